@@ -1,14 +1,18 @@
 import os
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from flask_migrate import Migrate
 from flask_cors import CORS
+from app.cache import ResponseCache
+from app.database import SQLAlchemy
+from app.metrics import Metrics
 
 db = SQLAlchemy()
 ma = Marshmallow()
 migrate = Migrate()
 cors = CORS()
+cache = ResponseCache()
+metrics = Metrics()
 
 
 def create_app(options={}):
@@ -21,6 +25,7 @@ def create_app(options={}):
         )
     app = Flask(__name__)
     app.config.from_object(config_name)
+    app.config.update(options)
     init_extensions(app)
     register_blueprints(app)
     return app
@@ -31,6 +36,14 @@ def init_extensions(app):
     ma.init_app(app)
     migrate.init_app(app, db)
     cors.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+    from app.reference import references
+    references.init_app(app)
+    metrics.gauge('db_pool_connections', 'Connections of the database pool',
+                  db.pool_status)
+    metrics.gauge('db_replica_healthy', 'Read replicas accepting queries',
+                  db.replicas_status)
 
 
 def register_blueprints(app):
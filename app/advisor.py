@@ -0,0 +1,93 @@
+""" Query plan advisor
+
+Runs the read only manager queries, captures the SQL they execute and asks
+the database for its plan, reporting the tables read with full sequential
+scans. Run it against a database with realistic volumes: on small tables
+planners prefer sequential scans even when a suitable index exists.
+"""
+import re
+
+from sqlalchemy import event
+
+from app import db
+from app.models import CustomersManager, OrdersManager, ProductsManager
+from app.summaries import SummariesManager
+
+MANAGER_QUERIES = (
+    CustomersManager.count_by_country,
+    ProductsManager.sells_by_product,
+    ProductsManager.units_delivered_by_product_by_country,
+    ProductsManager.count_by_category,
+    OrdersManager.count_by_status,
+    OrdersManager.check_totals,
+    SummariesManager.sells_by_product,
+    SummariesManager.units_delivered_by_product_by_country,
+    SummariesManager.count_by_status,
+    SummariesManager.check,
+)
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+}
+
+
+def capture_statements(function):
+    """ Calls function, returning the (statement, parameters) of the
+        SELECT statements it executed """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        function()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+    return statements
+
+
+def explain(connection, statement, parameters):
+    """ Plan of a statement, as a list of lines """
+    dialect = connection.dialect.name
+    if dialect not in EXPLAIN:
+        raise ValueError('EXPLAIN is not supported for %s' % dialect)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(EXPLAIN[dialect] + statement, parameters)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    return [str(row[-1]) for row in rows]
+
+
+def sequential_scans(dialect, plan):
+    """ Tables read with a full scan according to a plan """
+    scans = []
+    for line in plan:
+        if dialect == 'postgresql':
+            match = re.search(r'Seq Scan on (\S+)', line)
+        else:
+            # SQLite reports index scans as SCAN x USING [COVERING] INDEX
+            match = re.match(r'\s*SCAN (?:TABLE )?(\S+)', line)
+            if 'USING' in line and 'INDEX' in line:
+                match = None
+        if match:
+            scans.append(match.group(1))
+    return scans
+
+
+def advise():
+    """ Returns a list of (query name, statement, plan, sequentially
+        scanned tables) for every statement of the manager queries """
+    connection = db.session.connection()
+    report = []
+    for query in MANAGER_QUERIES:
+        name = query.__qualname__
+        for statement, parameters in capture_statements(query):
+            plan = explain(connection, statement, parameters)
+            report.append((name, statement, plan, sequential_scans(
+                connection.dialect.name, plan)))
+    return report
@@ -0,0 +1,7 @@
+import os
+
+from app import create_app
+from app.asgi_adapter import WsgiToAsgi
+
+application = WsgiToAsgi(create_app(),
+                         max_workers=int(os.getenv('ASGI_THREADS', '32')))
@@ -0,0 +1,129 @@
+""" ASGI adapter for WSGI applications
+
+Serves a WSGI application to an ASGI server (uvicorn, hypercorn, daphne).
+Requests are handled on an event loop and the application runs in a pool
+of threads, so a process keeps accepting connections while slow requests
+wait for the database: concurrency is bounded by the threads and the
+database pool, not by the number of processes.
+
+Response bodies are sent while the application produces them, which keeps
+streaming responses (exports) streaming.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WsgiToAsgi:
+    """ ASGI 3 application running `wsgi_app` in a thread pool """
+
+    def __init__(self, wsgi_app, max_workers=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported scope type %r' % scope['type'])
+        body = await read_body(receive)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.executor, self.run_wsgi, loop,
+                                   environ(scope, body), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run_wsgi(self, loop, environ, send):
+        """ Runs the application in a worker thread, sending the response
+            messages through the event loop """
+        def call(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('started'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1'))
+                for name, value in headers]
+
+        def start():
+            if not response.get('started'):
+                response['started'] = True
+                call({'type': 'http.response.start',
+                      'status': response['status'],
+                      'headers': response['headers']})
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    start()
+                    call({'type': 'http.response.body', 'body': chunk,
+                          'more_body': True})
+            start()
+            call({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body', False):
+            break
+    return bytes(body)
+
+
+def environ(scope, body):
+    """ WSGI environ of an ASGI http scope """
+    server = scope.get('server') or ('localhost', 80)
+    root_path = scope.get('root_path', '')
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+    return environ
@@ -0,0 +1,91 @@
+""" API benchmark
+
+Serves the app from a local threaded server and load tests every GET
+endpoint of the api blueprint, records are requested by the smallest id of
+their model. Results can be saved as JSON and compared with a previous run
+to catch regressions: slower p95 latency or throughput beyond a threshold,
+or more SQL statements per request (averages are rounded, cached responses
+make them fractional).
+"""
+import re
+import threading
+
+from sqlalchemy import func
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import db, loadtest
+
+ID_ARGUMENT = re.compile(r'<(?:int:)?id>')
+
+# Query strings of the endpoints with required arguments
+QUERY_STRINGS = {
+    '/api/products/search': 'q=product',
+    '/api/statistics/sales': 'from=2000-01-01&to=2100-01-01&bucket=month',
+}
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def api_paths(app):
+    """ Paths of the GET endpoints of the api, exports excluded, with
+        example arguments when some are required """
+    paths = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        defaults = rule.defaults or {}
+        if not rule.endpoint.startswith('api.') or \
+                'GET' not in rule.methods or 'export' in defaults:
+            continue
+        path = rule.rule
+        if 'id' in rule.arguments and 'id' not in defaults:
+            view = app.view_functions[rule.endpoint].view_class
+            model = view.Meta.model
+            id = db.session.query(func.min(model.id)).scalar()
+            if id is None:
+                continue
+            path = ID_ARGUMENT.sub(str(id), path)
+        if path in QUERY_STRINGS:
+            path += '?' + QUERY_STRINGS[path]
+        paths.append(path)
+    return paths
+
+
+def run(app, paths, concurrency=10, requests=200):
+    """ {path: load test summary}, see loadtest.PathResult """
+    app.config['METRICS_SERVER_TIMING'] = True
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        return loadtest.run('http://127.0.0.1:%d' % server.server_port,
+                            paths, concurrency, requests)
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def compare(baseline, results, threshold=0.2):
+    """ Returns a list of (path, metric, baseline value, value) of the
+        results that regressed from the baseline ones """
+    regressions = []
+    for path, summary in sorted(results.items()):
+        before = baseline.get(path)
+        if before is None:
+            continue
+        if before['p95'] and summary['p95'] > before['p95'] * (1 + threshold):
+            regressions.append((path, 'p95', before['p95'], summary['p95']))
+        if before['throughput'] and summary['throughput'] < \
+                before['throughput'] * (1 - threshold):
+            regressions.append((path, 'throughput', before['throughput'],
+                                summary['throughput']))
+        if before['sql_statements'] is not None and \
+                summary['sql_statements'] is not None and \
+                round(summary['sql_statements']) > \
+                round(before['sql_statements']):
+            regressions.append((path, 'sql_statements',
+                                before['sql_statements'],
+                                summary['sql_statements']))
+    return regressions
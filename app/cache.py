@@ -0,0 +1,292 @@
+""" Response cache for read heavy endpoints
+
+Cached views declare the models their response depends on. Every commit
+that flushed instances of one of those models invalidates the view
+responses. Entries also expire after CACHE_TTL seconds, which bounds the
+staleness when other processes write to the database and the backend isn't
+shared between them.
+
+Backends:
+    - 'lru': in-process LRU, one per worker
+    - 'shared': memcached-like client returned by CACHE_SHARED_CLIENT
+    - 'null': disables caching
+"""
+import abc
+import collections
+import functools
+import pickle
+import threading
+import time
+import uuid
+
+from flask import current_app, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.utils import import_string
+
+
+class CacheBackend(abc.ABC):
+    """ Storage used by ResponseCache. Keys are strings, values any
+        picklable object """
+
+    @abc.abstractmethod
+    def get(self, key):
+        """ Returns the value or None if it's missing or expired """
+
+    @abc.abstractmethod
+    def set(self, key, value, ttl=None):
+        """ Stores value, ttl is in seconds, None never expires """
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+
+class NullBackend(CacheBackend):
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUBackend(CacheBackend):
+    """ In-process LRU cache with per entry expiration """
+
+    def __init__(self, max_entries=256, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SharedBackend(CacheBackend):
+    """ Adapter for memcached-like clients, implementing
+        get(key), set(key, value, expire), delete(key) and flush_all().
+        Values are pickled so the client only deals with bytes """
+
+    def __init__(self, client, prefix='shop:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, pickle.dumps(value),
+                        int(ttl or 0))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        self.client.flush_all()
+
+
+class LocalSharedStore:
+    """ Stand-in for a shared cache server for development and tests.
+        Implements the subset of the memcached client API used by
+        SharedBackend, an expire of 0 means no expiration """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._data.get(key, (None, None))
+            if expires and expires <= self.clock():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, expire=0):
+        if not isinstance(value, bytes):
+            raise TypeError('Only bytes can be stored')
+        with self._lock:
+            self._data[key] = (value, self.clock() + expire if expire else 0)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+        return True
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+class ResponseCache:
+    """ Caches view responses, see module documentation """
+
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.ttl = None
+        # model class -> names of the views depending on it
+        self._dependencies = collections.defaultdict(set)
+        self._stats_lock = threading.Lock()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'lru')
+        app.config.setdefault('CACHE_TTL', 5)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 256)
+        app.config.setdefault('CACHE_SHARED_CLIENT',
+                              'app.cache.LocalSharedStore')
+        backend = app.config['CACHE_BACKEND']
+        if backend == 'lru':
+            self.backend = LRUBackend(app.config['CACHE_MAX_ENTRIES'])
+        elif backend == 'shared':
+            client = import_string(app.config['CACHE_SHARED_CLIENT'])()
+            self.backend = SharedBackend(client)
+        elif backend == 'null':
+            self.backend = NullBackend()
+        else:
+            raise ValueError('Unknown CACHE_BACKEND %r' % backend)
+        self.ttl = app.config['CACHE_TTL']
+        app.extensions['response_cache'] = self
+
+    def cached(self, *models):
+        """ View decorator caching the response for CACHE_TTL seconds or
+            until a commit changes an instance of one of `models` """
+        def decorator(f):
+            name = '%s.%s' % (f.__module__, f.__name__)
+            for model in models:
+                self._dependencies[model].add(name)
+
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                key = '%s:%s:%s' % (name, self._generation(name),
+                                    request.query_string.decode())
+                cached = self.backend.get(key)
+                if cached is not None:
+                    self._count(self.hits, name)
+                    body, status, mimetype = cached
+                    return current_app.response_class(
+                        body, status=status, mimetype=mimetype)
+                self._count(self.misses, name)
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200:
+                    self.backend.set(key, (response.get_data(), 200,
+                                           response.mimetype), self.ttl)
+                return response
+            return wrapper
+        return decorator
+
+    def _generation(self, name):
+        """ Views keys include a generation token, invalidating a view
+            replaces it so all its entries become unreachable """
+        generation = self.backend.get('generation:' + name)
+        if generation is None:
+            generation = self._new_generation(name)
+        return generation
+
+    def _new_generation(self, name):
+        generation = uuid.uuid4().hex
+        self.backend.set('generation:' + name, generation)
+        return generation
+
+    def _count(self, counter, name):
+        with self._stats_lock:
+            counter[name] += 1
+
+    def invalidate(self, *models):
+        """ Drops the cached responses of the views depending on `models` """
+        names = set()
+        for model in models:
+            names |= self._dependencies.get(model, set())
+        for name in names:
+            self._new_generation(name)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+            }
+
+
+def _touched_models(session):
+    return session.info.setdefault('cache_touched_models', set())
+
+
+def mark_touched(session, *models):
+    """ Records writes to `models` made without the unit of work (core
+        statements), so that the commit invalidates the views depending
+        on them """
+    _touched_models(session).update(models)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_flushed_models(session, flush_context):
+    touched = _touched_models(session)
+    for obj in session.new | session.dirty | session.deleted:
+        touched.add(type(obj))
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed_models(session):
+    touched = session.info.pop('cache_touched_models', None)
+    if touched and has_app_context() and \
+            'response_cache' in current_app.extensions:
+        current_app.extensions['response_cache'].invalidate(*touched)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_rolled_back_models(session, previous_transaction):
+    # Savepoints and subtransactions rolling back leave the enclosing
+    # transaction writes, which its commit must invalidate
+    if previous_transaction.parent is None:
+        session.info.pop('cache_touched_models', None)
@@ -17,33 +17,205 @@ def cli(debug):
 
 
 @cli.command()
-def populate_db():
+@click.option('--scale', default=1.0, show_default=True,
+              help='Size factor, 1 is 50 orders of 10 products')
+@click.option('--seed', type=int, help='Seed of a reproducible dataset')
+def populate_db(scale, seed):
     """ Populates the database with random data """
-    import app.tests.factories as factories
-    import random
-    from app.models import OrderStatusEnum
-
-    countries = factories.CountryFactory.create_batch(10)
-    customers = []
-    for country in countries:
-        customers += factories.CustomerFactory.create_batch(
-            random.randint(1, 10), country=country)
-    categories = factories.CategoryFactory.create_batch(20)
-    tags = factories.TagFactory.create_batch(10)
-    products = []
-    for _ in range(10):
-        products.append(factories.ProductFactory.create(
-            category=random.choice(categories),
-            tags=[t.name for t in random.sample(tags, random.randint(1, 4))]
-        ))
-    for _ in range(50):
-        order = factories.OrderFactory.create(
-            customer=random.choice(customers),
-            status=random.choice(list(OrderStatusEnum))
-        )
-        order_products = random.sample(products, random.randint(1, 5))
-        for p in order_products:
-            order.add_product(p, random.randint(1, 10))
+    from app import db
+    from app.seeding import DatasetGenerator, scaled_sizes
+
+    counts = DatasetGenerator(scaled_sizes(scale), seed=seed).run()
+    db.session.commit()
+    for table, count in counts.items():
+        click.echo('{:s}: {:d} rows'.format(table, count))
+
+
+@cli.command('rebuild-summaries')
+def rebuild_summaries():
+    """ Recomputes the statistics summary and rollup tables from the
+        orders """
+    from app import db
+    from app.rollups import RollupsManager
+    from app.summaries import SummariesManager
+
+    SummariesManager.rebuild()
+    RollupsManager.rebuild()
+    db.session.commit()
+
+
+@cli.command('rebuild-search')
+def rebuild_search():
+    """ Recomputes the product search documents """
+    from app import db
+    from app.search import SearchManager
+
+    SearchManager.rebuild()
+    db.session.commit()
+
+
+@cli.command('check-summaries')
+@click.pass_context
+def check_summaries(ctx):
+    """ Reports statistics summary and rollup rows that don't match the
+        orders """
+    from app.rollups import RollupsManager
+    from app.summaries import SummariesManager
+
+    errors = SummariesManager.check() + RollupsManager.check()
+    for table, key, expected, actual in errors:
+        click.echo('{:s} {!r}: expected {!r}, found {!r}'.format(
+            table, key, expected, actual))
+    if errors:
+        ctx.exit(1)
+    click.echo('Summaries are consistent')
+
+
+@cli.command('check-order-totals')
+@click.option('--fix', is_flag=True, default=False,
+              help='Recompute the totals of all the orders')
+@click.pass_context
+def check_order_totals(ctx, fix):
+    """ Reports orders whose stored totals don't match their detail """
+    from app import db
+    from app.models import OrdersManager
+
+    if fix:
+        OrdersManager.update_totals()
+        db.session.commit()
+    errors = OrdersManager.check_totals()
+    for id, stored, computed in errors:
+        click.echo('order {:d}: stored {!r}, computed {!r}'.format(
+            id, stored, computed))
+    if errors:
+        ctx.exit(1)
+    click.echo('Order totals are consistent')
+
+
+@cli.command('sweep-idempotency-keys')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Rows deleted per transaction')
+def sweep_idempotency_keys(batch_size):
+    """ Deletes the expired Idempotency-Key responses, run it periodically
+        (ex: hourly from cron) """
+    from app.idempotency import IdempotencyManager
+
+    deleted = IdempotencyManager.sweep(batch_size)
+    click.echo('{:d} expired keys deleted'.format(deleted))
+
+
+@cli.command('db-advise')
+@click.option('--plans', is_flag=True, default=False,
+              help='Print the statements and their full plans')
+def db_advise(plans):
+    """ Explains the manager queries and reports sequential scans """
+    from app.advisor import advise
+
+    for name, statement, plan, scans in advise():
+        if scans:
+            click.echo('{:s}: sequential scan of {:s}'.format(
+                name, ', '.join(scans)))
+        else:
+            click.echo('{:s}: no sequential scans'.format(name))
+        if plans:
+            click.echo(statement)
+            for line in plan:
+                click.echo('    ' + line)
+            click.echo()
+
+
+@cli.command()
+@click.argument('urls', nargs=-1, required=True)
+@click.option('--path', 'paths', multiple=True,
+              default=['/statistics/sells_by_product', '/products'],
+              show_default=True, help='Path requested, relative to URLS')
+@click.option('--concurrency', default=20, show_default=True)
+@click.option('--requests', default=500, show_default=True,
+              help='Requests per path')
+def loadtest(urls, paths, concurrency, requests):
+    """ Compares the throughput and latency of deployments of the api,
+        ex: app loadtest http://uwsgi/api http://asgi/api """
+    from app.loadtest import run
+
+    click.echo('{:30s} {:30s} {:>8s} {:>6s} {:>8s} {:>8s} {:>8s}'.format(
+        'url', 'path', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for url in urls:
+        for path, summary in run(url, paths, concurrency, requests).items():
+            click.echo(
+                '{:30s} {:30s} {:8.1f} {:6d} {:8.1f} {:8.1f} {:8.1f}'.format(
+                    url, path, summary['throughput'], summary['errors'],
+                    summary['p50'] * 1000, summary['p95'] * 1000,
+                    summary['p99'] * 1000))
+
+
+@cli.command('generate-dataset')
+@click.option('--countries', default=50, show_default=True)
+@click.option('--categories', default=50, show_default=True)
+@click.option('--tags', default=200, show_default=True)
+@click.option('--products', default=10000, show_default=True)
+@click.option('--customers', default=50000, show_default=True)
+@click.option('--orders', default=200000, show_default=True)
+@click.option('--lines', default=5, show_default=True,
+              help='Average detail lines per order')
+@click.option('--seed', default=0, show_default=True)
+def generate_dataset(lines, seed, **sizes):
+    """ Adds a large random dataset to the database """
+    from app import db
+    from app.seeding import DatasetGenerator
+
+    counts = DatasetGenerator(sizes, lines=lines, seed=seed).run()
+    db.session.commit()
+    for table, count in counts.items():
+        click.echo('{:s}: {:d} rows'.format(table, count))
+
+
+@cli.command()
+@click.option('--concurrency', default=10, show_default=True)
+@click.option('--requests', default=200, show_default=True,
+              help='Requests per endpoint')
+@click.option('--output', type=click.File('w'),
+              help='Save the results as JSON')
+@click.option('--compare', 'baseline', type=click.File(),
+              help='Results of a previous run to compare with')
+@click.option('--threshold', default=0.2, show_default=True,
+              help='Tolerated p95 and throughput change ratio')
+@click.pass_context
+def benchmark(ctx, concurrency, requests, output, baseline, threshold):
+    """ Load tests every api GET endpoint, reporting throughput, latency
+        percentiles and SQL statements count. Fill the database with
+        generate-dataset first """
+    import json
+    from flask import current_app
+    from app import benchmark
+    from app import db
+
+    paths = benchmark.api_paths(current_app)
+    db.session.remove()
+    results = benchmark.run(current_app._get_current_object(), paths,
+                            concurrency, requests)
+    click.echo('{:50s} {:>8s} {:>6s} {:>8s} {:>8s} {:>8s} {:>5s}'.format(
+        'path', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'sql'))
+    for path, summary in results.items():
+        click.echo(
+            '{:50s} {:8.1f} {:6d} {:8.1f} {:8.1f} {:8.1f} {:>5s}'.format(
+                path, summary['throughput'], summary['errors'],
+                summary['p50'] * 1000, summary['p95'] * 1000,
+                summary['p99'] * 1000,
+                '-' if summary['sql_statements'] is None
+                else '{:.1f}'.format(summary['sql_statements'])))
+    if output:
+        json.dump({'concurrency': concurrency, 'requests': requests,
+                   'database': db.engine.dialect.name,
+                   'results': results}, output, indent=2, sort_keys=True)
+    if baseline:
+        regressions = benchmark.compare(json.load(baseline)['results'],
+                                        results, threshold)
+        for path, metric, before, after in regressions:
+            click.echo('{:s} {:s}: {:.4g} -> {:.4g}'.format(
+                path, metric, before, after))
+        if regressions:
+            ctx.exit(1)
+        click.echo('No regressions')
 
 
 if __name__ == '__main__':
@@ -4,6 +4,11 @@ full_path = os.path.realpath(__file__)
 path, filename = os.path.split(full_path)
 
 
+def env_int(name, default=None):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
 class BaseConfig:
     """Base configuration."""
     SECRET_KEY = os.getenv('SECRET_KEY', 'my_secret')
@@ -12,7 +17,48 @@ class BaseConfig:
         'DATABASE_URI',
         'sqlite:///' + path + '/simple-shop.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Engine and pool tuning, see app/database.py. Size the pool so that
+    # workers * (pool size + overflow) fits the database max_connections
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE')
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW')
+    SQLALCHEMY_POOL_TIMEOUT = env_int('SQLALCHEMY_POOL_TIMEOUT')
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE')
+    SQLALCHEMY_POOL_PRE_PING = os.getenv('SQLALCHEMY_POOL_PRE_PING') == '1'
+    # Milliseconds, PostgreSQL only
+    SQLALCHEMY_STATEMENT_TIMEOUT = env_int('SQLALCHEMY_STATEMENT_TIMEOUT')
+    # Connections are pooled by pgbouncer or alike
+    SQLALCHEMY_EXTERNAL_POOLER = os.getenv('SQLALCHEMY_EXTERNAL_POOLER') == '1'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    # Read only requests are served by these databases, see app/replicas.py
+    SQLALCHEMY_REPLICA_URIS = list(filter(None, os.getenv(
+        'DATABASE_REPLICA_URIS', '').split(',')))
+    # Seconds a failing replica is skipped
+    REPLICA_RETRY_AFTER = env_int('REPLICA_RETRY_AFTER', 30)
+    # Seconds a client reads from the primary after a write
+    REPLICA_STICKY_SECONDS = env_int('REPLICA_STICKY_SECONDS', 5)
 #    SQLALCHEMY_ECHO = True
+    # Statistics responses cache: 'lru', 'shared' or 'null'
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'lru')
+    CACHE_TTL = int(os.getenv('CACHE_TTL', '5'))
+    CACHE_MAX_ENTRIES = 256
+    CACHE_SHARED_CLIENT = os.getenv('CACHE_SHARED_CLIENT',
+                                    'app.cache.LocalSharedStore')
+    # Seconds between checks for reference data (countries, categories,
+    # tags) changed by other processes, see app/reference.py
+    REFERENCE_CACHE_CHECK = env_int('REFERENCE_CACHE_CHECK', 1)
+    # Maximum items accepted by POST /<plural>/bulk
+    BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', '1000'))
+    # Seconds POST responses are kept for retries with the same
+    # Idempotency-Key, see app/idempotency.py
+    IDEMPOTENCY_KEY_TTL = env_int('IDEMPOTENCY_KEY_TTL', 24 * 3600)
+    # Seconds after which a key reserved by a request that never stored its
+    # response can be used again, longer than any request
+    IDEMPOTENCY_RESERVATION_TIMEOUT = env_int(
+        'IDEMPOTENCY_RESERVATION_TIMEOUT', 60)
+    # Rows fetched per query by GET /<plural>/export
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '1000'))
+    # Return request timings to clients in a Server-Timing header
+    METRICS_SERVER_TIMING = os.getenv('METRICS_SERVER_TIMING') == '1'
 
 
 class DevelopmentConfig(BaseConfig):
@@ -26,8 +72,16 @@ class TestingConfig(BaseConfig):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = os.getenv(
         'TEST_DATABASE_URL', 'sqlite:////tmp/simple-shop_test.db')
+    SQLALCHEMY_REPLICA_URIS = []
 
 
 class ProductionConfig(BaseConfig):
     """Production configuration."""
     DEBUG = False
+    SQLALCHEMY_POOL_SIZE = env_int('SQLALCHEMY_POOL_SIZE', 5)
+    SQLALCHEMY_MAX_OVERFLOW = env_int('SQLALCHEMY_MAX_OVERFLOW', 5)
+    SQLALCHEMY_POOL_RECYCLE = env_int('SQLALCHEMY_POOL_RECYCLE', 1800)
+    SQLALCHEMY_POOL_PRE_PING = os.getenv(
+        'SQLALCHEMY_POOL_PRE_PING', '1') == '1'
+    SQLALCHEMY_STATEMENT_TIMEOUT = env_int('SQLALCHEMY_STATEMENT_TIMEOUT',
+                                           30000)
@@ -0,0 +1,150 @@
+""" Engine and connection pool configuration
+
+Flask-SQLAlchemy only knows about pool size, timeout, recycle and overflow.
+This extension adds, from the app config:
+
+    - SQLALCHEMY_POOL_PRE_PING: test connections on checkout, dropping the
+      ones closed by the server or a proxy
+    - SQLALCHEMY_STATEMENT_TIMEOUT: PostgreSQL statement_timeout in
+      milliseconds, applied to every connection
+    - SQLALCHEMY_EXTERNAL_POOLER: connections are pooled outside the
+      process (pgbouncer), don't keep any open (NullPool)
+    - SQLALCHEMY_ENGINE_OPTIONS: any other create_engine option, ex:
+      psycopg2 connect_args
+
+Pooled connections must not be shared between processes. Engines get new
+pools after uwsgi forks its workers, and connections checked out by a
+process other than the one that opened them are discarded, which covers
+other preforking servers.
+
+Read only requests can be served by replicas, see app/replicas.py.
+"""
+import os
+import time
+
+import flask_sqlalchemy
+import sqlalchemy
+from sqlalchemy import event, exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, Pool, QueuePool
+
+from app.metrics import observe_pool_wait
+from app.replicas import ReplicaRouter, RoutingSession, init_routing
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+# create_engine options only understood by QueuePool
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool recording how long checkouts wait for a connection """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            observe_pool_wait(time.perf_counter() - start)
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        app.config.setdefault('SQLALCHEMY_STATEMENT_TIMEOUT', None)
+        app.config.setdefault('SQLALCHEMY_EXTERNAL_POOLER', False)
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('REPLICA_RETRY_AFTER', 30)
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+        app.config.setdefault('REPLICA_STICKY_COOKIE', 'read_primary_until')
+        super().init_app(app)
+        router = ReplicaRouter(
+            [self.create_engine(app, uri)
+             for uri in app.config['SQLALCHEMY_REPLICA_URIS']],
+            retry_after=app.config['REPLICA_RETRY_AFTER'])
+        app.extensions['replicas'] = router
+        if router.engines:
+            init_routing(app, self, router)
+        if postfork is not None:
+            postfork(lambda: self.reset_pools(app))
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, app, uri):
+        """ Engine for uri with the same options as the primary one """
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        return sqlalchemy.create_engine(info, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        config = app.config
+        if config['SQLALCHEMY_POOL_PRE_PING']:
+            options['pool_pre_ping'] = True
+        engine_options = dict(config['SQLALCHEMY_ENGINE_OPTIONS'])
+        connect_args = dict(options.get('connect_args', {}),
+                            **engine_options.pop('connect_args', {}))
+        options.update(engine_options)
+        timeout = config['SQLALCHEMY_STATEMENT_TIMEOUT']
+        if timeout and info.drivername.startswith('postgresql'):
+            connect_args['options'] = ' '.join(filter(None, [
+                connect_args.get('options'),
+                '-c statement_timeout=%d' % timeout]))
+        if connect_args:
+            options['connect_args'] = connect_args
+        if config['SQLALCHEMY_EXTERNAL_POOLER']:
+            options['poolclass'] = NullPool
+            for key in QUEUE_POOL_OPTIONS:
+                options.pop(key, None)
+        elif 'poolclass' not in options and info.drivername != 'sqlite':
+            options['poolclass'] = InstrumentedQueuePool
+
+    def reset_pools(self, app):
+        """ Replaces the pools of the engines created so far. Their
+            connections are left open, they belong to the parent process """
+        state = flask_sqlalchemy.get_state(app)
+        for connector in list(state.connectors.values()):
+            engine = connector.get_engine()
+            engine.pool = engine.pool.recreate()
+        app.extensions['replicas'].reset_pools()
+
+    def pool_status(self):
+        """ [(labels, connections)] of the current app engine pool """
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return []
+        return [
+            ({'state': 'idle'}, pool.checkedin()),
+            ({'state': 'checked_out'}, pool.checkedout()),
+            ({'state': 'overflow'}, max(pool.overflow(), 0)),
+            ({'state': 'size'}, pool.size()),
+        ]
+
+    def replicas_status(self):
+        """ [(labels, 1 if healthy else 0)] of the current app replicas """
+        router = self.get_app().extensions['replicas']
+        return [({'replica': str(i)}, int(router.is_healthy(engine)))
+                for i, engine in enumerate(router.engines)]
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        # opened by the parent process: forget it without closing it, the
+        # pool then opens a new one
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid %s, attempting to check out '
+            'in pid %s' % (connection_record.info['pid'], os.getpid()))
@@ -0,0 +1,111 @@
+""" Idempotent creation requests
+
+Clients retrying a POST after a timeout can't know whether the first
+attempt created the records. Sending the same `Idempotency-Key` header on
+every attempt makes the API create them once and return the response of
+the first successful attempt to the others, without loading nor writing
+anything else.
+
+The idempotency_key table keeps, by key, a hash of the request (method,
+path and body), the response once known, and an expiry. The row of a
+request is inserted before the records are created, in the same
+transaction: concurrent attempts with the same key wait for it on
+the primary key, and failed attempts roll it back so they can be retried.
+The response is stored in the same transaction too, so a key is either
+unknown or answered with the response of its committed records. Attempts
+arriving while the first one runs get a conflict, as do requests reusing
+a key with another body.
+
+Rows with a response expire after IDEMPOTENCY_KEY_TTL seconds, `app
+sweep-idempotency-keys` deletes them. Reservations expire after
+IDEMPOTENCY_RESERVATION_TIMEOUT seconds: should one be committed without
+its response, retries are conflicts only until then.
+"""
+import datetime
+import hashlib
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+
+# Longest key accepted
+MAX_KEY_LENGTH = 255
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'
+    key = db.Column(db.String(MAX_KEY_LENGTH), primary_key=True)
+    # sha256 hex digest of the request
+    request_hash = db.Column(db.String(64), nullable=False)
+    # None until the request succeeded
+    status = db.Column(db.SmallInteger)
+    response = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+def request_hash(method, path, body):
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), body):
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class IdempotencyManager:
+    @staticmethod
+    def find(key, now=None):
+        """ Unexpired IdempotencyKey of key, None if there is none """
+        record = IdempotencyKey.query.filter(
+            IdempotencyKey.key == key).first()
+        if record is not None and \
+                record.expires_at <= (now or datetime.datetime.now()):
+            return None
+        return record
+
+    @staticmethod
+    def reserve(key, hash, timeout, now=None):
+        """ Inserts the row of a new request in the session transaction,
+            replacing an expired one, expiring after `timeout` seconds
+            unless its response is stored. Returns False, after rolling
+            back the transaction, if a concurrent request already inserted
+            it """
+        table = IdempotencyKey.__table__
+        now = now or datetime.datetime.now()
+        try:
+            db.session.execute(table.delete().where(db.and_(
+                table.c.key == key, table.c.expires_at <= now)))
+            db.session.execute(table.insert().values(
+                key=key, request_hash=hash,
+                expires_at=now + datetime.timedelta(seconds=timeout)))
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    @staticmethod
+    def store(key, status, response, ttl, now=None):
+        """ Records the response of the request of key, in the session
+            transaction creating its records, kept `ttl` seconds """
+        table = IdempotencyKey.__table__
+        now = now or datetime.datetime.now()
+        db.session.execute(table.update().where(table.c.key == key).values(
+            status=status, response=response,
+            expires_at=now + datetime.timedelta(seconds=ttl)))
+
+    @staticmethod
+    def sweep(batch_size=1000, now=None):
+        """ Deletes the expired rows, batch_size per transaction, and
+            returns how many were deleted """
+        table = IdempotencyKey.__table__
+        now = now or datetime.datetime.now()
+        deleted = 0
+        while True:
+            keys = select([table.c.key]).where(
+                table.c.expires_at <= now).limit(batch_size)
+            count = db.session.execute(table.delete().where(
+                table.c.key.in_(keys))).rowcount
+            db.session.commit()
+            deleted += count
+            if count < batch_size:
+                return deleted
@@ -0,0 +1,109 @@
+""" HTTP load generator
+
+Sends requests to a running server from a pool of threads, each one using
+its own keep-alive connection, and reports throughput and latency
+percentiles per path, and the SQL statements count the server reports in
+its Server-Timing header (METRICS_SERVER_TIMING). Pointing it at several
+deployments of the same database (ex: uwsgi and the ASGI entry point)
+compares them.
+"""
+import http.client
+import math
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+SQL_COUNT = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+class PathResult:
+    def __init__(self, path):
+        self.path = path
+        self.latencies = []
+        self.errors = 0
+        self.sql_counts = []
+        self.elapsed = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok, sql_count=None):
+        with self._lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+            if sql_count is not None:
+                self.sql_counts.append(sql_count)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'requests': len(latencies),
+            'errors': self.errors,
+            'throughput': len(latencies) / self.elapsed if self.elapsed
+            else None,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'sql_statements': (sum(self.sql_counts) / len(self.sql_counts)
+                               if self.sql_counts else None),
+        }
+
+
+def connection(url, timeout):
+    parts = urlsplit(url)
+    cls = (http.client.HTTPSConnection if parts.scheme == 'https'
+           else http.client.HTTPConnection)
+    return cls(parts.netloc, timeout=timeout), parts.path.rstrip('/')
+
+
+def load_path(url, path, concurrency, requests, timeout=30):
+    """ Requests url + path `requests` times from `concurrency` threads """
+    result = PathResult(path)
+    remaining = iter(range(requests))
+    lock = threading.Lock()
+
+    def worker():
+        conn, prefix = connection(url, timeout)
+        try:
+            while True:
+                with lock:
+                    if next(remaining, None) is None:
+                        return
+                start = time.perf_counter()
+                try:
+                    conn.request('GET', prefix + path)
+                    response = conn.getresponse()
+                    response.read()
+                    ok = response.status < 400
+                    sql_count = SQL_COUNT.search(
+                        response.getheader('Server-Timing', ''))
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    ok, sql_count = False, None
+                result.record(time.perf_counter() - start, ok,
+                              int(sql_count.group(1)) if sql_count else None)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.perf_counter() - start
+    return result
+
+
+def run(url, paths, concurrency=10, requests=100, timeout=30):
+    """ {path: summary} of loading every path in turn """
+    return {path: load_path(url, path, concurrency, requests,
+                            timeout).summary()
+            for path in paths}
@@ -0,0 +1,229 @@
+""" Request instrumentation
+
+Records, for every endpoint, the request latency, how many SQL statements
+it executed, how long they took and how long serializing the response
+took. Values are kept in histograms exposed at /metrics in the Prometheus
+text format, and optionally returned to clients in a Server-Timing header
+(METRICS_SERVER_TIMING).
+
+Histograms live in the process memory: with several workers each one
+exposes its own values, scrape them separately or aggregate them with
+the worker label of your deployment.
+"""
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+
+class Histogram:
+    """ Prometheus-like histogram with labels """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # labels tuple -> [bucket counts..., +Inf count, sum, count]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 3)
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self, **labels):
+        """ Returns (cumulative bucket counts, sum, count) of a series """
+        with self._lock:
+            series = self._series.get(tuple(sorted(labels.items())))
+            series = list(series) if series else [0] * (len(self.buckets) + 3)
+        cumulative, total = [], 0
+        for count in series[:len(self.buckets) + 1]:
+            total += count
+            cumulative.append(total)
+        return cumulative, series[-2], series[-1]
+
+    def expose(self):
+        """ Lines of the Prometheus text format """
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            keys = sorted(self._series)
+        for key in keys:
+            labels = dict(key)
+            buckets, total, count = self.samples(**labels)
+            for le, value in zip(self.buckets + ('+Inf',), buckets):
+                lines.append('%s_bucket%s %d' % (
+                    self.name, _labels(key + (('le', _number(le)),)), value))
+            lines.append('%s_sum%s %s' % (self.name, _labels(key),
+                                          _number(total)))
+            lines.append('%s_count%s %d' % (self.name, _labels(key), count))
+        return lines
+
+
+def _number(value):
+    return value if isinstance(value, str) else repr(float(value))
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs)
+
+
+# Filled by the database connection pool, for any request or command
+POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds',
+    'Time waited to check out a connection from the pool', WAIT_BUCKETS)
+
+
+def observe_pool_wait(seconds):
+    POOL_CHECKOUT_WAIT.observe(seconds)
+    current = _current()
+    if current is not None:
+        current.timings['pool'] += seconds
+
+
+class RequestMetrics:
+    """ Measures of the current request, stored in flask.g """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0
+        self.timings = collections.defaultdict(float)
+
+
+class Metrics:
+    """ Flask extension recording the endpoints histograms """
+
+    def __init__(self, app=None):
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Request latency')
+        self.sql_count = Histogram(
+            'http_request_sql_statements', 'SQL statements per request',
+            COUNT_BUCKETS)
+        self.sql_duration = Histogram(
+            'http_request_sql_duration_seconds',
+            'Time spent executing SQL per request')
+        self.serialization_duration = Histogram(
+            'http_request_serialization_duration_seconds',
+            'Time spent serializing the response per request')
+        self.histograms = [self.request_duration, self.sql_count,
+                           self.sql_duration, self.serialization_duration,
+                           POOL_CHECKOUT_WAIT]
+        self.gauges = collections.OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_SERVER_TIMING', False)
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        app.add_url_rule('/metrics', 'metrics', self.expose)
+        app.extensions['metrics'] = self
+
+    def gauge(self, name, help, function):
+        """ Exposes the values returned by function, a list of
+            (labels dict, value) """
+        self.gauges[name] = (help, function)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """ Adds the time spent in the block to the `name` timing of the
+            current request """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            current = _current()
+            if current is not None:
+                current.timings[name] += time.perf_counter() - start
+
+    def _start_request(self):
+        g.request_metrics = RequestMetrics()
+
+    def _end_request(self, response):
+        current = _current()
+        if current is None or request.endpoint in (None, 'metrics',
+                                                   'static'):
+            return response
+        elapsed = time.perf_counter() - current.start
+        labels = {'endpoint': request.endpoint, 'method': request.method}
+        self.request_duration.observe(elapsed, **labels)
+        self.sql_count.observe(current.sql_count, **labels)
+        self.sql_duration.observe(current.sql_time, **labels)
+        self.serialization_duration.observe(
+            current.timings['serialization'], **labels)
+        if current_app.config['METRICS_SERVER_TIMING']:
+            response.headers['Server-Timing'] = server_timing(
+                current, elapsed)
+        return response
+
+    def expose(self):
+        lines = []
+        for histogram in self.histograms:
+            lines += histogram.expose()
+        for name, (help, function) in self.gauges.items():
+            lines += ['# HELP %s %s' % (name, help),
+                      '# TYPE %s gauge' % name]
+            for labels, value in function():
+                lines.append('%s%s %s' % (name, _labels(
+                    sorted(labels.items())), _number(value)))
+        return current_app.response_class(
+            '\n'.join(lines) + '\n',
+            mimetype='text/plain; version=0.0.4')
+
+
+def server_timing(current, elapsed):
+    metrics = ['db;dur=%.3f;desc="%d queries"' % (
+        current.sql_time * 1000, current.sql_count)]
+    for name, duration in sorted(current.timings.items()):
+        metrics.append('%s;dur=%.3f' % (name, duration * 1000))
+    metrics.append('total;dur=%.3f' % (elapsed * 1000))
+    return ', '.join(metrics)
+
+
+def _current():
+    if has_request_context():
+        return g.get('request_metrics')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_sql_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_end(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['metrics_sql_start'].pop()
+    current = _current()
+    if current is not None:
+        current.sql_count += 1
+        current.sql_time += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'handle_error')
+def _sql_error(context):
+    if context.connection is not None and context.cursor is not None:
+        starts = context.connection.info.get('metrics_sql_start')
+        if starts:
+            starts.pop()
@@ -1,10 +1,12 @@
 import datetime
 import decimal
 import enum
+import time
 
 from flask_sqlalchemy import BaseQuery
-from sqlalchemy import func, select
-from sqlalchemy.orm import aliased
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.sql import label
@@ -20,7 +22,27 @@ class ModelEnum(enum.Enum):
         return None
 
 
-class Category(db.Model):
+def next_version(previous=0):
+    """ Row versions are microsecond timestamps forced to grow on every
+        change of the row. They aren't ordered across rows: concurrent
+        transactions and hosts whose clocks differ can give an update a
+        version lower than the one of a row written earlier """
+    return max(int(time.time() * 1000000), previous + 1)
+
+
+class Versioned:
+    """ Adds a version column bumped every time the row is modified.
+        Collections listed in __versioned_collections__ are part of the
+        row representation and bump the version too """
+    __versioned_collections__ = ()
+    version = db.Column(db.BigInteger, nullable=False,
+                        default=lambda: next_version())
+
+    def bump_version(self):
+        self.version = next_version(self.version or 0)
+
+
+class Category(Versioned, db.Model):
     __tablename__ = 'category'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(50), nullable=False, unique=True)
@@ -33,16 +55,12 @@ class Category(db.Model):
 
     class CategoryQuery(BaseQuery):
         def get_or_create(self, name):
-            with db.session.no_autoflush:
-                category = Category.query.filter(Category.name == name).first()
-                if category is None:
-                    category = Category(name=name)
-            return category
+            return NameResolver(Category).resolve([name])[0]
 
     query_class = CategoryQuery
 
 
-class Country(db.Model):
+class Country(Versioned, db.Model):
     __tablename__ = 'country'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(50), nullable=False, unique=True)
@@ -51,14 +69,14 @@ class Country(db.Model):
         return '<Country %r>' % self.name
 
 
-class Customer(db.Model):
+class Customer(Versioned, db.Model):
     __tablename__ = 'customer'
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(255), unique=True, nullable=False)
     firstname = db.Column(db.Unicode(30), nullable=False)
     lastname = db.Column(db.Unicode(30), nullable=False)
     country_id = db.Column(db.Integer, db.ForeignKey(
-        'country.id'), nullable=False)
+        'country.id'), nullable=False, index=True)
     country = db.relationship('Country', backref='customers')
     orders = db.relationship(
         'Order',
@@ -102,29 +120,84 @@ class Tag(db.Model):
 
     class TagQuery(BaseQuery):
         def get_or_create(self, name):
-            with db.session.no_autoflush:
-                tag = Tag.query.filter(Tag.name == name).first()
-                if tag is None:
-                    tag = Tag(name=name)
-            return tag
+            return NameResolver(Tag).resolve([name])[0]
 
     query_class = TagQuery
 
 
+class NameResolver:
+    """ Maps names to instances of a model with an unique `name` column.
+        Known names are fetched with a single IN query, or from the
+        reference data cache (see reference.py), and missing ones
+        are inserted with a single statement that ignores the names a
+        concurrent transaction inserted meanwhile, so get or create never
+        fails on the unique constraint. Instances are shared between all
+        the lookups done through the same resolver """
+
+    def __init__(self, model):
+        self.model = model
+        self.instances = {}
+        self.looked_up = set()
+
+    def prefetch(self, names):
+        from app.reference import MODELS, references
+        missing = set(names) - self.looked_up
+        self.looked_up |= missing
+        if missing and self.model in MODELS:
+            self.instances.update(references.find(self.model, missing))
+        elif missing:
+            with db.session.no_autoflush:
+                for o in self.model.query.filter(
+                        self.model.name.in_(missing)):
+                    self.instances[o.name] = o
+
+    def resolve(self, names):
+        """ Returns the instances named `names`, in the same order """
+        self.prefetch(names)
+        missing = {name for name in names if name not in self.instances}
+        if missing:
+            self.create(missing)
+        return [self.instances[name] for name in names]
+
+    def create(self, names):
+        table = self.model.__table__
+        dialect = db.session.get_bind(inspect(self.model)).dialect.name
+        if dialect == 'postgresql':
+            insert = postgresql.insert(table).on_conflict_do_nothing(
+                index_elements=[table.c.name])
+        elif dialect == 'sqlite':
+            insert = table.insert().prefix_with('OR IGNORE')
+        else:
+            insert = table.insert()
+        with db.session.no_autoflush:
+            db.session.execute(
+                insert.values([{'name': name} for name in sorted(names)]),
+                mapper=inspect(self.model))
+        from app.reference import mark_changed
+        mark_changed(db.session, {self.model})
+        self.looked_up -= set(names)
+        self.prefetch(names)
+
+
 class ProductStatusEnum(ModelEnum):
     ACTIVE = 'ACTIVE'
     INACTIVE = 'INACTIVE'
     COMING_SOON = 'COMING_SOON'
 
 
-class Product(db.Model):
+class Product(Versioned, db.Model):
     __tablename__ = 'product'
+    __table_args__ = (
+        # Filtering by status, ordered by id for pagination
+        db.Index('ix_product_status_id', 'status', 'id'),
+    )
+    __versioned_collections__ = ('rel_tags',)
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(50), nullable=False, unique=True)
     description = db.Column(db.UnicodeText())
     price = db.Column(db.Numeric(10, 5, asdecimal=True))
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'),
-                            nullable=False)
+                            nullable=False, index=True)
     category = db.relationship('Category', backref=db.backref(
         'products', lazy='dynamic'), lazy='select')
     status = db.Column(
@@ -132,7 +205,7 @@ class Product(db.Model):
         nullable=False
     )
     rel_tags = db.relationship('Tag', secondary='product_tag',
-                               backref='products')
+                               backref='products', order_by='Tag.id')
     tags = association_proxy(
         'rel_tags', 'name',
         creator=lambda name: Tag.query.get_or_create(name=name)
@@ -223,7 +296,8 @@ class ProductTag(db.Model):
     __tablename__ = 'product_tag'
     product_id = db.Column(db.Integer, db.ForeignKey(
         'product.id'), primary_key=True)
-    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id'), primary_key=True,
+                       index=True)
 
 
 class OrderStatusEnum(ModelEnum):
@@ -236,8 +310,14 @@ class OrderStatusEnum(ModelEnum):
 
 class OrderDetail(db.Model):
     __tablename__ = 'order_detail'
+    __table_args__ = (
+        # Covers the units sold by product aggregates
+        db.Index('ix_order_detail_product_id_quantity', 'product_id',
+                 'quantity'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False,
+                         index=True)
     order = db.relationship('Order', backref='detail')
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'),
                            nullable=False)
@@ -248,37 +328,34 @@ class OrderDetail(db.Model):
 
     @hybrid_property
     def total(self):
-        return decimal.Decimal(self.unit_price * self.quantity)
+        return decimal.Decimal((self.unit_price or 0) * self.quantity)
 
 
-class Order(db.Model):
+class Order(Versioned, db.Model):
     __tablename__ = 'order'
+    __table_args__ = (
+        # Filtering by status, ordered by id for pagination
+        db.Index('ix_order_status_id', 'status', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'),
-                            nullable=False)
+                            nullable=False, index=True)
     status = db.Column(db.Enum(OrderStatusEnum, validate_strings=True),
                        nullable=False)
     created_at = db.Column(db.DateTime, nullable=False)
+    # Sum of the detail lines totals and quantities, kept up to date by
+    # add_product and update_order_totals
+    total = db.Column(db.Numeric(12, 5, asdecimal=True), nullable=False,
+                      default=0, index=True)
+    items_count = db.Column(db.Integer, nullable=False, default=0)
 
     def __init__(self, *arg, **kw):
         super().__init__(*arg, **kw)
         self.created_at = datetime.datetime.now()
         if 'status' not in kw:
             self.status = OrderStatusEnum.PENDING
-
-    @hybrid_property
-    def total(self):
-        return decimal.Decimal(sum(map(lambda d: d.total, self.detail)))
-
-    @total.expression
-    def total(cls):
-        return (
-            select([func.coalesce(func.sum(
-                OrderDetail.unit_price * OrderDetail.quantity), 0
-            )])
-            .where(OrderDetail.order_id == cls.id)
-            .label('total')
-        )
+        self.total = decimal.Decimal(0)
+        self.items_count = 0
 
     def add_product(self, product, quantity):
         self.detail.append(OrderDetail(
@@ -286,6 +363,15 @@ class Order(db.Model):
             quantity=quantity,
             unit_price=product.price
         ))
+        self.total += self.detail[-1].total
+        self.items_count += quantity
+
+    def update_totals(self, removed=()):
+        """ Recomputes total and items_count from the detail lines, but
+            the `removed` ones """
+        lines = [d for d in self.detail if d not in removed]
+        self.total = decimal.Decimal(sum(d.total for d in lines))
+        self.items_count = sum(d.quantity for d in lines)
 
     def __repr__(self):
         return '<Order %r>' % self.id
@@ -301,3 +387,92 @@ class OrdersManager:
                 label('status', Order.status),
                 label('count', func.count(Order.id))
             ).group_by(Order.status).all()
+
+    @staticmethod
+    def _detail_totals():
+        return (
+            select([
+                OrderDetail.order_id,
+                label('total', func.sum(
+                    OrderDetail.unit_price * OrderDetail.quantity)),
+                label('items_count', func.sum(OrderDetail.quantity)),
+            ])
+            .group_by(OrderDetail.order_id)
+            .alias('detail_totals')
+        )
+
+    @staticmethod
+    def check_totals():
+        """ Returns a list of (order id, stored (total, items count),
+            computed (total, items count)) for the orders whose stored
+            totals don't match their detail lines """
+        lines = OrdersManager._detail_totals()
+        rows = (
+            db.session.query(Order.id, Order.total, Order.items_count,
+                             lines.c.total, lines.c.items_count)
+            .outerjoin(lines, lines.c.order_id == Order.id)
+            .order_by(Order.id)
+        )
+        cents = decimal.Decimal('0.01')
+        errors = []
+        for id, total, items_count, lines_total, lines_count in rows:
+            stored = (decimal.Decimal(total).quantize(cents), items_count)
+            computed = (decimal.Decimal(lines_total or 0).quantize(cents),
+                        lines_count or 0)
+            if stored != computed:
+                errors.append((id, stored, computed))
+        return errors
+
+    @staticmethod
+    def update_totals():
+        """ Recomputes the stored totals of all the orders """
+        def detail_sum(expression):
+            return func.coalesce(
+                select([func.sum(expression)])
+                .where(OrderDetail.order_id == Order.id).as_scalar(), 0)
+        db.session.execute(Order.__table__.update().values(
+            total=detail_sum(OrderDetail.unit_price * OrderDetail.quantity),
+            items_count=detail_sum(OrderDetail.quantity)))
+
+
+@event.listens_for(Session, 'before_flush')
+def bump_versions(session, flush_context, instances):
+    """ Bumps the version of the modified rows. Detail lines are part of
+        their order representation """
+    bumped = set()
+    for obj in session.dirty:
+        if not isinstance(obj, Versioned):
+            continue
+        attrs = inspect(obj).attrs
+        if session.is_modified(obj, include_collections=False) or any(
+                attrs[name].history.has_changes()
+                for name in obj.__versioned_collections__):
+            bumped.add(obj)
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, OrderDetail):
+            for order in (obj.order, _committed_order(obj)):
+                if order is not None and order not in session.new and \
+                        order not in session.deleted:
+                    bumped.add(order)
+    for obj in bumped:
+        obj.bump_version()
+
+
+@event.listens_for(Session, 'before_flush')
+def update_order_totals(session, flush_context, instances):
+    """ Keeps the stored totals of the orders whose detail lines changed
+        by other means than Order.add_product """
+    orders = set()
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, OrderDetail):
+            for order in (obj.order, _committed_order(obj)):
+                if order is not None and order not in session.deleted:
+                    orders.add(order)
+    for order in orders:
+        order.update_totals(removed=session.deleted)
+
+
+def _committed_order(detail):
+    """ Order a detail line belonged to before being moved or deleted """
+    deleted = inspect(detail).attrs.order.history.deleted
+    return deleted[0] if deleted else None
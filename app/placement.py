@@ -0,0 +1,103 @@
+""" Order placement
+
+Creating an order through the ORM loads the product of each detail line
+with its own query and flushes the lines one INSERT at a time.
+`PlacementManager.place` creates it with a fixed number of statements,
+whatever its lines count, in stages:
+
+    - load: the customer, then all the products of the lines in a single
+      query. On PostgreSQL the products rows are locked (SELECT ... FOR
+      UPDATE), in id order so that concurrent placements sharing products
+      don't deadlock, and their price and status can't change until the
+      transaction ends.
+    - validate: the customer exists, every product exists and is ACTIVE.
+    - insert: the order, then all its lines with a single multi-row
+      INSERT, with the totals computed from the loaded prices.
+    - aggregates: these statements bypass the unit of work, so the flush
+      listeners don't see them. New orders are PENDING, which only counts
+      in the products sells and orders status summaries; the sales rollups
+      only count sold orders and follow the later status changes.
+
+The stages durations are added to the request timings, see metrics.py.
+"""
+import datetime
+import decimal
+
+from sqlalchemy import select
+
+from app import db, metrics
+from app.cache import mark_touched
+from app.models import (Customer, Order, OrderDetail, OrderStatusEnum,
+                        Product, ProductStatusEnum, next_version)
+from app.summaries import (OrderStatusSummary, ProductSellsSummary,
+                           SummaryDelta)
+
+
+class PlacementError(Exception):
+    """ The order can't be placed, `errors` are keyed like the request
+        fields: {'customer': [...], 'detail': {line index: {...}}} """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+class PlacementManager:
+    @staticmethod
+    def place(customer_id, lines, session=None):
+        """ Creates a PENDING order of the customer with the `lines`, a
+            list of (product id, quantity), possibly empty, in the session
+            transaction. Returns the order id, raises PlacementError if the
+            customer or a product doesn't exist or a product isn't ACTIVE """
+        session = session or db.session
+        connection = session.connection()
+        with metrics.timer('placement_load'):
+            customer = connection.execute(select([Customer.id]).where(
+                Customer.id == customer_id)).scalar()
+            products = {
+                row.id: row for row in connection.execute(
+                    select([Product.id, Product.price, Product.status])
+                    .where(Product.id.in_({id for id, _ in lines}))
+                    .order_by(Product.id)
+                    .with_for_update())
+            } if lines else {}
+        with metrics.timer('placement_validate'):
+            errors = {}
+            if customer is None:
+                errors['customer'] = ['Not found.']
+            for index, (product_id, _) in enumerate(lines):
+                product = products.get(product_id)
+                if product is None:
+                    message = 'Not found.'
+                elif product.status != ProductStatusEnum.ACTIVE:
+                    message = 'Not available.'
+                else:
+                    continue
+                errors.setdefault('detail', {})[index] = {
+                    'product': [message]}
+            if errors:
+                raise PlacementError(errors)
+        with metrics.timer('placement_insert'):
+            total = sum(((products[id].price or 0) * quantity
+                         for id, quantity in lines), decimal.Decimal(0))
+            order_id = connection.execute(Order.__table__.insert().values(
+                customer_id=customer_id,
+                status=OrderStatusEnum.PENDING,
+                created_at=datetime.datetime.now(),
+                total=total,
+                items_count=sum(quantity for _, quantity in lines),
+                version=next_version(),
+            )).inserted_primary_key[0]
+            if lines:
+                connection.execute(OrderDetail.__table__.insert().values([
+                    {'order_id': order_id, 'product_id': id,
+                     'quantity': quantity, 'unit_price': products[id].price}
+                    for id, quantity in lines]))
+        with metrics.timer('placement_aggregates'):
+            delta = SummaryDelta()
+            delta.add(OrderStatusSummary, OrderStatusEnum.PENDING, 1)
+            for id, quantity in lines:
+                delta.add(ProductSellsSummary, id, quantity)
+            delta.apply(connection)
+            mark_touched(session, Order, OrderDetail)
+        return order_id
@@ -0,0 +1,220 @@
+""" Reference data cache
+
+Countries, categories and tags are small tables that rarely change, yet
+customer and product writes looked them up on every request and their
+dumps joined them. ReferenceCache keeps in each process their rows by id
+and their ids by name, and puts instances built from them in the session
+with merge(load=False), which doesn't query.
+
+Freshness:
+    - updating or deleting rows of these models bumps the model row of the
+      reference_version table, in the same transaction, and drops the
+      local copy once the transaction ends. Other processes compare the
+      reference_version rows with the versions their copies were loaded
+      at, at most every REFERENCE_CACHE_CHECK seconds, and reload the
+      tables that changed. Until then they can dump names and resolve
+      names up to that many seconds old.
+    - ids and names missing from a copy are looked up in the database, and
+      the copy is reloaded if they exist, so rows created by any process
+      are found without bumping versions.
+    - sessions with pending changes to a model don't use its copy, so
+      uncommitted rows are never cached nor shared with other requests.
+"""
+import collections
+import threading
+import time
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from app import db
+from app.models import Category, Country, Tag, next_version
+from app.summaries import upsert_rows
+
+MODELS = (Country, Category, Tag)
+
+Row = collections.namedtuple('Row', ['id', 'name', 'version'])
+Table = collections.namedtuple('Table', ['version', 'rows', 'ids'])
+
+
+class ReferenceVersion(db.Model):
+    """ Version of the rows of each reference model, by table name """
+    __tablename__ = 'reference_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False)
+
+
+def bump_versions(connection, models):
+    """ Records that rows of `models` were updated or deleted """
+    upsert_rows(connection, ReferenceVersion.__table__, ['name'], [
+        {'name': model.__tablename__, 'version': next_version()}
+        for model in sorted(models, key=lambda m: m.__tablename__)])
+
+
+def _columns(model):
+    columns = [model.id, model.name]
+    if 'version' in model.__table__.c:
+        columns.append(model.version)
+    return columns
+
+
+def _row(values):
+    return Row(values[0], values[1], values[2] if len(values) > 2 else None)
+
+
+class ReferenceCache:
+    """ Per process copy of the MODELS rows, see module documentation """
+
+    def __init__(self, check_interval=1, clock=time.monotonic):
+        self.check_interval = check_interval
+        self.clock = clock
+        self._tables = {}
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('REFERENCE_CACHE_CHECK', 1)
+        self.check_interval = app.config['REFERENCE_CACHE_CHECK']
+        app.extensions['reference_cache'] = self
+        app.before_first_request(self.warm)
+
+    def warm(self):
+        """ Loads all the tables """
+        try:
+            for model in MODELS:
+                self.table(model, db.session)
+        except SQLAlchemyError:
+            # Database not migrated yet, tables are loaded on first use
+            db.session.rollback()
+
+    def clear(self, *models):
+        """ Drops the copies of models, all of them by default """
+        with self._lock:
+            for model in models or list(self._tables):
+                self._tables.pop(model, None)
+            if not models:
+                self._checked = None
+
+    def check(self, session):
+        """ Drops the tables changed in the database, at most every
+            check_interval seconds. Returns the versions if they were read """
+        now = self.clock()
+        if self._checked is not None and \
+                now - self._checked < self.check_interval:
+            return None
+        versions = dict(session.execute(select(
+            [ReferenceVersion.name, ReferenceVersion.version])).fetchall())
+        with self._lock:
+            for model, table in list(self._tables.items()):
+                if table.version != versions.get(model.__tablename__):
+                    del self._tables[model]
+            self._checked = now
+        return versions
+
+    def table(self, model, session):
+        """ Copy of the rows of model, None if the session has pending
+            changes to them """
+        if model in session.info.get('reference_changes', ()):
+            return None
+        versions = self.check(session)
+        table = self._tables.get(model)
+        if table is None:
+            if versions is None:
+                self._checked = None
+                versions = self.check(session)
+            rows = {row.id: row for row in map(
+                _row, session.execute(select(_columns(model))))}
+            table = Table(versions.get(model.__tablename__), rows,
+                          {row.name: row.id for row in rows.values()})
+            with self._lock:
+                self._tables[model] = table
+        return table
+
+    def rows(self, model, session, ids=(), names=()):
+        """ {id: Row} and {name: Row} of the existing ids and names """
+        table = self.table(model, session)
+        by_id, by_name = {}, {}
+        if table is not None:
+            by_id = {id: table.rows[id] for id in ids if id in table.rows}
+            by_name = {name: table.rows[table.ids[name]] for name in names
+                       if name in table.ids}
+        missing_ids = set(ids) - set(by_id)
+        missing_names = set(names) - set(by_name)
+        if missing_ids or missing_names:
+            where = []
+            if missing_ids:
+                where.append(model.id.in_(missing_ids))
+            if missing_names:
+                where.append(model.name.in_(missing_names))
+            found = list(map(_row, session.execute(
+                select(_columns(model)).where(db.or_(*where)))))
+            if found and table is not None:
+                # Created since the copy was loaded
+                self.clear(model)
+            for row in found:
+                by_id[row.id] = row
+                by_name[row.name] = row
+        return by_id, by_name
+
+    def row(self, model, id, session=None):
+        """ Row of the id, None if it doesn't exist """
+        return self.rows(model, session or db.session, ids=[id])[0].get(id)
+
+    def get(self, model, id, session=None):
+        """ Instance of the id in the session, None if it doesn't exist """
+        session = session or db.session
+        row = self.row(model, id, session)
+        return None if row is None else self.instance(model, row, session)
+
+    def find(self, model, names, session=None):
+        """ {name: instance in the session} of the existing names """
+        session = session or db.session
+        _, rows = self.rows(model, session, names=names)
+        return {name: self.instance(model, row, session)
+                for name, row in rows.items() if name in names}
+
+    def instance(self, model, row, session):
+        """ Session instance of a row, built without querying """
+        found = session.identity_map.get(identity_key(model, row.id))
+        if found is not None:
+            return found
+        o = model(id=row.id, name=row.name)
+        if row.version is not None:
+            o.version = row.version
+        make_transient_to_detached(o)
+        return session.merge(o, load=False)
+
+
+references = ReferenceCache()
+
+
+def mark_changed(session, models):
+    """ Stops using the copies of models in the session until its
+        transaction ends """
+    session.info.setdefault('reference_changes', set()).update(models)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_reference_changes(session, flush_context):
+    # Collection changes (ex: the products of a tag) don't count
+    modified = {type(o) for o in session.deleted if type(o) in MODELS} | {
+        type(o) for o in session.dirty if type(o) in MODELS and
+        inspect(o).attrs.name.history.has_changes()}
+    changed = modified | {type(o) for o in session.new if type(o) in MODELS}
+    if modified:
+        bump_versions(session.connection(), modified)
+        session.info.setdefault('reference_modified', set()).update(
+            modified)
+    if changed:
+        mark_changed(session, changed)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_reference_changes(session, *args):
+    session.info.pop('reference_changes', None)
+    modified = session.info.pop('reference_modified', None)
+    if modified:
+        references.clear(*modified)
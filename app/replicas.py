@@ -0,0 +1,121 @@
+""" Read replicas routing
+
+Requests with a read only method run their queries on one of the
+SQLALCHEMY_REPLICA_URIS databases, chosen round robin, writes and every
+other request use the primary database. A replica that fails to connect
+is skipped for REPLICA_RETRY_AFTER seconds, reads fall back to the primary
+when no replica is available.
+
+Replicas lag behind the primary. After a successful write a client reads
+from the primary during REPLICA_STICKY_SECONDS, tracked with a cookie, so
+it sees its own writes.
+
+The replica is used until the session transaction ends, which the request
+teardown does: sessions can outlive a request (CLI commands, app context
+pushed by the caller) and their next transactions use the primary.
+"""
+import itertools
+import threading
+import time
+
+from flask import request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, exc
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaRouter:
+    """ Round robin over the replica engines, skipping failed ones """
+
+    def __init__(self, engines, retry_after=30, clock=time.monotonic):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self.clock = clock
+        self._failed = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def candidates(self):
+        """ Healthy replicas, starting from the next one in turn """
+        if not self.engines:
+            return []
+        with self._lock:
+            start = next(self._counter) % len(self.engines)
+        now = self.clock()
+        engines = self.engines[start:] + self.engines[:start]
+        return [e for e in engines if self._failed.get(e, now) <= now]
+
+    def mark_failed(self, engine):
+        self._failed[engine] = self.clock() + self.retry_after
+
+    def is_healthy(self, engine):
+        return self._failed.get(engine, 0) <= self.clock()
+
+    def reset_pools(self):
+        for engine in self.engines:
+            engine.pool = engine.pool.recreate()
+
+
+class RoutingSession(SignallingSession):
+    """ Session reading from `replica` when one is set, flushes always go
+        to the primary """
+
+    def __init__(self, db, **options):
+        self.replica = None
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.replica is not None and not self._flushing:
+            return self.replica
+        return super().get_bind(mapper, clause)
+
+    def use_replica(self, router):
+        """ Connects to the first healthy replica and reads from it.
+            Returns the replica engine or None if all of them failed """
+        for engine in router.candidates():
+            try:
+                self.connection(bind=engine)
+            except exc.DBAPIError:
+                router.mark_failed(engine)
+                continue
+            self.replica = engine
+            return engine
+        return None
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _forget_replica(session, transaction):
+    if transaction.parent is None:
+        session.replica = None
+
+
+def init_routing(app, db, router):
+    """ Registers the request hooks routing reads to the replicas """
+    cookie = app.config['REPLICA_STICKY_COOKIE']
+    sticky = app.config['REPLICA_STICKY_SECONDS']
+
+    def wrote_recently():
+        try:
+            return float(request.cookies.get(cookie, 0)) > time.time()
+        except ValueError:
+            return False
+
+    @app.before_request
+    def route_reads():
+        if request.method in READ_METHODS and not wrote_recently():
+            db.session().use_replica(router)
+
+    @app.teardown_request
+    def end_replica_reads(exception):
+        session = db.session()
+        if session.replica is not None:
+            session.rollback()
+
+    @app.after_request
+    def stick_to_primary(response):
+        if (sticky and request.method not in READ_METHODS
+                and response.status_code < 400):
+            response.set_cookie(cookie, '%.3f' % (time.time() + sticky),
+                                max_age=sticky, httponly=True)
+        return response
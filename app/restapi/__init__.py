@@ -4,32 +4,46 @@ from marshmallow.exceptions import ValidationError
 from .blueprint import api
 from .cruds import (CategoriesView, CountriesView, CustomersView, OrdersView,
                     ProductsView)
-from . import statistics    # noqa: F401
+from . import search, statistics    # noqa: F401
 
 
 def register_crud_view(view_class, plural, list_methods=['GET', 'POST'],
-                       record_methods=['GET', 'PUT', 'DELETE']):
+                       record_methods=['GET', 'PUT', 'DELETE'], bulk=False):
     """ Register routes endpoints for a CRUD
         /plural
         /plural/<int:id>
+        /plural/export (along with the list GET)
+        /plural/bulk (only POST, when bulk is True)
 
         Allowed methods can be configured using list_methods and record_methods
+
+        The list filters and sort keys are checked here, so that lists
+        sorted without index fail at startup rather than on first request
     """
+    if 'GET' in list_methods:
+        view_class().list_spec()
     view = view_class.as_view(plural)
     if 'GET' in list_methods:
         api.add_url_rule('/%s' % plural, defaults={'id': None},
                          view_func=view, methods=['GET', ])
+        api.add_url_rule('/%s/export' % plural,
+                         defaults={'id': None, 'export': True},
+                         view_func=view, methods=['GET', ])
     api.add_url_rule('/%s/<int:id>' % plural, view_func=view,
                      methods=record_methods)
     if 'POST' in list_methods:
         api.add_url_rule('/%s' % plural, view_func=view, methods=['POST', ])
+    if bulk:
+        api.add_url_rule('/%s/bulk' % plural, defaults={'bulk': True},
+                         view_func=view, methods=['POST', ])
 
 
 register_crud_view(CategoriesView, 'categories')
 register_crud_view(CountriesView, 'countries')
-register_crud_view(CustomersView, 'customers')
-register_crud_view(ProductsView, 'products')
-register_crud_view(OrdersView, 'orders', record_methods=['GET', 'PUT'])
+register_crud_view(CustomersView, 'customers', bulk=True)
+register_crud_view(ProductsView, 'products', bulk=True)
+register_crud_view(OrdersView, 'orders', record_methods=['GET', 'PUT'],
+                   bulk=True)
 
 
 @api.errorhandler(ValidationError)
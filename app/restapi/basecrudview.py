@@ -1,8 +1,202 @@
+import hashlib
+import json
+import operator
+
 from flask.views import MethodView
-from flask import jsonify, request
-from .schemas import ListArgsSchema
+from flask import current_app, g, jsonify, request, stream_with_context
+from marshmallow.exceptions import ValidationError
+from werkzeug.http import quote_etag
+from werkzeug.urls import url_encode
+from .compiled import compiled_dump
+from .export import FORMATS
+from .filtering import ListSpec, table_column, value_field
+from .schemas import Cursor, ExportArgsSchema, encode_cursor
+from sqlalchemy import and_, cast, func, inspect, or_, orm
 from sqlalchemy.exc import IntegrityError
-from app import db
+from sqlalchemy.ext.associationproxy import AssociationProxy
+from app import db, metrics
+from app.idempotency import IdempotencyManager, MAX_KEY_LENGTH, request_hash
+from app.models import NameResolver
+
+
+def loading_options(model, plan):
+    """ Translates a loading plan into query loader options.
+        A plan maps schema field paths to loader strategies, ex:
+        {'category': 'joinedload', 'tags': 'selectinload'}
+        Association proxies are followed to the relationship they proxy """
+    options = []
+    for path, strategy in plan.items():
+        entity, attrs = model, []
+        for name in path.split('.'):
+            attr = getattr(entity, name)
+            if isinstance(attr, AssociationProxy):
+                attr = getattr(entity, attr.target_collection)
+            attrs.append(attr)
+            entity = attr.property.mapper.class_
+        option = getattr(orm, 'defaultload' if len(attrs) > 1 else strategy)(
+            attrs[0])
+        for i, attr in enumerate(attrs[1:], 2):
+            option = getattr(
+                option, 'defaultload' if i < len(attrs) else strategy)(attr)
+        options.append(option)
+    return options
+
+
+def keyset_after(keys, values, descending=False):
+    """ Builds the predicate selecting the rows that come after `values` when
+        ordering by `keys`: (k1, k2) > (v1, v2) expanded as
+        k1 > v1 OR (k1 = v1 AND k2 > v2), which every backend can use as an
+        index range condition. Descending orders use < instead """
+    after = operator.lt if descending else operator.gt
+    if len(keys) == 1:
+        return after(keys[0], values[0])
+    return or_(after(keys[0], values[0]),
+               and_(keys[0] == values[0],
+                    keyset_after(keys[1:], values[1:], descending)))
+
+
+# Row hashes are polynomial hashes of the versions query columns modulo a
+# prime, computed with 64 bits integers in SQL
+ROW_HASH_MODULUS = 2147483647
+ROW_HASH_BASE = 1000003
+
+
+def _etag(summary):
+    return hashlib.sha1(':'.join(map(str, summary)).encode()).hexdigest()
+
+
+def _row_hash(columns, coalesce=lambda c: func.coalesce(c, 0)):
+    """ Hash of a versions query row, SQL expression of its columns or
+        Python value of its values """
+    value = columns[0] % ROW_HASH_MODULUS
+    for column in columns[1:]:
+        value = (value * ROW_HASH_BASE + coalesce(column)) % ROW_HASH_MODULUS
+    return value
+
+
+def versions_etag(session, query):
+    """ Summarizes the rows of a versions query, (primary key, versions...),
+        as (rows count, strong ETag) from the count and sum of their hashes.
+        Versions are timestamps, a row can be updated to a version lower
+        than others: every row counts, not only the greatest versions, so
+        adding, removing or modifying any of the rows changes the ETag """
+    columns = list(query.subquery(with_labels=True).c)
+    row = session.query(func.count(), func.coalesce(func.sum(_row_hash(
+        [cast(columns[0], db.BigInteger)] + columns[1:])), 0)).one()
+    return row[0], _etag(row)
+
+
+def rows_etag(rows):
+    """ versions_etag of rows already loaded, tuples of the versions query
+        columns """
+    summary = (len(rows), sum(_row_hash(row, lambda v: v or 0)
+                              for row in rows))
+    return summary[0], _etag(summary)
+
+
+def not_modified(etag):
+    """ 304 response if the client copy is the `etag` version """
+    if etag not in request.if_none_match:
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def next_page_url(**pagination):
+    """ URL of the next page of the current list request, keeping its
+        filters and sort """
+    args = [(name, value) for name, value in request.args.items(multi=True)
+            if name not in ('offset', 'after', 'limit')]
+    return '%s?%s' % (request.base_url,
+                      url_encode(list(pagination.items()) + args))
+
+
+def item_values(items, path):
+    """ Values found at a dotted `path` of the items, lists are walked """
+    values = items
+    for name in path.split('.'):
+        found = []
+        for value in values:
+            value = value.get(name) if isinstance(value, dict) else None
+            found.extend(value if isinstance(value, list) else [value])
+        values = found
+    return [v for v in values if v is not None]
+
+
+def parse_bulk_items():
+    """ Bulk request items, sent as a JSON array or as NDJSON. Returns
+        (items, error response) """
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        lines = request.get_data(as_text=True).splitlines()
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                return None, (jsonify({
+                    'status': 400,
+                    'message': 'Invalid JSON in line %d' % number}), 400)
+    else:
+        items = request.get_json()
+    if not isinstance(items, list) or not items:
+        return None, (jsonify({'status': 400,
+                               'message': 'No input data provided'}), 400)
+    if len(items) > current_app.config['BULK_MAX_ITEMS']:
+        return None, (jsonify({
+            'status': 413,
+            'message': 'At most %d items can be created at once' %
+            current_app.config['BULK_MAX_ITEMS']}), 413)
+    return items, None
+
+
+def idempotent(key, post):
+    """ Response of post(), called once for all the requests with the same
+        Idempotency-Key, see idempotency.py """
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return jsonify({'status': 400,
+                        'message': 'Invalid Idempotency-Key'}), 400
+    hash = request_hash(request.method, request.path, request.get_data())
+    record = IdempotencyManager.find(key)
+    if record is None:
+        if IdempotencyManager.reserve(key, hash, current_app.config[
+                'IDEMPOTENCY_RESERVATION_TIMEOUT']):
+            # The response is stored by CrudView._commit_created
+            g.idempotency_key = key
+            try:
+                resp = current_app.make_response(post())
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                # g outlives the request when the app context was pushed
+                # before it
+                g.pop('idempotency_key')
+            if resp.status_code >= 300:
+                # Failed attempts can be retried
+                db.session.rollback()
+            return resp
+        # A concurrent request with the same key committed first
+        record = IdempotencyManager.find(key)
+    if record is not None and record.request_hash != hash:
+        return jsonify({
+            'status': 409,
+            'message': 'Idempotency-Key used by another request'}), 409
+    if record is None or record.status is None:
+        return jsonify({
+            'status': 409,
+            'message': 'A request with this Idempotency-Key is in progress'
+        }), 409
+    resp = current_app.response_class(record.response, status=record.status,
+                                      mimetype='application/json')
+    resp.headers['Idempotent-Replayed'] = 'true'
+    return resp
+
+
+# ListSpec of each view Meta
+_list_specs = {}
 
 
 class CrudView(MethodView):
@@ -12,36 +206,267 @@ class CrudView(MethodView):
         list_schema = None
         post_schema = None
         put_schema = None
+        # Model attribute name used to sort keyset (?after=) pages, the
+        # primary key is used as tie breaker. None means primary key only
+        cursor_column = None
+        # Loading plans applied by list and get, see loading_options
+        list_loading_plan = {}
+        get_loading_plan = {}
+        # Projection listing records instead of model instances, see
+        # projection.py. It must include the cursor columns
+        list_projection = None
+        # Dump records with functions generated from the schemas instead of
+        # marshmallow, see compiled.py
+        compiled_dump = False
+        # Bulk creation: item field path -> model of the records it
+        # references by id, fetched with one IN query per field
+        bulk_references = {}
+        # Bulk creation: item field -> model resolved by name, see
+        # NameResolver
+        bulk_names = {}
+        # List filters, query argument -> filtering.Filter, and sort keys,
+        # ?sort= value -> model attribute, see filtering.py
+        filters = {}
+        sorts = {}
+        # Collections small enough to be sorted without index
+        small_collection = False
 
     def __new__(cls, *args, **kwargs):
         o = super().__new__(cls)
         o._meta = getattr(o, 'Meta')
         return o
 
+    def _option(self, name):
+        """ Optional Meta attribute, defaults to the CrudView.Meta value """
+        return getattr(self._meta, name, getattr(CrudView.Meta, name))
+
+    def dumper(self, schema_class):
+        """ Function dumping one record with a Meta schema """
+        if self._option('compiled_dump'):
+            return compiled_dump(schema_class)
+        return schema_class().dump
+
+    def dump_list(self, rows):
+        dump = self.dumper(self._meta.list_schema)
+        return jsonify([dump(row) for row in rows])
+
+    def list_spec(self):
+        """ Filters and sort keys of the list, built and checked once per
+            view by register_crud_view, see filtering.py """
+        spec = _list_specs.get(self._meta)
+        if spec is None:
+            spec = _list_specs[self._meta] = ListSpec(
+                self._meta.model, self._option('filters'),
+                self._option('sorts'), self._option('small_collection'))
+        return spec
+
     def list(self):
-        args_cleaned = ListArgsSchema().load(request.args)
+        args_cleaned = self.list_spec().load(request.args)
         limit = args_cleaned.get('limit')
+        if 'after' in args_cleaned:
+            return self.list_after(args_cleaned['after'], limit,
+                                   args_cleaned)
         offset = args_cleaned.get('offset')
-        result = self.list_query(db.session, limit, offset)
-        return (self._meta.list_schema(many=True).jsonify(result),
+        response = self.precondition(lambda query: self.paginate(
+            query, limit, offset=offset, args=args_cleaned))
+        if response is not None:
+            return response
+        result = self.prepare_rows(db.session, self.list_query(
+            db.session, limit, offset, args_cleaned).all())
+        etag = self.records_etag(result)
+        with metrics.timer('serialization'):
+            body = self.dump_list(result)
+        return (body,
+                200,
+                {'x-next': next_page_url(offset=offset + limit, limit=limit),
+                 'ETag': quote_etag(etag)})
+
+    def list_after(self, after, limit, args=None):
+        """ Keyset pagination: return the `limit` rows following the cursor
+            `after`. Unlike offset pagination every page costs the same, no
+            matter how deep it is """
+        keys = self.cursor_columns(args)
+        if after:
+            try:
+                after = Cursor().load_values(after, [
+                    value_field(table_column(key)) for key in keys])
+            except ValidationError as e:
+                raise ValidationError(e.messages, 'after')
+        response = self.precondition(lambda query: self.paginate(
+            query, limit, after=after, args=args))
+        if response is not None:
+            return response
+        result = self.prepare_rows(db.session, self.keyset_query(
+            db.session, keys, after, limit, args).all())
+        headers = {'ETag': quote_etag(self.records_etag(result))}
+        if len(result) == limit:
+            headers['x-next'] = next_page_url(
+                after=encode_cursor(self.cursor_values(result[-1], args)),
+                limit=limit)
+        with metrics.timer('serialization'):
+            body = self.dump_list(result)
+        return (body,
                 200,
-                {'x-next': "{:s}?offset={:d}&limit={:d}".format(
-                    request.base_url,
-                    offset+limit, limit)})
+                headers)
+
+    def cursor_columns(self, args=None):
+        """ Columns defining the rows order for pagination, the ?sort= key
+            of the list arguments if any """
+        model = self._meta.model
+        keys = [getattr(model, c.key) for c in inspect(model).primary_key]
+        column, _ = self.list_spec().sort(args or {})
+        if column is None:
+            column = self._option('cursor_column')
+            column = column and getattr(model, column)
+        if column is None:
+            return keys
+        return [column] + [k for k in keys if k.key != column.key]
+
+    def cursor_values(self, row, args=None):
+        """ Values of the cursor columns for a row returned by list queries """
+        return [getattr(row, key.key) for key in self.cursor_columns(args)]
+
+    def collection_query(self, session):
+        """ Query returning all the rows listed by this view """
+        projection = self._option('list_projection')
+        if projection is not None:
+            return projection.query(session)
+        return self._meta.model.query
+
+    def prepare_rows(self, session, rows):
+        """ Turns a page of collection_query rows into the objects dumped
+            by list_schema """
+        projection = self._option('list_projection')
+        if projection is not None:
+            return projection.records(session, rows)
+        return rows
+
+    def list_options(self):
+        if self._option('list_projection') is not None:
+            return []
+        return loading_options(self._meta.model,
+                               self._option('list_loading_plan'))
 
-    def list_query(self, session, limit, offset):
-        return self._meta.model.query.limit(limit).offset(offset)
+    def paginate(self, query, limit, offset=0, after=None, args=None):
+        """ Restricts a query over the listed rows to one page, filtered
+            and sorted by the list arguments """
+        spec = self.list_spec()
+        keys = self.cursor_columns(args)
+        _, descending = spec.sort(args or {})
+        criteria = spec.criteria(args or {})
+        if after:
+            criteria.append(keyset_after(keys, after, descending))
+        if criteria:
+            query = query.filter(*criteria)
+        if descending:
+            keys = [key.desc() for key in keys]
+        query = query.order_by(*keys).limit(limit)
+        return query.offset(offset) if offset else query
+
+    def list_query(self, session, limit, offset, args=None):
+        return self.paginate(
+            self.collection_query(session).options(*self.list_options()),
+            limit, offset=offset, args=args)
+
+    def keyset_query(self, session, keys, after, limit, args=None):
+        return self.paginate(
+            self.collection_query(session).options(*self.list_options()),
+            limit, after=after, args=args)
+
+    def versions_query(self, session):
+        """ Query returning the primary key and the versions of all the rows
+            a record representation depends on, one row per record. It
+            must accept the same filters and ordering as collection_query """
+        model = self._meta.model
+        return session.query(*(
+            [getattr(model, c.key) for c in inspect(model).primary_key] +
+            [model.version]))
+
+    def record_versions(self, record):
+        """ Row of versions_query of a record loaded by get_object or
+            list_query, from its attributes """
+        model = self._meta.model
+        return tuple(getattr(record, c.key) for c in
+                     inspect(model).primary_key) + (record.version,)
+
+    def records_etag(self, records):
+        """ ETag of loaded records, the one versions_etag computes for
+            their versions query. Embedded reference records are dumped
+            from the reference data cache, which can be behind the
+            database: their versions are the cached ones, so that the ETag
+            never claims a fresher representation than the one sent. It
+            must be computed before dumping, the cache can be reloaded in
+            between """
+        return rows_etag([self.record_versions(r) for r in records])[1]
+
+    def precondition(self, restrict):
+        """ 304 response if the request is conditional and the client copy
+            is current, computed with the versions query of the requested
+            rows, restrict(query) selecting them. Other requests don't pay
+            for it, responses get the records_etag of the rows they load """
+        if not request.if_none_match:
+            return None
+        _, etag = versions_etag(db.session, restrict(
+            self.versions_query(db.session)))
+        return not_modified(etag)
 
-    def get(self, id):
+    def export(self):
+        """ Streams the whole collection as NDJSON or CSV. Rows are fetched
+            in keyset batches of EXPORT_BATCH_SIZE, so memory use doesn't
+            depend on the collection size and every batch costs the same """
+        lines, mimetype = FORMATS[ExportArgsSchema().load(
+            request.args)['format']]
+        batch_size = current_app.config['EXPORT_BATCH_SIZE']
+        dump = self.dumper(self._meta.list_schema)
+        keys = self.cursor_columns()
+
+        def records():
+            after = []
+            while True:
+                batch = self.prepare_rows(db.session, self.keyset_query(
+                    db.session, keys, after, batch_size).all())
+                for row in batch:
+                    yield dump(row)
+                if len(batch) < batch_size:
+                    return
+                after = self.cursor_values(batch[-1])
+
+        return current_app.response_class(
+            stream_with_context(lines(records(), self._meta.list_schema)),
+            mimetype=mimetype)
+
+    def get(self, id, export=False):
+        if export:
+            return self.export()
         if id is None:
             return self.list()
-        o = self._meta.model.query.get(id)
+        model = self._meta.model
+        response = self.precondition(lambda query: query.filter(
+            inspect(model).primary_key[0] == id))
+        if response is not None:
+            return response
+        o = self.get_object(db.session, id)
         if o is None:
             return jsonify(dict(status=404, message='Not found')), 404
-        return self._meta.get_schema().jsonify(o)
+        etag = self.records_etag([o])
+        with metrics.timer('serialization'):
+            response = jsonify(self.dumper(self._meta.get_schema)(o))
+        response.set_etag(etag)
+        return response
 
-    def _try_commit(self):
+    def get_object(self, session, id):
+        """ Fetch the record dumped by get, None if it doesn't exist """
+        return self._meta.model.query.options(*loading_options(
+            self._meta.model, self._option('get_loading_plan'))).get(id)
+
+    def _try_commit(self, before_commit=None):
+        """ Commits the session, returns an error response if it fails.
+            before_commit is called once the changes are flushed, while the
+            objects are not expired by the commit yet """
         try:
+            if before_commit is not None:
+                db.session.flush()
+                before_commit()
             db.session.commit()
             return None
         except IntegrityError as e:
@@ -51,15 +476,96 @@ class CrudView(MethodView):
             db.session.rollback()
             return jsonify({'status': 400, 'message': 'DB write error'}), 400
 
-    def post(self):
+    def _commit_created(self, ids):
+        """ Commits the creation of records and returns the 201 response
+            of ids(), called once they are flushed. The response of a
+            request with an Idempotency-Key is stored in the same
+            transaction, see idempotent """
+        created = []
+
+        def before_commit():
+            created.append(jsonify(ids()))
+            key = g.get('idempotency_key')
+            if key is not None:
+                IdempotencyManager.store(
+                    key, 201, created[0].get_data(as_text=True),
+                    current_app.config['IDEMPOTENCY_KEY_TTL'])
+        resp = self._try_commit(before_commit)
+        if resp is not None:
+            return resp
+        created[0].status_code = 201
+        return created[0]
+
+    def post(self, bulk=False):
+        key = request.headers.get('Idempotency-Key')
+        if key is not None:
+            return idempotent(key, lambda: self._post(bulk))
+        return self._post(bulk)
+
+    def _post(self, bulk):
+        if bulk:
+            return self.bulk_post()
         json_data = request.get_json()
         if not json_data:
             return jsonify({'status': 400,
                             'message': 'No input data provided'}), 400
-        o = self._meta.post_schema().load(json_data)
+        return self.create(json_data)
+
+    def create(self, data):
+        """ Creates the record of a POST body, returns the response """
+        o = self._meta.post_schema().load(data)
         db.session.add(o)
-        resp = self._try_commit()
-        return resp if resp is not None else (jsonify(o.id), 201)
+        return self._commit_created(lambda: o.id)
+
+    def bulk_post(self):
+        """ Creates many records in a single transaction. Either all the
+            items are valid and created, or none is and the errors of each
+            invalid item are returned """
+        items, resp = parse_bulk_items()
+        if resp is not None:
+            return resp
+        ids, errors = self.bulk_create(items)
+        if errors:
+            db.session.rollback()
+            return jsonify({'status': 422, 'message': 'Invalid items',
+                            'errors': errors}), 422
+        return self._commit_created(ids)
+
+    def bulk_create(self, items):
+        """ Adds the records of the bulk items to the session. Returns
+            (ids, errors): ids() gives the created ids once flushed, errors
+            the {'index', 'errors'} of the invalid items """
+        schema = self._meta.post_schema()
+        schema.context.update(self.bulk_prefetch(db.session, items))
+        objects, errors = [], []
+        with db.session.no_autoflush:
+            for index, item in enumerate(items):
+                try:
+                    objects.append(schema.load(item))
+                except ValidationError as e:
+                    errors.append({'index': index, 'errors': e.messages})
+        if not errors:
+            db.session.add_all(objects)
+        return (lambda: [o.id for o in objects]), errors
+
+    def bulk_prefetch(self, session, items):
+        """ Loads the records the items reference with one query per kind,
+            so loading each item finds them in the session identity map
+            instead of querying. Returns the schema context: the name
+            resolvers and the prefetched records, kept there so they stay
+            in the identity map during the loads """
+        prefetched = []
+        for path, model in self._option('bulk_references').items():
+            ids = {v for v in item_values(items, path) if isinstance(v, int)}
+            if ids:
+                prefetched.extend(
+                    session.query(model).filter(model.id.in_(ids)))
+        resolvers = {}
+        for path, model in self._option('bulk_names').items():
+            resolvers[model] = NameResolver(model)
+            resolvers[model].prefetch(
+                {v for v in item_values(items, path) if isinstance(v, str)})
+        return {'resolvers': resolvers, 'prefetched': prefetched}
 
     def delete(self, id):
         o = self._meta.model.query.get(id)
@@ -0,0 +1,96 @@
+""" Compiled serializers
+
+marshmallow dumps every field of every record through several generic
+calls: accessor lookup, default handling, error bookkeeping and the field
+formatting. `compiled_dump` generates, once per schema, a function doing
+only the work the schema fields need and returning the same data as
+`schema.dump(obj)`.
+
+Nested schemas are compiled too, and common field types are inlined.
+Other fields still use their own formatting, so the output doesn't
+change. Schemas with pre/post dump processors and mappings (instead of
+objects) are delegated to marshmallow.
+"""
+import functools
+from collections.abc import Mapping
+
+from marshmallow import Schema, fields, missing
+from marshmallow.decorators import POST_DUMP, PRE_DUMP
+
+
+def _value_code(field, ref, name, namespace):
+    """ Expression formatting `value`, the attribute of `obj` dumped by
+        `field` (available as `ref`) """
+    if isinstance(field, fields.Nested) and not isinstance(field.only, str):
+        dump = ref + '_dump'
+        namespace[dump] = compile_schema(field.schema)
+        if field.many:
+            return 'None if value is None else [%s(v) for v in value]' % dump
+        return 'None if value is None else %s(value)' % dump
+    if type(field) is fields.Integer and not field.as_string:
+        return 'None if value is None else int(value)'
+    if type(field) is fields.String:
+        return ('value if value is None or type(value) is str '
+                'else %s._serialize(value, %r, obj)' % (ref, name))
+    return '%s._serialize(value, %r, obj)' % (ref, name)
+
+
+def compile_schema(schema):
+    """ Returns a function dumping one object like schema.dump(obj) """
+    if schema._has_processors(PRE_DUMP) or schema._has_processors(POST_DUMP):
+        return functools.partial(schema.dump, many=False)
+    namespace = {
+        'Mapping': Mapping,
+        'missing': missing,
+        'schema': schema,
+        'get_attribute': schema.get_attribute,
+    }
+    custom_getter = type(schema).get_attribute is not Schema.get_attribute
+    lines = [
+        'def dump(obj):',
+        '    if isinstance(obj, Mapping):',
+        '        return schema.dump(obj, many=False)',
+        '    result = {}',
+    ]
+    for i, (name, field) in enumerate(schema.fields.items()):
+        if field.load_only:
+            continue
+        ref = 'field_%d' % i
+        namespace[ref] = field
+        key = (schema.prefix or '') + (field.data_key or name)
+        if not field._CHECK_ATTRIBUTE:
+            lines += [
+                '    value = %s._serialize(None, %r, obj)' % (ref, name),
+                '    if value is not missing:',
+                '        result[%r] = value' % key,
+            ]
+            continue
+        attr = field.attribute or name
+        if custom_getter or '.' in attr:
+            lines.append('    value = get_attribute(obj, %r, missing)' % attr)
+        else:
+            lines.append('    value = getattr(obj, %r, missing)' % attr)
+        lines += [
+            '    if value is missing:',
+            # Defaults and missing values take the marshmallow path
+            '        value = %s.serialize(%r, obj, get_attribute)' % (
+                ref, name),
+            '        if value is not missing:',
+            '            result[%r] = value' % key,
+            '    else:',
+            '        result[%r] = %s' % (
+                key, _value_code(field, ref, name, namespace)),
+        ]
+    lines.append('    return result')
+    source = '\n'.join(lines)
+    exec(compile(source, '<compiled %s>' % type(schema).__name__, 'exec'),
+         namespace)
+    dump = namespace['dump']
+    dump.source = source
+    return dump
+
+
+@functools.lru_cache(maxsize=None)
+def compiled_dump(schema_class):
+    """ Compiled dump function of a schema class, built once """
+    return compile_schema(schema_class())
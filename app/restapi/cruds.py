@@ -1,17 +1,57 @@
-from app.models import Category, Country, Customer, Order, Product
+import collections
+
+from marshmallow.exceptions import ValidationError
+
+from app import db
+from app.models import (Category, Country, Customer, Order, OrderDetail,
+                        Product, ProductTag, Tag)
+from app.placement import PlacementError, PlacementManager
+from app.reference import references
+from sqlalchemy import func, select
+from sqlalchemy.orm import contains_eager
 
 from .basecrudview import CrudView
+from .filtering import Filter
+from .projection import Projection
 from .schemas import (CategorySchema, CountrySchema, CustomerDeserializeSchema,
-                      CustomerSchema, OrderCreateSchema, OrderSchema,
-                      OrdersListSchema, OrderUpdateSchema,
+                      CustomerSchema, OrderPlacementSchema,
+                      OrderSchema, OrdersListSchema, OrderUpdateSchema,
                       ProductDeserializeSchema, ProductSchema)
 
 
+def product_tags(session, ids):
+    """ Tag names of the products, by product id """
+    tags = collections.defaultdict(list)
+    rows = (
+        session.query(ProductTag.product_id, Tag.name)
+        .join(Tag, Tag.id == ProductTag.tag_id)
+        .filter(ProductTag.product_id.in_(ids))
+        .order_by(ProductTag.product_id, Tag.id)
+    )
+    for product_id, name in rows:
+        tags[product_id].append(name)
+    return tags
+
+
+def products_version():
+    """ Greatest version of the products of each order, correlated to the
+        order of the enclosing query """
+    return (
+        select([func.max(Product.version)])
+        .select_from(OrderDetail.__table__.join(Product.__table__))
+        .where(OrderDetail.order_id == Order.id)
+        .correlate(Order)
+        .as_scalar()
+    )
+
+
 class CategoriesView(CrudView):
     class Meta:
         model = Category
         get_schema = CategorySchema
         list_schema = CategorySchema
+        filters = {'name': Filter(Category.name)}
+        sorts = {'id': Category.id, 'name': Category.name}
 
         def post_schema(): return CategorySchema(exclude=('id',))
 
@@ -23,6 +63,8 @@ class CountriesView(CrudView):
         model = Country
         get_schema = CountrySchema
         list_schema = CountrySchema
+        filters = {'name': Filter(Country.name)}
+        sorts = {'id': Country.id, 'name': Country.name}
 
         def post_schema(): return CountrySchema(exclude=('id',))
 
@@ -36,6 +78,30 @@ class CustomersView(CrudView):
         list_schema = CustomerSchema
         post_schema = CustomerDeserializeSchema
         put_schema = CustomerDeserializeSchema
+        # Countries are dumped from the reference data cache
+        list_projection = Projection(Customer, {
+            'id': Customer.id,
+            'email': Customer.email,
+            'firstname': Customer.firstname,
+            'lastname': Customer.lastname,
+            'country_id': Customer.country_id,
+            'version': Customer.version,
+        })
+        compiled_dump = True
+        filters = {
+            'country': Filter(Customer.country_id, ('eq', 'in')),
+            'email': Filter(Customer.email),
+        }
+        sorts = {'id': Customer.id, 'email': Customer.email}
+
+    def versions_query(self, session):
+        return (super().versions_query(session)
+                .join(Customer.country).add_columns(Country.version))
+
+    def record_versions(self, record):
+        # The version of the cached country the dump used
+        return super().record_versions(record) + (
+            references.row(Country, record.country_id).version,)
 
 
 class ProductsView(CrudView):
@@ -45,6 +111,35 @@ class ProductsView(CrudView):
         list_schema = ProductSchema
         post_schema = ProductDeserializeSchema
         put_schema = ProductDeserializeSchema
+        # Categories are dumped from the reference data cache
+        get_loading_plan = {'tags': 'selectinload'}
+        list_projection = Projection(Product, {
+            'id': Product.id,
+            'name': Product.name,
+            'description': Product.description,
+            'price': Product.price,
+            'status': Product.status,
+            'category_id': Product.category_id,
+            'version': Product.version,
+        }, collections={'tags': product_tags})
+        bulk_names = {'tags': Tag}
+        compiled_dump = True
+        filters = {
+            'category': Filter(Product.category_id, ('eq', 'in')),
+            'tag': Filter(ProductTag.tag_id, ('eq', 'in'),
+                          via=ProductTag.product_id),
+            'status': Filter(Product.status, ('eq', 'in')),
+        }
+        sorts = {'id': Product.id, 'name': Product.name}
+
+    def versions_query(self, session):
+        return (super().versions_query(session)
+                .join(Product.category).add_columns(Category.version))
+
+    def record_versions(self, record):
+        # The version of the cached category the dump used
+        return super().record_versions(record) + (
+            references.row(Category, record.category_id).version,)
 
 
 class OrdersView(CrudView):
@@ -52,8 +147,90 @@ class OrdersView(CrudView):
         model = Order
         get_schema = OrderSchema
         list_schema = OrdersListSchema
-        post_schema = OrderCreateSchema
+        post_schema = OrderPlacementSchema
         put_schema = OrderUpdateSchema
-
-    def list_query(self, session, limit, offset):
-        return session.query(Order, Order.total).limit(limit).offset(offset)
+        compiled_dump = True
+        list_projection = Projection(Order, {
+            'id': Order.id,
+            'created_at': Order.created_at,
+            'status': Order.status,
+            'total': Order.total,
+            'customer.id': Customer.id,
+            'customer.email': Customer.email,
+            'customer.firstname': Customer.firstname,
+            'customer.lastname': Customer.lastname,
+            'version': Order.version,
+            'customer.version': Customer.version,
+            'products_version': products_version(),
+        }, joins=[Order.customer])
+        filters = {
+            'status': Filter(Order.status, ('eq', 'in')),
+            'customer': Filter(Order.customer_id, ('eq', 'in')),
+            'total': Filter(Order.total, ('gte', 'lt')),
+        }
+        sorts = {'id': Order.id, 'total': Order.total}
+
+    def create(self, data):
+        """ Orders are created by PlacementManager, with a fixed number of
+            statements whatever their lines count """
+        try:
+            id = self.place(data)
+        except PlacementError as e:
+            db.session.rollback()
+            raise ValidationError(e.errors)
+        return self._commit_created(lambda: id)
+
+    def bulk_create(self, items):
+        """ Bulk orders are placed one by one in the request transaction """
+        ids, errors = [], []
+        for index, item in enumerate(items):
+            try:
+                ids.append(self.place(item))
+            except ValidationError as e:
+                errors.append({'index': index, 'errors': e.messages})
+            except PlacementError as e:
+                errors.append({'index': index, 'errors': e.errors})
+        return (lambda: ids), errors
+
+    def place(self, data):
+        """ Places the order of a request item, returns its id """
+        data = self._meta.post_schema().load(data)
+        return PlacementManager.place(data['customer'], [
+            (line['product'], line['quantity']) for line in data['detail']])
+
+    def versions_query(self, session):
+        """ Orders representation includes their customer and the products
+            in the detail lines """
+        return (
+            session.query(Order.id, Order.version, Customer.version,
+                          func.max(Product.version))
+            .join(Order.customer)
+            .outerjoin(Order.detail)
+            .outerjoin(OrderDetail.product)
+            .group_by(Order.id, Order.version, Customer.version)
+        )
+
+    def record_versions(self, record):
+        if isinstance(record, Order):
+            products = max((line.product.version for line in record.detail),
+                           default=None)
+        else:
+            products = record.products_version
+        return (record.id, record.version, record.customer.version,
+                products)
+
+    def get_object(self, session, id):
+        """ Fetch the order, its customer, detail lines and products in a
+            single query """
+        rows = (
+            session.query(Order)
+            .join(Order.customer)
+            .outerjoin(Order.detail)
+            .outerjoin(OrderDetail.product)
+            .options(contains_eager(Order.customer),
+                     contains_eager(Order.detail)
+                     .contains_eager(OrderDetail.product))
+            .filter(Order.id == id)
+            .all()
+        )
+        return rows[0] if rows else None
@@ -0,0 +1,65 @@
+""" Serialization of exported collections, one record per line """
+import csv
+import io
+
+from flask import json
+from marshmallow import fields
+
+from .schemas import Reference
+
+
+def ndjson_lines(records, schema):
+    for record in records:
+        yield json.dumps(record) + '\n'
+
+
+def flatten(record, prefix=''):
+    """ Flattens nested records into dotted keys, lists are joined by '|'.
+        None values are left out, they are empty cells """
+    flat = {}
+    for key, value in record.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '%s%s.' % (prefix, key)))
+        elif isinstance(value, list):
+            flat[prefix + key] = '|'.join(map(str, value))
+        elif value is not None:
+            flat[prefix + key] = value
+    return flat
+
+
+def schema_columns(schema, prefix=''):
+    """ Dotted keys of the flattened records the schema dumps: the fields
+        of the nested schemas and of the Reference records are columns """
+    columns = []
+    for name, field in schema.fields.items():
+        if field.load_only:
+            continue
+        key = prefix + (field.data_key or name)
+        if isinstance(field, fields.Nested) and not field.many:
+            columns.extend(schema_columns(field.schema, key + '.'))
+        elif isinstance(field, Reference):
+            columns.extend((key + '.id', key + '.name'))
+        else:
+            columns.append(key)
+    return columns
+
+
+def csv_lines(records, schema):
+    """ CSV with a header, the columns are the sorted schema_columns of the
+        `schema` class: dumps don't keep the schema fields order, which
+        changes between processes """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=sorted(
+        schema_columns(schema())))
+    writer.writeheader()
+    for record in records:
+        writer.writerow(flatten(record))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+FORMATS = {
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+    'csv': (csv_lines, 'text/csv'),
+}
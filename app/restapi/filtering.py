@@ -0,0 +1,184 @@
+""" Declarative filtering and sorting of list endpoints
+
+A CrudView declares the list query arguments it accepts in its Meta:
+`filters`, {argument: Filter}, and `sorts`, {sort key: model attribute}.
+A ListSpec turns them into a ListArgsSchema subclass validating the
+arguments, and compiles the loaded arguments into the WHERE and ORDER BY
+clauses of the collection and versions queries.
+
+Filters are written `?name=value` (eq) or `?name__op=value`, `in` takes
+comma separated values. `?sort=key` sorts ascending, `?sort=-key`
+descending; the primary key breaks ties in the same direction, so keyset
+cursors keep working and the whole order can be read from an index.
+
+Sorting by a column without an index makes the database sort the whole
+filtered collection for every page, and filtering by one scans it, so sort
+keys and filter columns must lead an index (or the primary key, or an
+unique constraint) unless the view declares its collection small.
+"""
+import operator
+
+from marshmallow import fields, validate
+from sqlalchemy import (Enum, PrimaryKeyConstraint, UniqueConstraint,
+                        inspect, select)
+from sqlalchemy.types import DateTime, Integer, Numeric, String
+
+from .schemas import ListArgsSchema, Moment
+
+OPERATORS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'in': lambda column, values: column.in_(values),
+}
+
+# Most values an `in` filter accepts
+MAX_IN_VALUES = 100
+
+
+class EnumName(fields.Field):
+    """ Member of `enum` loaded by name """
+    default_error_messages = {'invalid': 'Must be one of: {choices}.'}
+
+    def __init__(self, enum, **kwargs):
+        super().__init__(**kwargs)
+        self.enum = enum
+
+    def _deserialize(self, value, attr, data):
+        if value not in self.enum.__members__:
+            self.fail('invalid', choices=', '.join(self.enum.__members__))
+        return self.enum[value]
+
+
+class Delimited(fields.Field):
+    """ Comma separated values, each one loaded with `field` """
+    default_error_messages = {
+        'too_many': 'At most {max:d} values are allowed.'}
+
+    def __init__(self, field, **kwargs):
+        super().__init__(**kwargs)
+        self.field = field
+
+    def _deserialize(self, value, attr, data):
+        values = [v.strip() for v in value.split(',')]
+        if len(values) > MAX_IN_VALUES:
+            self.fail('too_many', max=MAX_IN_VALUES)
+        return [self.field.deserialize(v, attr, data) for v in values]
+
+
+def value_field(column):
+    """ marshmallow field loading the query argument values of column """
+    type_ = column.type
+    if isinstance(type_, Enum) and type_.enum_class is not None:
+        return EnumName(type_.enum_class, required=False)
+    if isinstance(type_, Integer):
+        return fields.Integer(required=False)
+    if isinstance(type_, Numeric):
+        return fields.Decimal(required=False)
+    if isinstance(type_, DateTime):
+        return Moment(required=False)
+    if isinstance(type_, String):
+        return fields.String(required=False)
+    raise ValueError('Filtering by %s columns is not supported' % type_)
+
+
+def table_column(attribute):
+    """ Table column of a model attribute """
+    return attribute.property.columns[0]
+
+
+def is_indexed(column):
+    """ Whether column leads an index, the primary key or an unique
+        constraint of its table """
+    table = column.table
+    leading = [list(index.columns)[0] for index in table.indexes]
+    leading.extend(list(constraint.columns)[0]
+                   for constraint in table.constraints
+                   if isinstance(constraint, (PrimaryKeyConstraint,
+                                              UniqueConstraint)) and
+                   len(constraint.columns))
+    return any(column is c for c in leading)
+
+
+class Filter:
+    """ Filters a list by `column`, with the `operators` listed in
+        OPERATORS. When `via` is given, column belongs to another table
+        (ex: an association table) and the listed rows are the ones whose
+        primary key is among the `via` values of the matching rows """
+
+    def __init__(self, column, operators=('eq',), via=None):
+        unknown = set(operators) - set(OPERATORS)
+        if unknown:
+            raise ValueError('Unknown filter operators: %s' % ', '.join(
+                sorted(unknown)))
+        self.column = column
+        self.operators = operators
+        self.via = via
+
+    def arguments(self, name):
+        """ [(query argument, operator, field)] """
+        arguments = []
+        for op in self.operators:
+            field = value_field(table_column(self.column))
+            if op == 'in':
+                field = Delimited(field, required=False)
+            arguments.append((name if op == 'eq' else '%s__%s' % (name, op),
+                              op, field))
+        return arguments
+
+    def predicate(self, model, op, value):
+        expression = OPERATORS[op](self.column, value)
+        if self.via is None:
+            return expression
+        key = getattr(model, inspect(model).primary_key[0].key)
+        return key.in_(select([self.via]).where(expression))
+
+
+class ListSpec:
+    """ Query arguments of a list endpoint, see the module documentation """
+
+    def __init__(self, model, filters, sorts, small_collection=False):
+        self.model = model
+        self.sorts = sorts
+        if not small_collection:
+            for key, attribute in sorts.items():
+                if not is_indexed(table_column(attribute)):
+                    raise ValueError(
+                        'Sorting %s by %s requires an index' % (
+                            model.__tablename__, key))
+            for name, spec in filters.items():
+                if not is_indexed(table_column(spec.column)):
+                    raise ValueError(
+                        'Filtering %s by %s requires an index' % (
+                            model.__tablename__, name))
+        self.arguments = {}
+        schema_fields = {}
+        for name, spec in filters.items():
+            for argument, op, field in spec.arguments(name):
+                self.arguments[argument] = (spec, op)
+                schema_fields[argument] = field
+        if sorts:
+            schema_fields['sort'] = fields.String(
+                required=False, validate=[validate.OneOf(
+                    sorted(sorts) + ['-' + key for key in sorted(sorts)])])
+        self.schema = type(model.__name__ + 'ListArgsSchema',
+                           (ListArgsSchema,), schema_fields)
+
+    def load(self, args):
+        return self.schema().load(args)
+
+    def criteria(self, args):
+        """ Predicates of the filters found in the loaded arguments """
+        return [spec.predicate(self.model, op, args[argument])
+                for argument, (spec, op) in self.arguments.items()
+                if argument in args]
+
+    def sort(self, args):
+        """ (sort attribute or None, descending) of the loaded arguments """
+        key = args.get('sort')
+        if key is None:
+            return None, False
+        return self.sorts[key.lstrip('-')], key.startswith('-')
@@ -0,0 +1,77 @@
+""" Column projections for list endpoints
+
+Listing ORM instances pays for identity map bookkeeping, change tracking
+and relationship loaders on every row, only to dump it and throw it away.
+A Projection selects just the columns a list schema dumps and builds plain
+Record objects from them, which schemas dump like model instances.
+"""
+import collections
+from types import SimpleNamespace
+
+
+class Record(SimpleNamespace):
+    """ Lightweight row of a projection """
+
+
+class Projection:
+    """ Selects `columns`, a mapping of record attribute paths to column
+        expressions, ex: {'id': Customer.id, 'country.name': Country.name}.
+        Dotted paths build nested records, which are None when all their
+        columns are NULL (outer joins).
+
+        joins are the relationships joined from `model` to reach the
+        columns. collections maps record attributes to functions
+        (session, ids) -> {id: list} filling them for a whole page with one
+        query, records must have an `id` for them """
+
+    def __init__(self, model, columns, joins=(), collections=None):
+        self.model = model
+        self.columns = list(columns.items())
+        self.joins = joins
+        self.collections = collections or {}
+        self._layout = self._build_layout(
+            [(path.split('.'), i) for i, (path, _) in enumerate(self.columns)])
+
+    @classmethod
+    def _build_layout(cls, paths):
+        """ [(attribute, row index or nested layout)] """
+        layout = []
+        nested = collections.OrderedDict()
+        for path, index in paths:
+            if len(path) == 1:
+                layout.append((path[0], index))
+            else:
+                nested.setdefault(path[0], []).append((path[1:], index))
+        for name, sub_paths in nested.items():
+            layout.append((name, cls._build_layout(sub_paths)))
+        return layout
+
+    def query(self, session):
+        query = session.query(*[
+            column.label('c%d' % i)
+            for i, (_, column) in enumerate(self.columns)
+        ]).select_from(self.model)
+        for join in self.joins:
+            query = query.join(join)
+        return query
+
+    def _record(self, row, layout):
+        attrs = {}
+        for name, index in layout:
+            if isinstance(index, list):
+                attrs[name] = self._record(row, index)
+            else:
+                attrs[name] = row[index]
+        if all(v is None for v in attrs.values()):
+            return None
+        return Record(**attrs)
+
+    def records(self, session, rows):
+        """ Builds the records of a page of rows returned by query """
+        records = [self._record(row, self._layout) for row in rows]
+        ids = [r.id for r in records]
+        for name, load in self.collections.items():
+            values = load(session, ids) if ids else {}
+            for record in records:
+                setattr(record, name, values.get(record.id, []))
+        return records
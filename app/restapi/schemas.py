@@ -1,6 +1,100 @@
+import base64
+import datetime
+import json
+
 from app import ma
-from marshmallow import validate, post_load
+from marshmallow import ValidationError, fields, validate, validates_schema
 from app import models
+from app.reference import references
+from app.rollups import BUCKETS
+
+
+def encode_cursor(values):
+    """ Builds an opaque keyset pagination cursor from the key values of the
+        last row of a page """
+    return base64.urlsafe_b64encode(
+        json.dumps(values, default=str).encode()).decode().rstrip('=')
+
+
+class Cursor(fields.Field):
+    """ Keyset pagination cursor, loaded as the list of key values of the
+        last row already seen. An empty cursor means "from the beginning" """
+    default_error_messages = {'invalid': 'Not a valid cursor.'}
+
+    def _serialize(self, value, attr, obj):
+        return encode_cursor(value)
+
+    def _deserialize(self, value, attr, data):
+        if value == '':
+            return []
+        try:
+            padding = '=' * (-len(value) % 4)
+            values = json.loads(
+                base64.urlsafe_b64decode((value + padding).encode()).decode())
+        except (TypeError, ValueError):
+            self.fail('invalid')
+        if not isinstance(values, list) or not values or not all(
+                isinstance(v, (str, int, float)) and not isinstance(v, bool)
+                for v in values):
+            self.fail('invalid')
+        return values
+
+    def load_values(self, values, value_fields):
+        """ Values of a loaded cursor, each one loaded with the field of
+            its column """
+        if len(values) != len(value_fields):
+            self.fail('invalid')
+        try:
+            return [field.deserialize(value)
+                    for field, value in zip(value_fields, values)]
+        except ValidationError:
+            self.fail('invalid')
+
+
+class ResolvedNames(fields.List):
+    """ List of names loaded as instances of `model`, see NameResolver.
+        The resolver is taken from the schema context 'resolvers' so many
+        loads can share it """
+
+    def __init__(self, model, **kwargs):
+        super().__init__(fields.String(), **kwargs)
+        self.model = model
+
+    def _deserialize(self, value, attr, data):
+        names = super()._deserialize(value, attr, data)
+        resolver = self.context.get('resolvers', {}).get(self.model)
+        if resolver is None:
+            resolver = models.NameResolver(self.model)
+        return resolver.resolve(names)
+
+
+class Reference(fields.Field):
+    """ Record of a reference model (see reference.py) dumped as
+        {'id', 'name'} from the reference data cache, by the id found at
+        `attribute`. Loads ids, integers or decimal strings like the
+        database coerces them, as session instances """
+    default_error_messages = {'invalid': 'Not a valid id.',
+                              'not_found': 'Not found.'}
+
+    def __init__(self, model, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+
+    def _serialize(self, value, attr, obj):
+        if value is None:
+            return None
+        row = references.row(self.model, value)
+        return None if row is None else {'id': row.id, 'name': row.name}
+
+    def _deserialize(self, value, attr, data):
+        if isinstance(value, str) and value.isdecimal():
+            value = int(value)
+        if not isinstance(value, int) or isinstance(value, bool):
+            self.fail('invalid')
+        instance = references.get(self.model, value)
+        if instance is None:
+            self.fail('not_found')
+        return instance
 
 
 class ListArgsSchema(ma.Schema):
@@ -8,6 +102,64 @@ class ListArgsSchema(ma.Schema):
         validate.Range(1, 100)], missing=100)
     offset = ma.Integer(required=False, validate=[
         validate.Range(0)], missing=0)
+    after = Cursor(required=False)
+
+    @validates_schema(pass_original=True)
+    def validate_pagination_mode(self, data, original_data):
+        if 'after' in original_data and 'offset' in original_data:
+            raise ValidationError(
+                'offset and after can not be used together', 'after')
+
+
+class ExportArgsSchema(ma.Schema):
+    format = ma.String(required=False, missing='ndjson',
+                       validate=[validate.OneOf(['ndjson', 'csv'])])
+
+
+class SearchArgsSchema(ma.Schema):
+    q = ma.String(required=True, validate=[validate.Length(1, 200)])
+    category = ma.Integer(required=False)
+    tag = ma.Integer(required=False)
+    limit = ma.Integer(required=False, validate=[
+        validate.Range(1, 100)], missing=20)
+    offset = ma.Integer(required=False, validate=[
+        validate.Range(0)], missing=0)
+
+
+class FacetSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'name', 'count')
+
+
+class Moment(fields.DateTime):
+    """ ISO datetime or date (midnight), loaded as a naive local time like
+        the model datetimes """
+
+    def _deserialize(self, value, attr, data):
+        try:
+            moment = super()._deserialize(value, attr, data)
+        except ValidationError:
+            moment = datetime.datetime.combine(
+                fields.Date()._deserialize(value, attr, data),
+                datetime.time())
+        if moment.tzinfo is not None:
+            moment = moment.astimezone().replace(tzinfo=None)
+        return moment
+
+
+class SalesArgsSchema(ma.Schema):
+    start = Moment(data_key='from', required=True)
+    end = Moment(data_key='to', required=True)
+    bucket = ma.String(required=False, missing='day',
+                       validate=[validate.OneOf(BUCKETS)])
+    by = ma.String(required=False, missing='product',
+                   validate=[validate.OneOf(['product', 'country'])])
+
+    @validates_schema
+    def validate_range(self, data):
+        if 'start' in data and 'end' in data and \
+                data['start'] >= data['end']:
+            raise ValidationError('from must be before to', 'to')
 
 
 class CategorySchema(ma.ModelSchema):
@@ -27,7 +179,7 @@ class CustomerSchema(ma.ModelSchema):
         model = models.Customer
         fields = ('id', 'email', 'firstname', 'lastname', 'country')
 
-    country = ma.Nested(CountrySchema)
+    country = Reference(models.Country, attribute='country_id')
 
 
 class CustomerDeserializeSchema(CustomerSchema):
@@ -35,8 +187,8 @@ class CustomerDeserializeSchema(CustomerSchema):
         model = models.Customer
         fields = ('email', 'firstname', 'lastname', 'country')
 
-    country = ma.Function(deserialize=lambda v: models.Country.query.get(
-        v), required=True, validate=[validate.NoneOf([None])])
+    country = Reference(models.Country, attribute='country',
+                        required=True)
 
 
 class ProductSchema(ma.ModelSchema):
@@ -45,7 +197,7 @@ class ProductSchema(ma.ModelSchema):
         fields = ('id', 'name', 'description', 'price',
                   'category', 'status', 'tags')
 
-    category = ma.Nested(CategorySchema)
+    category = Reference(models.Category, attribute='category_id')
     price = ma.Decimal(as_string=True, places=2)
     status = ma.Function(lambda v: v.status.value)
     tags = ma.Function(lambda v: list(v.tags))
@@ -56,13 +208,13 @@ class ProductDeserializeSchema(ProductSchema):
         model = models.Product
         fields = ('name', 'description', 'price', 'category', 'status', 'tags')
 
-    category = ma.Function(deserialize=lambda v: models.Category.query.get(
-        v), required=True, validate=[validate.NoneOf([None])])
+    category = Reference(models.Category, attribute='category',
+                         required=True)
 
     status = ma.Function(deserialize=models.ProductStatusEnum.find,
                          required=True,
                          validate=[validate.NoneOf([None])])
-    tags = ma.List(ma.String(), required=True)
+    tags = ResolvedNames(models.Tag, attribute='rel_tags', required=True)
 
 
 class OrderDetailSchema(ma.ModelSchema):
@@ -87,37 +239,22 @@ class OrderSchema(ma.ModelSchema):
 
 
 class OrdersListSchema(OrderSchema):
+    """ Dumps the records of the orders list projection """
     class Meta:
         model = models.Order
         fields = ('id', 'created_at', 'status',
                   'customer', 'total')
 
-    status = ma.Function(lambda row: row.Order.status.value)
-
-    @staticmethod
-    def get_attribute(obj, attr, default):
-        if attr == 'total':
-            return obj.total
-        return getattr(obj.Order, attr, default)
 
-
-class OrderDetailCreateSchema(ma.Schema):
-    product = ma.Function(deserialize=lambda v: models.Product.query.get(
-        v), required=True, validate=[validate.NoneOf([None])])
+class OrderLineSchema(ma.Schema):
+    product = ma.Integer(required=True)
     quantity = ma.Integer(required=True, validate=[validate.Range(1)])
 
 
-class OrderCreateSchema(ma.Schema):
-    customer = ma.Function(deserialize=lambda v: models.Customer.query.get(
-        v), required=True, validate=[validate.NoneOf([None])])
-    detail = ma.Nested(OrderDetailCreateSchema, many=True)
-
-    @post_load
-    def create_order(self, data):
-        order = models.Order(customer=data['customer'])
-        for detail in data['detail']:
-            order.add_product(detail['product'], detail['quantity'])
-        return order
+class OrderPlacementSchema(ma.Schema):
+    """ Loads an order creation as ids, for PlacementManager.place """
+    customer = ma.Integer(required=True)
+    detail = ma.Nested(OrderLineSchema, many=True, required=True)
 
 
 class OrderUpdateSchema(ma.ModelSchema):
@@ -158,3 +295,18 @@ class UnitsDeliveredByProductByCountrySchema(ma.Schema):
     country_name = ma.String()
     country_id = ma.Integer()
     units = ma.Integer()
+
+
+class SalesSchema(ma.Schema):
+    bucket = ma.DateTime()
+    units = ma.Integer()
+    revenue = ma.Decimal(as_string=True, places=2)
+    orders = ma.Integer()
+
+
+class ProductSalesSchema(SalesSchema):
+    product = ma.Function(lambda row: {'id': row.id, 'name': row.name})
+
+
+class CountrySalesSchema(SalesSchema):
+    country = ma.Function(lambda row: {'id': row.id, 'name': row.name})
@@ -0,0 +1,38 @@
+from flask import jsonify, request
+
+from app import metrics
+from app.models import Product
+from app.search import SearchManager
+
+from .basecrudview import loading_options, next_page_url
+from .blueprint import api
+from .schemas import FacetSchema, ProductSchema, SearchArgsSchema
+
+
+@api.route('/products/search')
+def search_products():
+    """ A page of the products matching ?q=, best ranked first, with the
+        categories and tags facets of all the matches """
+    args = SearchArgsSchema().load(request.args)
+    result = SearchManager.search(args['q'], args.get('category'),
+                                  args.get('tag'), args['limit'],
+                                  args['offset'])
+    products = {p.id: p for p in Product.query.options(*loading_options(
+        Product, {'tags': 'selectinload'})
+    ).filter(Product.id.in_([hit.product_id for hit in result.hits]))}
+    with metrics.timer('serialization'):
+        dump = ProductSchema().dump
+        response = jsonify({
+            'total': result.total,
+            'results': [dict(dump(products[hit.product_id]),
+                             rank=round(hit.rank, 6))
+                        for hit in result.hits if hit.product_id in products],
+            'facets': {
+                'categories': FacetSchema(many=True).dump(result.categories),
+                'tags': FacetSchema(many=True).dump(result.tags),
+            },
+        })
+    if args['offset'] + args['limit'] < result.total:
+        response.headers['x-next'] = next_page_url(
+            offset=args['offset'] + args['limit'], limit=args['limit'])
+    return response
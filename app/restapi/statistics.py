@@ -1,36 +1,62 @@
-from app.models import CustomersManager, OrdersManager, ProductsManager
+from flask import jsonify, request
+
+from app import cache
+from app.models import (Category, Country, Customer, CustomersManager, Order,
+                        Product, ProductsManager)
+from app.rollups import RollupsManager
+from app.summaries import SummariesManager
 
 from .blueprint import api
-from .schemas import (CustomersByCountrySchema, OrdersByStatusSchema,
-                      ProductsByCategorySchema, SellsByProductSchema,
+from .schemas import (CountrySalesSchema, CustomersByCountrySchema,
+                      OrdersByStatusSchema, ProductsByCategorySchema,
+                      ProductSalesSchema, SalesArgsSchema,
+                      SellsByProductSchema,
                       UnitsDeliveredByProductByCountrySchema)
 
 
 @api.route('/statistics/products_by_category')
+@cache.cached(Product, Category)
 def products_by_category():
     return ProductsByCategorySchema(many=True).jsonify(
         ProductsManager.count_by_category())
 
 
 @api.route('/statistics/customers_by_country')
+@cache.cached(Customer, Country)
 def customers_by_country():
     return CustomersByCountrySchema(many=True).jsonify(
         CustomersManager.count_by_country())
 
 
 @api.route('/statistics/orders_by_status')
+@cache.cached(Order)
 def orders_by_status():
     return OrdersByStatusSchema(many=True).jsonify(
-        OrdersManager.count_by_status())
+        SummariesManager.count_by_status())
 
 
 @api.route('/statistics/sells_by_product')
 def sells_by_product():
     return SellsByProductSchema(many=True).jsonify(
-        ProductsManager.sells_by_product())
+        SummariesManager.sells_by_product())
 
 
 @api.route('/statistics/units_delivered_by_product_by_country')
 def units_delivered_by_product_by_country():
     return UnitsDeliveredByProductByCountrySchema(many=True).jsonify(
-        ProductsManager.units_delivered_by_product_by_country())
+        SummariesManager.units_delivered_by_product_by_country())
+
+
+@api.route('/statistics/sales')
+@cache.cached(Order, Customer, Product, Country)
+def sales():
+    args = SalesArgsSchema().load(request.args)
+    schema = (ProductSalesSchema if args['by'] == 'product'
+              else CountrySalesSchema)
+    return schema(many=True).jsonify(RollupsManager.sales(
+        args['start'], args['end'], args['bucket'], args['by']))
+
+
+@api.route('/statistics/cache')
+def cache_stats():
+    return jsonify(cache.stats())
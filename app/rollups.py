@@ -0,0 +1,384 @@
+""" Time bucketed sales rollups
+
+Units, revenue and orders count of the sold orders (SALE_STATUSES), by
+hour and by day of their creation, per product and country and per
+country. Orders are counted once per product in the product rollups, the
+country rollups count them once, so they aren't summed over products.
+
+Rollups are kept up to date on every flush touching orders, their detail
+lines or their customers country: the orders state after the flush is
+loaded with a single query, their state before is rebuilt from the
+attributes history, and the difference of their contributions is upserted
+into the rollup rows. Weeks and months are folded from the daily rollups.
+
+`RollupsManager.rebuild` recomputes them from scratch and
+`RollupsManager.check` compares them against the orders.
+"""
+import collections
+import datetime
+import decimal
+
+from sqlalchemy import event, func, inspect, select, type_coerce
+from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import (Country, Customer, Order, OrderDetail,
+                        OrderStatusEnum, Product)
+from app.summaries import _committed, increment_rows
+
+SALE_STATUSES = (OrderStatusEnum.PAYED, OrderStatusEnum.SHIPPING,
+                 OrderStatusEnum.DELIVERED)
+BUCKETS = ('hour', 'day', 'week', 'month')
+REVENUE = db.Numeric(14, 5, asdecimal=True)
+PRECISION = decimal.Decimal('0.00001')
+
+
+class SalesRollup:
+    bucket = db.Column(db.DateTime, primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(REVENUE, nullable=False, default=0)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+
+    @declared_attr
+    def country_id(cls):
+        return db.Column(db.Integer, db.ForeignKey(
+            'country.id', ondelete='CASCADE'), primary_key=True)
+
+
+class ProductSalesRollup(SalesRollup):
+    @declared_attr
+    def product_id(cls):
+        return db.Column(db.Integer, db.ForeignKey(
+            'product.id', ondelete='CASCADE'), primary_key=True)
+
+
+class HourlyProductSales(ProductSalesRollup, db.Model):
+    __tablename__ = 'rollup_product_sales_hourly'
+
+
+class DailyProductSales(ProductSalesRollup, db.Model):
+    __tablename__ = 'rollup_product_sales_daily'
+
+
+class HourlyCountrySales(SalesRollup, db.Model):
+    __tablename__ = 'rollup_country_sales_hourly'
+
+
+class DailyCountrySales(SalesRollup, db.Model):
+    __tablename__ = 'rollup_country_sales_daily'
+
+
+# (rollup model, granularity, key columns besides the bucket)
+ROLLUPS = (
+    (HourlyProductSales, 'hour', ('product_id', 'country_id')),
+    (DailyProductSales, 'day', ('product_id', 'country_id')),
+    (HourlyCountrySales, 'hour', ('country_id',)),
+    (DailyCountrySales, 'day', ('country_id',)),
+)
+
+SOURCE_COLUMNS = {
+    'product_id': OrderDetail.product_id,
+    'country_id': Customer.country_id,
+}
+
+
+def bucket_expression(column, granularity, dialect):
+    """ `column` truncated to the hour or the day """
+    if dialect == 'postgresql':
+        expression = func.date_trunc(granularity, column)
+    elif dialect == 'sqlite':
+        # Same text format SQLAlchemy stores SQLite datetimes with
+        expression = func.strftime(
+            '%Y-%m-%d %H:00:00.000000' if granularity == 'hour'
+            else '%Y-%m-%d 00:00:00.000000', column)
+    else:
+        raise ValueError('Sales rollups are not supported for %s' % dialect)
+    return type_coerce(expression, db.DateTime)
+
+
+def _rollup_select(granularity, keys, dialect, order_ids=None):
+    """ Contributions of the sold orders, or of the `order_ids` ones, to
+        a rollup. Rows are (bucket, keys..., units, revenue, orders) """
+    bucket = bucket_expression(Order.created_at, granularity, dialect)
+    columns = [SOURCE_COLUMNS[key] for key in keys]
+    q = (
+        select([bucket] + columns + [
+            func.sum(OrderDetail.quantity),
+            type_coerce(func.sum(OrderDetail.unit_price *
+                                 OrderDetail.quantity), REVENUE),
+            func.count(func.distinct(Order.id)),
+        ])
+        .select_from(OrderDetail.__table__.join(Order).join(Customer))
+        .where(Order.status.in_(SALE_STATUSES))
+        .group_by(bucket, *columns)
+    )
+    if order_ids is not None:
+        q = q.where(Order.id.in_(order_ids))
+    return q
+
+
+def bucket_start(moment, granularity):
+    """ `moment` truncated to the hour or the day, like bucket_expression """
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if granularity == 'day':
+        moment = moment.replace(hour=0)
+    return moment
+
+
+# Rollups state of an order: its status, creation time, customer, customer
+# country and lines, {line id: (product id, quantity, unit price)}
+OrderState = collections.namedtuple(
+    'OrderState', ['status', 'created_at', 'customer_id', 'country_id',
+                   'lines'])
+
+
+class RollupDelta:
+    """ Increments to apply to the rollup rows, keyed like them """
+
+    def __init__(self):
+        self.counters = {
+            model: collections.defaultdict(lambda: [0, decimal.Decimal(0), 0])
+            for model, _, _ in ROLLUPS}
+
+    def add_order(self, state, sign=1):
+        """ Adds the contributions of an order in `state`, or removes them
+            with sign -1 """
+        if state.status not in SALE_STATUSES or not state.lines:
+            return
+        for model, granularity, keys in ROLLUPS:
+            counter = self.counters[model]
+
+            def key(product_id):
+                values = {'product_id': product_id,
+                          'country_id': state.country_id}
+                return (bucket_start(state.created_at, granularity),) + \
+                    tuple(values[k] for k in keys)
+            # Orders are counted once per key
+            for k in {key(line[0]) for line in state.lines.values()}:
+                counter[k][2] += sign
+            for product_id, quantity, unit_price in state.lines.values():
+                values = counter[key(product_id)]
+                values[0] += sign * quantity
+                values[1] += sign * quantity * decimal.Decimal(
+                    unit_price or 0)
+
+    def __bool__(self):
+        return any(any(any(values) for values in counter.values())
+                   for counter in self.counters.values())
+
+    def apply(self, connection):
+        """ Adds the increments to the rollup rows, creating the rows that
+            don't exist yet, see increment_rows """
+        for model, _, keys in ROLLUPS:
+            names = ('bucket',) + keys
+            rows = []
+            for key, (units, revenue, orders) in sorted(
+                    self.counters[model].items()):
+                revenue = revenue.quantize(PRECISION)
+                if units or revenue or orders:
+                    rows.append(dict(zip(names, key), units=units,
+                                     revenue=revenue, orders=orders))
+            if rows:
+                increment_rows(connection, model.__table__, names, rows)
+
+    @classmethod
+    def from_flush(cls, session):
+        """ Computes the increments caused by the objects being flushed,
+            from the orders state before and after the flush. Must be
+            called from after_flush, see SummaryDelta.from_flush. Loads the
+            orders the flush can change the contributions of, with their
+            lines, in one query """
+        delta = cls()
+        orders = {}
+        # line -> order id before the flush, None for new lines
+        lines = {}
+        # customer id -> country id before the flush
+        moved = {}
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, Order):
+                orders[obj.id] = obj
+            elif isinstance(obj, OrderDetail):
+                lines[obj] = (None if obj in session.new
+                              else _committed(obj, 'order_id'))
+            elif isinstance(obj, Customer) and obj not in session.new:
+                old = _committed(obj, 'country_id')
+                if old != obj.country_id:
+                    moved[obj.id] = old
+        if not orders and not lines and not moved:
+            return delta
+
+        def before(order, attr):
+            if order in session.new:
+                return None
+            return _committed(order, attr)
+        # Orders of the flush which were or are sold, and the orders of
+        # the lines and customers, if they are sold
+        flushed = {id for id, o in orders.items() if o not in session.deleted
+                   and (o.status in SALE_STATUSES or
+                        before(o, 'status') in SALE_STATUSES)}
+        others = ({line.order_id for line in lines} | set(lines.values())) - \
+            set(orders) - {None}
+        where = []
+        if flushed:
+            where.append(Order.id.in_(flushed))
+        if others or moved:
+            where.append(db.and_(Order.status.in_(SALE_STATUSES), db.or_(
+                *([Order.id.in_(others)] if others else []) +
+                ([Order.customer_id.in_(moved)] if moved else []))))
+        after = {}
+        if where:
+            for row in session.execute(
+                    select([Order.id, Order.status, Order.created_at,
+                            Order.customer_id, Customer.country_id,
+                            OrderDetail.id, OrderDetail.product_id,
+                            OrderDetail.quantity, OrderDetail.unit_price])
+                    .select_from(Order.__table__.join(Customer)
+                                 .outerjoin(OrderDetail))
+                    .where(db.or_(*where))):
+                if row[0] not in after:
+                    after[row[0]] = OrderState(*row[1:5], lines={})
+                if row[5] is not None:
+                    after[row[0]].lines[row[5]] = tuple(row[6:])
+
+        # The state before the flush, from the state after and the
+        # attributes history
+        previous = {}
+        for id, state in after.items():
+            order = orders.get(id)
+            if order is None:
+                previous[id] = state._replace(country_id=None,
+                                              lines=dict(state.lines))
+            elif order not in session.new:
+                previous[id] = OrderState(
+                    before(order, 'status'), before(order, 'created_at'),
+                    before(order, 'customer_id'), None, dict(state.lines))
+        for id, order in orders.items():
+            if order in session.deleted and \
+                    before(order, 'status') in SALE_STATUSES:
+                previous[id] = OrderState(
+                    before(order, 'status'), before(order, 'created_at'),
+                    before(order, 'customer_id'), None, {})
+        for line, order_id in lines.items():
+            if line.order_id in previous:
+                previous[line.order_id].lines.pop(line.id, None)
+            if order_id in previous and line not in session.new:
+                previous[order_id].lines[line.id] = tuple(
+                    _committed(line, attr)
+                    for attr in ('product_id', 'quantity', 'unit_price'))
+
+        countries = {s.customer_id: s.country_id for s in after.values()}
+        countries.update(moved)
+        missing = {s.customer_id for s in previous.values()} - \
+            set(countries)
+        if missing:
+            countries.update(map(tuple, session.execute(
+                select([Customer.id, Customer.country_id])
+                .where(Customer.id.in_(missing)))))
+        for state in previous.values():
+            delta.add_order(state._replace(
+                country_id=countries[state.customer_id]), -1)
+        for state in after.values():
+            delta.add_order(state)
+        return delta
+
+
+@event.listens_for(Session, 'after_flush')
+def update_rollups(session, flush_context):
+    delta = RollupDelta.from_flush(session)
+    if delta:
+        delta.apply(session.connection())
+
+
+def period_start(moment, bucket):
+    """ Start of the week (monday) or month of a day """
+    if bucket == 'week':
+        return moment - datetime.timedelta(days=moment.weekday())
+    if bucket == 'month':
+        return moment.replace(day=1)
+    return moment
+
+
+SalesRow = collections.namedtuple(
+    'SalesRow', ['bucket', 'id', 'name', 'units', 'revenue', 'orders'])
+
+
+class RollupsManager:
+    @staticmethod
+    def sales(start, end, bucket='day', by='product'):
+        """ Returns a list of SalesRow, one per bucket and product or
+            country, with the sales of the orders created between start
+            (inclusive) and end (exclusive) """
+        granularity = 'hour' if bucket == 'hour' else 'day'
+        if by == 'product':
+            model = (HourlyProductSales if granularity == 'hour'
+                     else DailyProductSales)
+            key, key_id = Product, model.product_id
+        else:
+            model = (HourlyCountrySales if granularity == 'hour'
+                     else DailyCountrySales)
+            key, key_id = Country, model.country_id
+        rows = (
+            db.session.query(
+                model.bucket, key.id, key.name,
+                func.sum(model.units),
+                type_coerce(func.sum(model.revenue), REVENUE),
+                func.sum(model.orders))
+            .join(key, key.id == key_id)
+            .filter(model.bucket >= start, model.bucket < end)
+            .filter(model.orders > 0)
+            .group_by(model.bucket, key.id, key.name)
+            .order_by(model.bucket, key.id)
+        )
+        if bucket in ('hour', 'day'):
+            return [SalesRow(*row) for row in rows]
+        periods = collections.OrderedDict()
+        for moment, id, name, units, revenue, orders in rows:
+            period = (period_start(moment, bucket), id)
+            if period not in periods:
+                periods[period] = SalesRow(period[0], id, name, 0, 0, 0)
+            row = periods[period]
+            periods[period] = row._replace(
+                units=row.units + units, revenue=row.revenue + revenue,
+                orders=row.orders + orders)
+        return sorted(periods.values(), key=lambda row: (row.bucket, row.id))
+
+    @staticmethod
+    def rebuild():
+        """ Recomputes all the rollups from the orders """
+        dialect = db.session.get_bind(inspect(Order)).dialect.name
+        for model, granularity, keys in ROLLUPS:
+            table = model.__table__
+            db.session.execute(table.delete())
+            db.session.execute(table.insert().from_select(
+                ['bucket'] + list(keys) + ['units', 'revenue', 'orders'],
+                _rollup_select(granularity, keys, dialect)))
+
+    @staticmethod
+    def check():
+        """ Compares the rollups against the orders. Returns a list of
+            (table, key, expected, actual) for each mismatching row """
+        dialect = db.session.get_bind(inspect(Order)).dialect.name
+        zero = (0, decimal.Decimal(0), 0)
+        errors = []
+        for model, granularity, keys in ROLLUPS:
+            table = model.__table__
+
+            def values(rows):
+                return {
+                    tuple(row[:-3]): (row[-3], decimal.Decimal(
+                        row[-2] or 0).quantize(decimal.Decimal('0.01')),
+                        row[-1])
+                    for row in rows if any(row[-3:])
+                }
+            expected = values(db.session.execute(
+                _rollup_select(granularity, keys, dialect)))
+            actual = values(db.session.execute(select(
+                [table.c.bucket] + [table.c[k] for k in keys] +
+                [table.c.units, type_coerce(table.c.revenue, REVENUE),
+                 table.c.orders])))
+            for key in sorted(set(expected) | set(actual)):
+                if expected.get(key, zero) != actual.get(key, zero):
+                    errors.append((table.name, key, expected.get(key, zero),
+                                   actual.get(key, zero)))
+        return errors
@@ -0,0 +1,296 @@
+""" Product full text search
+
+Products are searched by name (weight A), tag names (B), category name (C)
+and description (D). The product_search table keeps one row per product,
+refreshed from the flush listeners whenever a product changes or its
+category or one of its tags is renamed.
+
+On PostgreSQL the rows hold a weighted tsvector covered by a GIN index,
+queries are parsed with plainto_tsquery (every word must match) and ranked
+with ts_rank_cd. Other databases (SQLite in development and tests) use an
+in-process inverted index built from the products, reloaded whenever the
+product_search rows change; it matches whole words, without stemming.
+
+`SearchManager.rebuild` recomputes the table.
+"""
+import collections
+import re
+import threading
+
+from sqlalchemy import DDL, event, func, inspect, literal, null, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+from app import db
+from app.models import Category, Product, ProductTag, Tag, next_version
+
+# PostgreSQL text search configuration
+TEXT_SEARCH_CONFIG = 'english'
+# Field weights, the PostgreSQL ts_rank defaults
+WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2, 'D': 0.1}
+# Most values returned per facet
+FACET_SIZE = 20
+# Product attributes the search document depends on
+DOCUMENT_ATTRIBUTES = ('name', 'description', 'category', 'category_id',
+                       'rel_tags')
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+class ProductSearch(db.Model):
+    __tablename__ = 'product_search'
+    product_id = db.Column(db.Integer, db.ForeignKey(
+        'product.id', ondelete='CASCADE'), primary_key=True)
+    # Changes on every refresh, the fallback index reloads when the
+    # greatest one changes
+    version = db.Column(db.BigInteger, nullable=False)
+    # Weighted tsvector on PostgreSQL, unused elsewhere
+    document = db.Column(db.Text().with_variant(postgresql.TSVECTOR(),
+                                                'postgresql'))
+
+
+event.listen(ProductSearch.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_product_search_document ON product_search '
+    'USING gin (document)').execute_if(dialect='postgresql'))
+
+
+def tokenize(text):
+    return TOKEN.findall((text or '').lower())
+
+
+def _weighted(expression, weight):
+    return func.setweight(func.to_tsvector(
+        TEXT_SEARCH_CONFIG, func.coalesce(expression, '')), weight)
+
+
+def _document_select(dialect, version, ids=None):
+    """ (product_id, version, document) rows of the products """
+    if dialect == 'postgresql':
+        tags = (
+            select([func.string_agg(Tag.name, ' ')])
+            .select_from(ProductTag.__table__.join(Tag))
+            .where(ProductTag.product_id == Product.id)
+            .as_scalar()
+        )
+        document = (_weighted(Product.name, 'A')
+                    .op('||')(_weighted(tags, 'B'))
+                    .op('||')(_weighted(Category.name, 'C'))
+                    .op('||')(_weighted(Product.description, 'D')))
+    else:
+        document = null()
+    q = (
+        select([Product.id, literal(version), document])
+        .select_from(Product.__table__.join(Category))
+    )
+    if ids is not None:
+        q = q.where(Product.id.in_(ids))
+    return q
+
+
+def refresh(connection, ids=None):
+    """ Recomputes the search rows of the products `ids`, all of them by
+        default. Rows of deleted products are removed """
+    table = ProductSearch.__table__
+    delete = table.delete()
+    if ids is not None:
+        delete = delete.where(table.c.product_id.in_(ids))
+    connection.execute(delete)
+    connection.execute(table.insert().from_select(
+        ['product_id', 'version', 'document'],
+        _document_select(connection.dialect.name, next_version(), ids)))
+
+
+def _changed(obj, attributes):
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes()
+               for name in attributes)
+
+
+@event.listens_for(Session, 'before_flush')
+def _search_before_flush(session, flush_context, instances):
+    """ Records the products whose search document the flush changes """
+    products, categories, tags = [], [], []
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Product):
+            if obj in session.new or obj in session.deleted or \
+                    _changed(obj, DOCUMENT_ATTRIBUTES):
+                products.append(obj)
+        elif isinstance(obj, (Category, Tag)) and obj in session.dirty \
+                and _changed(obj, ('name',)):
+            (categories if isinstance(obj, Category) else tags).append(
+                obj.id)
+    if products or categories or tags:
+        session.info['search_products'] = (products, categories, tags)
+
+
+@event.listens_for(Session, 'after_flush')
+def _search_after_flush(session, flush_context):
+    products, categories, tags = session.info.pop(
+        'search_products', ((), (), ()))
+    ids = {p.id for p in products}
+    if categories:
+        ids |= {row[0] for row in session.execute(
+            select([Product.id]).where(Product.category_id.in_(categories)))}
+    if tags:
+        ids |= {row[0] for row in session.execute(
+            select([ProductTag.product_id]).where(
+                ProductTag.tag_id.in_(tags)))}
+    ids.discard(None)
+    if ids:
+        refresh(session.connection(), ids)
+
+
+SearchResult = collections.namedtuple(
+    'SearchResult', ['total', 'hits', 'categories', 'tags'])
+Hit = collections.namedtuple('Hit', ['product_id', 'rank'])
+# Category or tag, and how many matching products have it
+Facet = collections.namedtuple('Facet', ['id', 'name', 'count'])
+
+
+class InvertedIndex:
+    """ token -> {product id: score} of all the products, with their
+        category and tags for the facets. Never modified once built, see
+        IndexCache """
+
+    def __init__(self, postings=None, products=None, names=None):
+        self.postings = postings or {}
+        self.products = products or {}
+        self.names = names or {'category': {}, 'tag': {}}
+
+    @classmethod
+    def build(cls, session):
+        postings = collections.defaultdict(
+            lambda: collections.defaultdict(float))
+        products = {}
+        tags = collections.defaultdict(list)
+        names = {'category': {}, 'tag': {}}
+        for product_id, tag_id, name in (
+                session.query(ProductTag.product_id, Tag.id, Tag.name)
+                .join(Tag, Tag.id == ProductTag.tag_id)):
+            tags[product_id].append(tag_id)
+            names['tag'][tag_id] = name
+            for token in tokenize(name):
+                postings[token][product_id] += WEIGHTS['B']
+        for id, name, description, category_id, category in (
+                session.query(Product.id, Product.name, Product.description,
+                              Category.id, Category.name)
+                .join(Product.category)):
+            products[id] = (category_id, tags.get(id, []))
+            names['category'][category_id] = category
+            for text, weight in ((name, 'A'), (category, 'C'),
+                                 (description, 'D')):
+                for token in tokenize(text):
+                    postings[token][id] += WEIGHTS[weight]
+        return cls({token: dict(scores)
+                    for token, scores in postings.items()}, products, names)
+
+    def search(self, text, category=None, tag=None, limit=20, offset=0):
+        tokens = set(tokenize(text))
+        scores = None
+        for token in tokens:
+            found = self.postings.get(token, {})
+            if scores is None:
+                scores = dict(found)
+            else:
+                scores = {id: score + found[id]
+                          for id, score in scores.items() if id in found}
+        scores = scores or {}
+        matches = [
+            id for id in scores if id in self.products and
+            (category is None or self.products[id][0] == category) and
+            (tag is None or tag in self.products[id][1])]
+        categories = collections.Counter(
+            self.products[id][0] for id in matches)
+        tags = collections.Counter(
+            tag_id for id in matches for tag_id in self.products[id][1])
+        matches.sort(key=lambda id: (-scores[id], id))
+        return SearchResult(
+            len(matches),
+            [Hit(id, scores[id]) for id in matches[offset:offset + limit]],
+            self._facet(categories, 'category'), self._facet(tags, 'tag'))
+
+    def _facet(self, counter, kind):
+        return [Facet(id, self.names[kind][id], count) for id, count in sorted(
+            counter.items(), key=lambda item: (-item[1], item[0]))[
+                :FACET_SIZE]]
+
+
+class IndexCache:
+    """ InvertedIndex of the process, rebuilt when the product_search table
+        changes. Rebuilds replace the whole index with a single assignment:
+        searches keep the index they started with and never see one half
+        built """
+
+    def __init__(self):
+        self.stamp = None
+        self.index = InvertedIndex()
+        self._lock = threading.Lock()
+
+    def refresh(self, session):
+        """ Current index, rebuilt first if the table changed """
+        stamp = session.query(func.count(ProductSearch.product_id),
+                              func.max(ProductSearch.version)).one()
+        with self._lock:
+            if stamp != self.stamp:
+                self.index = InvertedIndex.build(session)
+                self.stamp = stamp
+            return self.index
+
+
+_index = IndexCache()
+
+
+class SearchManager:
+    @staticmethod
+    def search(text, category=None, tag=None, limit=20, offset=0):
+        """ Products matching all the words of text, best ranked first.
+            category and tag (ids) narrow the matches. Returns a
+            SearchResult, with a page of Hit and the Facet of the matches """
+        dialect = db.session.get_bind(inspect(Product)).dialect.name
+        if dialect != 'postgresql':
+            return _index.refresh(db.session).search(
+                text, category, tag, limit, offset)
+        query = func.plainto_tsquery(TEXT_SEARCH_CONFIG, text)
+        rank = func.ts_rank_cd(ProductSearch.document, query)
+        matches = (
+            db.session.query(ProductSearch.product_id)
+            .filter(ProductSearch.document.op('@@')(query))
+        )
+        if category is not None:
+            matches = matches.join(
+                Product, Product.id == ProductSearch.product_id).filter(
+                    Product.category_id == category)
+        if tag is not None:
+            matches = matches.filter(ProductSearch.product_id.in_(
+                select([ProductTag.product_id]).where(
+                    ProductTag.tag_id == tag)))
+        total = matches.count()
+        hits = (
+            matches.add_columns(rank)
+            .order_by(rank.desc(), ProductSearch.product_id)
+            .limit(limit).offset(offset).all()
+        )
+        ids = matches.subquery()
+        categories = (
+            db.session.query(Category.id, Category.name, func.count())
+            .join(Product, Product.category_id == Category.id)
+            .filter(Product.id.in_(select([ids.c.product_id])))
+            .group_by(Category.id, Category.name)
+            .order_by(func.count().desc(), Category.id)
+            .limit(FACET_SIZE).all()
+        )
+        tags = (
+            db.session.query(Tag.id, Tag.name, func.count())
+            .join(ProductTag, ProductTag.tag_id == Tag.id)
+            .filter(ProductTag.product_id.in_(select([ids.c.product_id])))
+            .group_by(Tag.id, Tag.name)
+            .order_by(func.count().desc(), Tag.id)
+            .limit(FACET_SIZE).all()
+        )
+        return SearchResult(total, [Hit(*row) for row in hits],
+                            [Facet(*row) for row in categories],
+                            [Facet(*row) for row in tags])
+
+    @staticmethod
+    def rebuild():
+        """ Recomputes the search rows of all the products """
+        refresh(db.session.connection())
@@ -0,0 +1,245 @@
+""" Bulk dataset generator
+
+Adds random, reproducible data to a database, fast enough for millions of
+order detail lines. Rows are built in batches with explicit primary keys,
+following the existing ones, and loaded bypassing the ORM unit of work:
+with COPY on PostgreSQL and one executemany per batch on other databases.
+Tables are filled in foreign keys order, countries -> customers -> orders
+-> order_detail and categories, tags -> products -> product_tag. Order
+totals and versions are computed while generating the rows and the
+summary, rollup and search tables are rebuilt at the end.
+"""
+import csv
+import datetime
+import decimal
+import enum
+import io
+import random
+
+from sqlalchemy import func, select
+
+from app import db
+from app.models import (Category, Country, Customer, Order, OrderDetail,
+                        OrderStatusEnum, Product, ProductStatusEnum,
+                        ProductTag, Tag, next_version)
+from app.rollups import RollupsManager
+from app.search import SearchManager
+from app.summaries import SummariesManager
+
+DEFAULT_SIZES = {
+    'countries': 50,
+    'categories': 50,
+    'tags': 200,
+    'products': 10000,
+    'customers': 50000,
+    'orders': 200000,
+}
+
+# Sizes of scale 1, multiplied by the scale factor. Reference tables stop
+# growing at their maximum
+SCALE_SIZES = {
+    'countries': (10, 200),
+    'categories': (20, 500),
+    'tags': (10, 1000),
+    'products': (10, None),
+    'customers': (50, None),
+    'orders': (50, None),
+}
+
+# Models with an id primary key, in foreign keys order
+MODELS = (Country, Category, Tag, Product, Customer, Order, OrderDetail)
+
+
+def scaled_sizes(scale):
+    """ Sizes of the dataset of a scale factor """
+    sizes = {}
+    for name, (size, maximum) in SCALE_SIZES.items():
+        size = max(int(size * scale), 1)
+        sizes[name] = min(size, maximum) if maximum else size
+    return sizes
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_value(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ')
+    return value
+
+
+def copy_data(columns, rows):
+    """ CSV text of rows for COPY ... FROM STDIN (FORMAT csv), None values
+        are written as NULL """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow([copy_value(row[column]) for column in columns])
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(connection, table, rows):
+    """ Loads rows with PostgreSQL COPY """
+    quote = connection.dialect.identifier_preparer
+    columns = list(rows[0])
+    statement = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (
+        quote.format_table(table),
+        ', '.join(quote.quote(column) for column in columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, copy_data(columns, rows))
+    finally:
+        cursor.close()
+
+
+class DatasetGenerator:
+    """ Generates `sizes` rows (see DEFAULT_SIZES) with orders of 1 to
+        2 * `lines` - 1 detail lines, `lines` on average """
+
+    def __init__(self, sizes=None, lines=5, seed=None, batch_size=10000):
+        self.sizes = dict(DEFAULT_SIZES, **(sizes or {}))
+        self.lines = lines
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.version = next_version()
+        self.now = datetime.datetime.now().replace(microsecond=0)
+        self.ids = {}
+        self.prices = {}
+        self.counts = {}
+
+    def run(self):
+        """ Inserts the dataset in the current session transaction and
+            returns the inserted rows count by table """
+        connection = db.session.connection()
+        for model in MODELS:
+            self.ids[model] = connection.execute(
+                select([func.coalesce(func.max(model.id), 0)])).scalar() + 1
+        self.insert(connection, Country, self.named(Country, 'countries'))
+        self.insert(connection, Category,
+                    self.named(Category, 'categories'))
+        self.insert(connection, Tag, self.named(Tag, 'tags'))
+        self.insert(connection, Product, self.products())
+        self.insert(connection, ProductTag, self.product_tags())
+        self.insert(connection, Customer, self.customers())
+        self.insert_orders(connection)
+        if connection.dialect.name == 'postgresql':
+            self.reset_sequences(connection)
+        SummariesManager.rebuild()
+        RollupsManager.rebuild()
+        SearchManager.rebuild()
+        return self.counts
+
+    def id_range(self, model, size):
+        """ Ids of the new rows of model """
+        first = self.ids.get(model, 1)
+        return range(first, first + self.sizes[size])
+
+    def insert(self, connection, model, rows):
+        table = model.__table__
+        for batch in batches(rows, self.batch_size):
+            if connection.dialect.name == 'postgresql':
+                copy_rows(connection, table, batch)
+            else:
+                connection.execute(table.insert(), batch)
+            self.counts[table.name] = self.counts.get(table.name, 0) + len(
+                batch)
+
+    def reset_sequences(self, connection):
+        for model in MODELS:
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('\"%s\"', 'id'), "
+                "coalesce(max(id), 1)) FROM \"%s\"" % (
+                    model.__tablename__, model.__tablename__))
+
+    def named(self, model, size):
+        for id in self.id_range(model, size):
+            row = {'id': id, 'name': '%s %d' % (model.__name__, id)}
+            if 'version' in model.__table__.c:
+                row['version'] = self.version
+            yield row
+
+    def products(self):
+        rnd = self.random
+        statuses = list(ProductStatusEnum)
+        categories = self.id_range(Category, 'categories')
+        for id in self.id_range(Product, 'products'):
+            price = decimal.Decimal(rnd.randint(100, 100000)) / 100
+            self.prices[id] = price
+            yield {
+                'id': id,
+                'name': 'Product %d' % id,
+                'description': 'Description of product %d' % id,
+                'price': price,
+                'category_id': rnd.choice(categories),
+                'status': (ProductStatusEnum.ACTIVE if rnd.random() < 0.8
+                           else rnd.choice(statuses)),
+                'version': self.version,
+            }
+
+    def product_tags(self):
+        tags = self.id_range(Tag, 'tags')
+        for id in self.id_range(Product, 'products'):
+            for tag_id in self.random.sample(tags, min(len(tags), 3)):
+                yield {'product_id': id, 'tag_id': tag_id}
+
+    def customers(self):
+        rnd = self.random
+        countries = self.id_range(Country, 'countries')
+        for id in self.id_range(Customer, 'customers'):
+            yield {
+                'id': id,
+                'email': 'customer%d@example.com' % id,
+                'firstname': 'Firstname %d' % id,
+                'lastname': 'Lastname %d' % id,
+                'country_id': rnd.choice(countries),
+                'version': self.version,
+            }
+
+    def insert_orders(self, connection):
+        """ Orders and their lines are generated together, the lines of a
+            batch of orders are inserted after it """
+        rnd = self.random
+        statuses = list(OrderStatusEnum)
+        customers = self.id_range(Customer, 'customers')
+        products = self.id_range(Product, 'products')
+        detail_id = self.ids.get(OrderDetail, 1)
+        for ids in batches(self.id_range(Order, 'orders'), self.batch_size):
+            orders, details = [], []
+            for id in ids:
+                total, items_count = decimal.Decimal(0), 0
+                count = rnd.randint(1, 2 * self.lines - 1)
+                for product_id in rnd.sample(products,
+                                             min(count, len(products))):
+                    quantity = rnd.randint(1, 10)
+                    unit_price = self.prices[product_id]
+                    details.append({
+                        'id': detail_id, 'order_id': id,
+                        'product_id': product_id, 'quantity': quantity,
+                        'unit_price': unit_price,
+                    })
+                    detail_id += 1
+                    total += unit_price * quantity
+                    items_count += quantity
+                orders.append({
+                    'id': id,
+                    'customer_id': rnd.choice(customers),
+                    'status': rnd.choice(statuses),
+                    'created_at': self.now - datetime.timedelta(
+                        seconds=rnd.randint(0, 365 * 24 * 3600)),
+                    'total': total,
+                    'items_count': items_count,
+                    'version': self.version,
+                })
+            self.insert(connection, Order, orders)
+            self.insert(connection, OrderDetail, details)
@@ -0,0 +1,386 @@
+""" Summary tables backing the order statistics
+
+Aggregating the whole order history on each statistics request is
+O(history). These tables keep the aggregates precomputed and are updated
+incrementally, in the same transaction, every time orders or their detail
+lines are flushed, so reading them is O(result size).
+
+`SummariesManager.rebuild` recomputes them from scratch and
+`SummariesManager.check` compares them against the source tables.
+"""
+import collections
+
+from sqlalchemy import bindparam, event, func, inspect, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.sql import label
+
+from app import db
+from app.models import (Country, Customer, Order, OrderDetail,
+                        OrderStatusEnum, Product)
+
+
+class ProductSellsSummary(db.Model):
+    """ Units sold of each product, including canceled orders """
+    __tablename__ = 'summary_product_sells'
+    product_id = db.Column(db.Integer, db.ForeignKey(
+        'product.id', ondelete='CASCADE'), primary_key=True)
+    sells = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DeliveredUnitsSummary(db.Model):
+    """ Units of each product delivered to each country """
+    __tablename__ = 'summary_delivered_units'
+    product_id = db.Column(db.Integer, db.ForeignKey(
+        'product.id', ondelete='CASCADE'), primary_key=True)
+    country_id = db.Column(db.Integer, db.ForeignKey(
+        'country.id', ondelete='CASCADE'), primary_key=True, index=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+
+
+class OrderStatusSummary(db.Model):
+    """ How many orders are in each status """
+    __tablename__ = 'summary_order_status'
+    status = db.Column(db.Enum(OrderStatusEnum, validate_strings=True),
+                       primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+def _sells_select():
+    return (
+        select([OrderDetail.product_id, func.sum(OrderDetail.quantity)])
+        .group_by(OrderDetail.product_id)
+    )
+
+
+def _delivered_select():
+    return (
+        select([OrderDetail.product_id, Customer.country_id,
+                func.sum(OrderDetail.quantity)])
+        .select_from(OrderDetail.__table__.join(Order).join(Customer))
+        .where(Order.status == OrderStatusEnum.DELIVERED)
+        .group_by(OrderDetail.product_id, Customer.country_id)
+    )
+
+
+def _status_select():
+    return (
+        select([Order.status, func.count(Order.id)])
+        .group_by(Order.status)
+    )
+
+
+# (summary model, key columns, value column, source aggregate)
+SUMMARIES = (
+    (ProductSellsSummary, ('product_id',), 'sells', _sells_select),
+    (DeliveredUnitsSummary, ('product_id', 'country_id'), 'units',
+     _delivered_select),
+    (OrderStatusSummary, ('status',), 'count', _status_select),
+)
+
+
+def _committed(obj, attr):
+    """ Value of `attr` before the current flush """
+    history = inspect(obj).attrs[attr].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, attr)
+
+
+def _keep_history(target, value, oldvalue, initiator):
+    pass
+
+
+# Attributes the summaries and rollups need the value before the flush of:
+# when they are set while expired, as after a commit, their previous value
+# is loaded so that their history has it
+for _attribute in (Order.status, Order.created_at, Order.customer_id,
+                   OrderDetail.order_id, OrderDetail.product_id,
+                   OrderDetail.quantity, OrderDetail.unit_price,
+                   Customer.country_id):
+    event.listen(_attribute, 'set', _keep_history, active_history=True)
+
+
+def increment_rows(connection, table, keys, rows):
+    """ Adds the values of `rows`, dicts of the `keys` columns and of the
+        columns to increment, to the rows of `table` with the same keys,
+        inserting the missing ones, see upsert_rows """
+    upsert_rows(connection, table, keys, rows, increment=True)
+
+
+def upsert_rows(connection, table, keys, rows, increment=False):
+    """ Sets the other columns of `rows`, dicts of the `keys` columns and
+        of the other columns, in the rows of `table` with the same keys,
+        inserting the missing ones. With `increment` the values are added
+        to the existing ones instead.
+
+        On PostgreSQL and SQLite 3.24+ this is a single INSERT ... ON
+        CONFLICT DO UPDATE statement, executed for all the rows at once:
+        transactions inserting the same new row concurrently wait for each
+        other instead of failing on the primary key. Other databases update
+        each row, then insert it in a savepoint when it doesn't exist and
+        update it again if a concurrent transaction inserted it first """
+    columns = [c for c in rows[0] if c not in keys]
+    dialect = connection.dialect
+    if dialect.name == 'postgresql':
+        insert = postgresql.insert(table)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[table.c[k] for k in keys],
+            set_={c: table.c[c] + insert.excluded[c] if increment
+                  else insert.excluded[c] for c in columns}),
+            rows)
+    elif dialect.name == 'sqlite' and \
+            dialect.dbapi.sqlite_version_info >= (3, 24):
+        # SQLAlchemy has no SQLite upsert construct yet
+        quote = dialect.identifier_preparer.quote
+        names = list(keys) + columns
+        assignment = ('{0} = {0} + excluded.{0}' if increment
+                      else '{0} = excluded.{0}')
+        statement = text(
+            'INSERT INTO {} ({}) VALUES ({}) '
+            'ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                dialect.identifier_preparer.format_table(table),
+                ', '.join(quote(n) for n in names),
+                ', '.join(':' + n for n in names),
+                ', '.join(quote(k) for k in keys),
+                ', '.join(assignment.format(quote(c)) for c in columns))
+        ).bindparams(*[bindparam(n, type_=table.c[n].type) for n in names])
+        connection.execute(statement, rows)
+    else:
+        for row in rows:
+            update = table.update().where(db.and_(*[
+                table.c[k] == row[k] for k in keys])).values(
+                    {c: table.c[c] + row[c] if increment else row[c]
+                     for c in columns})
+            if connection.execute(update).rowcount:
+                continue
+            try:
+                with connection.begin_nested():
+                    connection.execute(table.insert().values(row))
+            except IntegrityError:
+                connection.execute(update)
+
+
+class SummaryDelta:
+    """ Increments to apply to the summary tables, keyed like the
+        summary rows """
+
+    def __init__(self):
+        self.counters = {model: collections.Counter()
+                         for model, _, _, _ in SUMMARIES}
+
+    def add(self, model, key, value):
+        if value:
+            self.counters[model][key] += value
+
+    def __bool__(self):
+        return any(any(c.values()) for c in self.counters.values())
+
+    def apply(self, connection):
+        """ Adds the increments to the summary rows, creating the rows
+            that don't exist yet, see increment_rows """
+        for model, keys, column, _ in SUMMARIES:
+            rows = sorted(
+                (dict(zip(keys, key if len(keys) > 1 else (key,)),
+                      **{column: value})
+                 for key, value in self.counters[model].items() if value),
+                key=lambda row: repr([row[k] for k in keys]))
+            if rows:
+                increment_rows(connection, model.__table__, keys, rows)
+
+    @classmethod
+    def from_flush(cls, session):
+        """ Computes the increments caused by the objects being flushed.
+            Must be called from after_flush, when rows are already written
+            but session.new/dirty/deleted and attribute history still
+            describe the flush """
+        delta = cls()
+        statuses = delta.counters[OrderStatusSummary]
+        # order id -> (status before the flush, status after the flush)
+        transitions = {}
+        # (order id, product id, quantity, counted with the old status)
+        lines = []
+        touched_lines = set()
+        customers_moved = []
+        for obj in session.new:
+            if isinstance(obj, Order):
+                statuses[obj.status] += 1
+                transitions[obj.id] = (None, obj.status)
+            elif isinstance(obj, OrderDetail):
+                lines.append((obj.order_id, obj.product_id, obj.quantity,
+                              False))
+                touched_lines.add(obj.id)
+        for obj in session.dirty:
+            if isinstance(obj, Order):
+                old = _committed(obj, 'status')
+                if old != obj.status:
+                    statuses[old] -= 1
+                    statuses[obj.status] += 1
+                    transitions[obj.id] = (old, obj.status)
+            elif isinstance(obj, OrderDetail):
+                # Modified lines are accounted as removed and added again
+                lines.append((_committed(obj, 'order_id'),
+                              _committed(obj, 'product_id'),
+                              -_committed(obj, 'quantity'), True))
+                lines.append((obj.order_id, obj.product_id, obj.quantity,
+                              False))
+                touched_lines.add(obj.id)
+            elif isinstance(obj, Customer):
+                old = _committed(obj, 'country_id')
+                if old != obj.country_id:
+                    customers_moved.append((obj.id, old, obj.country_id))
+        for obj in session.deleted:
+            if isinstance(obj, Order):
+                statuses[_committed(obj, 'status')] -= 1
+            elif isinstance(obj, OrderDetail):
+                lines.append((_committed(obj, 'order_id'),
+                              _committed(obj, 'product_id'),
+                              -_committed(obj, 'quantity'), True))
+
+        sells = delta.counters[ProductSellsSummary]
+        for _, product_id, quantity, _ in lines:
+            sells[product_id] += quantity
+
+        delivered = DeliveredUnitsSummary
+        # order id -> +1 when the order was delivered, -1 when it stops
+        # being delivered
+        delivered_changes = {
+            order_id: 1 if new == OrderStatusEnum.DELIVERED else -1
+            for order_id, (old, new) in transitions.items()
+            if (old == OrderStatusEnum.DELIVERED) !=
+            (new == OrderStatusEnum.DELIVERED)
+        }
+        order_ids = {line[0] for line in lines} | set(delivered_changes)
+        if order_ids:
+            orders = _orders_status_country(session, order_ids)
+            for order_id, product_id, quantity, old in lines:
+                if order_id not in orders:
+                    continue
+                status, country_id = orders[order_id]
+                if old:
+                    status = transitions.get(order_id, (status,))[0]
+                if status == OrderStatusEnum.DELIVERED:
+                    delta.add(delivered, (product_id, country_id), quantity)
+            # Lines already in the order before the flush follow its status
+            for order_id, sign in delivered_changes.items():
+                if order_id not in orders:
+                    continue
+                q = (
+                    select([OrderDetail.product_id,
+                            func.sum(OrderDetail.quantity)])
+                    .where(OrderDetail.order_id == order_id)
+                    .group_by(OrderDetail.product_id)
+                )
+                if touched_lines:
+                    q = q.where(OrderDetail.id.notin_(touched_lines))
+                for product_id, units in session.execute(q):
+                    delta.add(delivered, (product_id, orders[order_id][1]),
+                              sign * units)
+
+        for customer_id, old_country, new_country in customers_moved:
+            q = (
+                select([OrderDetail.product_id,
+                        func.sum(OrderDetail.quantity)])
+                .select_from(OrderDetail.__table__.join(Order))
+                .where(Order.customer_id == customer_id)
+                .where(Order.status == OrderStatusEnum.DELIVERED)
+                .group_by(OrderDetail.product_id)
+            )
+            for product_id, units in session.execute(q):
+                delta.add(delivered, (product_id, old_country), -units)
+                delta.add(delivered, (product_id, new_country), units)
+        return delta
+
+
+def _orders_status_country(session, order_ids):
+    """ order id -> (current status, customer country id) """
+    q = (
+        select([Order.id, Order.status, Customer.country_id])
+        .select_from(Order.__table__.join(Customer))
+        .where(Order.id.in_(order_ids))
+    )
+    return {row[0]: (row[1], row[2]) for row in session.execute(q)}
+
+
+@event.listens_for(Session, 'after_flush')
+def update_summaries(session, flush_context):
+    delta = SummaryDelta.from_flush(session)
+    if delta:
+        delta.apply(session.connection())
+
+
+class SummariesManager:
+    @staticmethod
+    def sells_by_product():
+        """ Returns a list of (product, sells) """
+        product = aliased(Product, name='product')
+        return (
+            db.session.query(
+                product,
+                label('sells', func.coalesce(ProductSellsSummary.sells, 0))
+            )
+            .outerjoin(ProductSellsSummary,
+                       ProductSellsSummary.product_id == product.id)
+            .all()
+        )
+
+    @staticmethod
+    def units_delivered_by_product_by_country():
+        """ Returns a list a of (product, country, units) """
+        return (
+            db.session.query(
+                label('product_name', Product.name),
+                label('product_id', Product.id),
+                label('country_name', Country.name),
+                label('country_id', Country.id),
+                label('units', DeliveredUnitsSummary.units)
+            )
+            .select_from(DeliveredUnitsSummary)
+            .join(Product, Product.id == DeliveredUnitsSummary.product_id)
+            .join(Country, Country.id == DeliveredUnitsSummary.country_id)
+            .filter(DeliveredUnitsSummary.units > 0)
+            .all()
+        )
+
+    @staticmethod
+    def count_by_status():
+        """ Returns a list of (OrderStatusEnum, count) """
+        return (
+            db.session.query(
+                label('status', OrderStatusSummary.status),
+                label('count', OrderStatusSummary.count)
+            )
+            .filter(OrderStatusSummary.count > 0)
+            .all()
+        )
+
+    @staticmethod
+    def rebuild():
+        """ Recomputes all the summary tables from the order history """
+        for model, keys, column, source in SUMMARIES:
+            table = model.__table__
+            db.session.execute(table.delete())
+            db.session.execute(table.insert().from_select(
+                list(keys) + [column], source()))
+
+    @staticmethod
+    def check():
+        """ Compares the summary tables against the order history.
+            Returns a list of (table, key, expected, actual) for each
+            mismatching row """
+        errors = []
+        for model, keys, column, source in SUMMARIES:
+            table = model.__table__
+            expected = {tuple(row[:-1]): row[-1]
+                        for row in db.session.execute(source())}
+            actual = {
+                tuple(row[:-1]): row[-1]
+                for row in db.session.execute(select(
+                    [table.c[k] for k in keys] + [table.c[column]]))
+            }
+            for key in sorted(set(expected) | set(actual), key=repr):
+                if expected.get(key, 0) != actual.get(key, 0):
+                    errors.append((table.name, key, expected.get(key, 0),
+                                   actual.get(key, 0)))
+        return errors
@@ -1,7 +1,8 @@
 import pytest
 
-from app import create_app
+from app import cache, create_app
 from app import db
+from app.reference import references
 
 pytest_plugins = [
     "app.tests.factories",
@@ -30,3 +31,26 @@ def _db(app):
     db.drop_all()
     db.create_all()
     return db
+
+
+@pytest.fixture
+def isolated_app(tmpdir):
+    """ App on its own database, outside of the test transaction, for the
+        tests of rollbacks and deletions, which the test transaction
+        doesn't support. Tests using it can't use db_session """
+    _app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI':
+                       'sqlite:///' + str(tmpdir.join('isolated.db'))})
+    db.session.remove()
+    with _app.app_context():
+        db.create_all()
+        yield _app
+        db.session.remove()
+        db.get_engine(_app).dispose()
+
+
+@pytest.fixture(autouse=True)
+def _clear_cache(app):
+    """ Each test rolls back its data without committing, which the
+        response cache can't notice """
+    cache.clear()
+    references.clear()
@@ -0,0 +1,27 @@
+from app.advisor import MANAGER_QUERIES, advise, sequential_scans
+
+
+def test_sequential_scans():
+    """ Full scans are told apart from index scans """
+    sqlite_plan = ['SCAN country', 'SCAN TABLE product',
+                   'SCAN customer USING COVERING INDEX ix_customer_country_id',
+                   'SEARCH order_detail USING INDEX ix_order_detail_order_id']
+    assert sequential_scans('sqlite', sqlite_plan) == ['country', 'product']
+    postgresql_plan = [
+        'Hash Join  (cost=1.09..2.24 rows=8 width=12)',
+        '  ->  Seq Scan on customer  (cost=0.00..1.08 rows=8 width=8)',
+        '  ->  Index Scan using ix_order_customer_id on "order"',
+    ]
+    assert sequential_scans('postgresql', postgresql_plan) == ['customer']
+
+
+def test_advise(order_factory, db_session):
+    """ Every manager query is explained, joins use the indexes """
+    order_factory.create_batch(3, details=2)
+    db_session.commit()
+    report = advise()
+    assert {name for name, _, _, _ in report} == {
+        q.__qualname__ for q in MANAGER_QUERIES}
+    for name, statement, plan, scans in report:
+        assert plan
+        assert 'customer' not in scans and 'order_detail' not in scans
@@ -0,0 +1,117 @@
+import asyncio
+import threading
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+from app import loadtest
+from app.asgi_adapter import WsgiToAsgi
+
+
+def echo_app():
+    app = Flask(__name__)
+
+    @app.route('/echo', methods=['POST'])
+    def echo():
+        return Response(request.get_data(), headers={
+            'X-Query': request.args['q'],
+            'X-Agent': request.headers['User-Agent']})
+
+    @app.route('/stream')
+    def stream():
+        return Response(iter([b'a', b'', b'b']))
+
+    return app
+
+
+def call(application, scope, body_parts=(b'',)):
+    """ Runs an ASGI request, returning the sent messages """
+    messages = [{'type': 'http.request', 'body': part,
+                 'more_body': i < len(body_parts) - 1}
+                for i, part in enumerate(body_parts)]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.get_event_loop().run_until_complete(
+        application(scope, receive, send))
+    return sent
+
+
+def http_scope(method, path, query=b'', headers=()):
+    return {'type': 'http', 'method': method, 'path': path,
+            'query_string': query, 'headers': list(headers)}
+
+
+def test_asgi_request():
+    """ Requests reach the WSGI app with their body and headers """
+    application = WsgiToAsgi(echo_app(), max_workers=2)
+    sent = call(application, http_scope(
+        'POST', '/echo', b'q=1', [(b'user-agent', b'test')]),
+        [b'hello ', b'world'])
+    assert sent[0]['status'] == 200
+    headers = dict(sent[0]['headers'])
+    assert headers[b'x-query'] == b'1'
+    assert headers[b'x-agent'] == b'test'
+    assert b''.join(m.get('body', b'') for m in sent[1:]) == b'hello world'
+    assert not sent[-1].get('more_body')
+
+
+def test_asgi_streaming():
+    """ Chunks are sent as the app yields them """
+    sent = call(WsgiToAsgi(echo_app()), http_scope('GET', '/stream'))
+    assert [m['body'] for m in sent[1:]] == [b'a', b'b', b'']
+
+
+def test_asgi_api(app):
+    """ The api is served through the adapter """
+    sent = call(WsgiToAsgi(app), http_scope('GET', '/api/statistics/cache'))
+    assert sent[0]['status'] == 200
+    assert sent[1]['body'].startswith(b'{')
+
+
+def test_lifespan():
+    """ Startup and shutdown are acknowledged """
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.get_event_loop().run_until_complete(
+        WsgiToAsgi(echo_app())({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete',
+                    'lifespan.shutdown.complete']
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([3], 95) == 3
+    assert loadtest.percentile([], 50) is None
+
+
+def test_loadtest():
+    """ Load test of a local server """
+    server = make_server('127.0.0.1', 0, echo_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_port
+        results = loadtest.run(url, ['/stream', '/missing'], concurrency=3,
+                               requests=10)
+    finally:
+        server.shutdown()
+        thread.join()
+    assert results['/stream']['requests'] == 10
+    assert results['/stream']['errors'] == 0
+    assert results['/missing']['errors'] == 10
+    assert results['/stream']['p50'] <= results['/stream']['p99']
@@ -0,0 +1,80 @@
+import datetime
+
+from app import benchmark
+from app.models import OrdersManager, OrderStatusEnum
+from app.seeding import DatasetGenerator, copy_data, scaled_sizes
+from app.summaries import SummariesManager
+
+SIZES = {'countries': 3, 'categories': 2, 'tags': 4, 'products': 10,
+         'customers': 5, 'orders': 20}
+
+
+def test_generate_dataset(db_session):
+    """ Generated datasets are consistent and follow the existing rows """
+    counts = DatasetGenerator(SIZES, lines=3, seed=1, batch_size=7).run()
+    assert counts['order'] == 20
+    assert counts['product_tag'] == 30
+    assert 20 <= counts['order_detail'] <= 100
+    assert OrdersManager.check_totals() == []
+    assert SummariesManager.check() == []
+    more = DatasetGenerator(SIZES, lines=3).run()
+    assert more['order'] == 20
+    assert OrdersManager.check_totals() == []
+    assert SummariesManager.check() == []
+
+
+def test_dataset_seed():
+    """ The same seed generates the same rows """
+    def products(seed):
+        return [(p['price'], p['category_id'], p['status'])
+                for p in DatasetGenerator(SIZES, seed=seed).products()]
+    assert products(1) == products(1)
+    assert products(1) != products(2)
+
+
+def test_api_paths(app, customer_factory, db_session):
+    """ Every GET endpoint, records requested by an existing id """
+    customer = customer_factory.create()
+    db_session.commit()
+    paths = benchmark.api_paths(app)
+    assert '/api/customers' in paths
+    assert '/api/customers/%d' % customer.id in paths
+    assert '/api/statistics/sells_by_product' in paths
+    assert '/api/products/search?q=product' in paths
+    assert '/api/customers/export' not in paths
+    assert not any(p.startswith('/api/orders/') for p in paths)
+
+
+def test_compare():
+    """ Slower, lower throughput or more SQL statements are regressions """
+    baseline = {
+        '/a': {'p95': 0.1, 'throughput': 100, 'sql_statements': 2},
+        '/b': {'p95': 0.1, 'throughput': 100, 'sql_statements': 2},
+    }
+    results = {
+        '/a': {'p95': 0.11, 'throughput': 90, 'sql_statements': 2},
+        '/b': {'p95': 0.2, 'throughput': 50, 'sql_statements': 3},
+        '/c': {'p95': 1, 'throughput': 1, 'sql_statements': 9},
+    }
+    assert benchmark.compare(baseline, results) == [
+        ('/b', 'p95', 0.1, 0.2),
+        ('/b', 'throughput', 100, 50),
+        ('/b', 'sql_statements', 2, 3),
+    ]
+
+
+def test_scaled_sizes():
+    """ Sizes grow with the scale, reference tables up to a maximum """
+    assert scaled_sizes(1)['orders'] == 50
+    assert scaled_sizes(100)['orders'] == 5000
+    assert scaled_sizes(100)['countries'] == 200
+    assert scaled_sizes(0.01)['products'] == 1
+
+
+def test_copy_data():
+    """ COPY rows are CSV, enums by name and None as NULL """
+    data = copy_data(['id', 'status', 'created_at', 'price'], [
+        {'id': 1, 'status': OrderStatusEnum.PAYED, 'price': None,
+         'created_at': datetime.datetime(2020, 1, 2, 3, 4, 5)},
+    ])
+    assert data.read() == '1,PAYED,2020-01-02 03:04:05,\n'
@@ -0,0 +1,82 @@
+from flask import json
+from app import cache, db, models
+from app.cache import LocalSharedStore, LRUBackend, SharedBackend
+
+from .utils import FakeClock, category_to_dict
+
+
+def test_lru_expiration():
+    """ LRU entries expire after their ttl """
+    clock = FakeClock()
+    backend = LRUBackend(clock=clock)
+    backend.set('a', 1, ttl=5)
+    backend.set('b', 2)
+    clock.now = 4
+    assert backend.get('a') == 1
+    clock.now = 5
+    assert backend.get('a') is None
+    assert backend.get('b') == 2
+
+
+def test_lru_eviction():
+    """ Least recently used entries are evicted first """
+    backend = LRUBackend(max_entries=2)
+    backend.set('a', 1)
+    backend.set('b', 2)
+    backend.get('a')
+    backend.set('c', 3)
+    assert backend.get('b') is None
+    assert backend.get('a') == 1
+    assert backend.get('c') == 3
+
+
+def test_shared_backend():
+    """ Shared backend pickles values into the store """
+    clock = FakeClock()
+    store = LocalSharedStore(clock=clock)
+    backend = SharedBackend(store)
+    backend.set('a', (b'body', 200, 'application/json'), ttl=5)
+    assert SharedBackend(store).get('a') == (b'body', 200, 'application/json')
+    clock.now = 5
+    assert backend.get('a') is None
+
+
+def test_cached_statistics(client, category_factory, product_factory):
+    """ Statistics responses are cached until a related model changes """
+    category = category_factory.create()
+    product_factory.create_batch(3, category=category)
+    name = 'app.restapi.statistics.products_by_category'
+    hits, misses = cache.hits[name], cache.misses[name]
+    rv = client.get('/api/statistics/products_by_category')
+    data = json.loads(rv.data)
+    assert json.loads(
+        client.get('/api/statistics/products_by_category').data) == data
+    assert (cache.hits[name], cache.misses[name]) == (hits + 1, misses + 1)
+    product_factory.create(category=category)
+    data = json.loads(
+        client.get('/api/statistics/products_by_category').data)
+    assert {'category': category_to_dict(category), 'count': 4} in data
+    assert cache.misses[name] == misses + 2
+    stats = json.loads(client.get('/api/statistics/cache').data)
+    assert stats['hits'][name] == cache.hits[name]
+
+
+def test_savepoint_rollback(isolated_app):
+    """ Rolling back a savepoint doesn't forget the models written by the
+        enclosing transaction, its commit invalidates their views """
+    client = isolated_app.test_client()
+    category = models.Category(name='Category')
+    db.session.add(category)
+    db.session.commit()
+    url = '/api/statistics/products_by_category'
+    assert [c['count'] for c in json.loads(client.get(url).data)] == [0]
+    db.session.add(models.Product(name='Product', category=category,
+                                  status=models.ProductStatusEnum.ACTIVE))
+    db.session.flush()
+    db.session.begin_nested()
+    db.session.add(models.Country(name='Country'))
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    assert models.Country.query.count() == 0
+    assert [c['count'] for c in json.loads(client.get(url).data)] == [1]
@@ -0,0 +1,65 @@
+from app import db
+from app.models import (CustomersManager, Order, OrdersManager, Product,
+                        ProductsManager)
+from app.restapi import schemas
+from app.restapi.compiled import compile_schema
+from app.restapi.cruds import OrdersView, ProductsView
+
+
+def projection_records(view, key):
+    projection = view.Meta.list_projection
+    rows = projection.query(db.session).order_by(key).all()
+    return projection.records(db.session, rows)
+
+
+def assert_parity(schema, objects):
+    """ The compiled dump returns the same data as marshmallow """
+    dump = compile_schema(schema)
+    assert [schema.dump(o) for o in objects] == [dump(o) for o in objects]
+
+
+def test_reference_schemas(category_factory, country_factory):
+    """ Category and country schemas parity """
+    assert_parity(schemas.CategorySchema(), category_factory.create_batch(3))
+    assert_parity(schemas.CountrySchema(), country_factory.create_batch(3))
+
+
+def test_customer_schema(customer_factory):
+    """ Customer schema parity, with its nested country """
+    assert_parity(schemas.CustomerSchema(), customer_factory.create_batch(3))
+
+
+def test_product_schema(product_factory):
+    """ Product schema parity, including null values """
+    products = product_factory.create_batch(3)
+    products.append(product_factory.create(description=None, price=None,
+                                           tags=[]))
+    assert_parity(schemas.ProductSchema(), products)
+    assert_parity(schemas.ProductSchema(only=('id', 'name')), products)
+    assert_parity(schemas.ProductSchema(),
+                  projection_records(ProductsView, Product.id))
+
+
+def test_order_schemas(order_factory, db_session):
+    """ Order schemas parity, for orders and list records """
+    orders = order_factory.create_batch(3, details=2)
+    orders.append(order_factory.create())
+    db_session.commit()
+    assert_parity(schemas.OrderSchema(), orders)
+    assert_parity(schemas.OrderDetailSchema(), orders[0].detail)
+    assert_parity(schemas.OrdersListSchema(),
+                  projection_records(OrdersView, Order.id))
+
+
+def test_statistics_schemas(order_factory, db_session):
+    """ Statistics schemas parity, they dump query rows """
+    order_factory.create_batch(3, details=2)
+    db_session.commit()
+    assert_parity(schemas.ProductsByCategorySchema(),
+                  ProductsManager.count_by_category())
+    assert_parity(schemas.CustomersByCountrySchema(),
+                  CustomersManager.count_by_country())
+    assert_parity(schemas.OrdersByStatusSchema(),
+                  OrdersManager.count_by_status())
+    assert_parity(schemas.SellsByProductSchema(),
+                  ProductsManager.sells_by_product())
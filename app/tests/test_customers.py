@@ -1,6 +1,10 @@
 from flask import json
 from app import models
-from .utils import model_to_dict, expected_404, expected_integrity_error
+from app.reference import references
+from app.restapi.export import csv_lines
+from app.restapi.schemas import CustomerSchema
+from .utils import (assert_max_queries, model_to_dict, expected_404,
+                    expected_integrity_error)
 
 
 def test_get(client, customer_factory):
@@ -36,6 +40,29 @@ def test_list(client, customer_factory):
         data, key=lambda c: c['id'])
 
 
+def test_list_queries(client, customer_factory):
+    """ Listing customers doesn't issue queries per customer. Countries
+        come from the reference data cache """
+    customer_factory.create_batch(20)
+    references.warm()
+    with assert_max_queries(1):
+        rv = client.get('/api/customers')
+    assert len(json.loads(rv.data)) == 20
+
+
+def test_list_by_country(client, customer_factory, country_factory):
+    """ Filter customers by country """
+    country = country_factory.create()
+    customers = customer_factory.create_batch(3)
+    customers[1].country = country
+    rv = client.get('/api/customers?country={:d}'.format(country.id))
+    assert [c['id'] for c in json.loads(rv.data)] == [customers[1].id]
+    rv = client.get('/api/customers?country__in={:d},{:d}&sort=-id'.format(
+        country.id, customers[2].country.id))
+    assert [c['id'] for c in json.loads(rv.data)] == [
+        customers[2].id, customers[1].id]
+
+
 def test_list_limit_offset(client, customer_factory):
     """ List a range of customers """
     customers = customer_factory.create_batch(10)
@@ -143,3 +170,18 @@ def test_customer_delete_404(client, customer_factory):
     assert rv.status_code == 404
     data = json.loads(rv.data)
     assert expected_404 == data
+
+
+def test_export_csv_columns():
+    """ The CSV columns come from the schema, not from the first record """
+    records = [
+        {'id': 1, 'email': 'a@example.com', 'firstname': 'A',
+         'lastname': 'B', 'country': None},
+        {'id': 2, 'email': 'c@example.com', 'firstname': 'C',
+         'lastname': 'D', 'country': {'id': 3, 'name': 'Country'}},
+    ]
+    assert ''.join(csv_lines(records, CustomerSchema)).splitlines() == [
+        'country.id,country.name,email,firstname,id,lastname',
+        ',,a@example.com,A,1,B',
+        '3,Country,c@example.com,C,2,D',
+    ]
@@ -0,0 +1,78 @@
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+from app import db
+from app.database import InstrumentedQueuePool
+from app.metrics import POOL_CHECKOUT_WAIT
+
+
+def engine_options(app, monkeypatch, uri, **config):
+    for key, value in config.items():
+        monkeypatch.setitem(app.config, key, value)
+    options = {}
+    db.apply_pool_defaults(app, options)
+    db.apply_driver_hacks(app, make_url(uri), options)
+    return options
+
+
+def test_postgresql_options(app, monkeypatch):
+    """ Pool and statement timeout options for PostgreSQL """
+    options = engine_options(
+        app, monkeypatch, 'postgresql://shop@db/shop',
+        SQLALCHEMY_POOL_SIZE=3, SQLALCHEMY_POOL_PRE_PING=True,
+        SQLALCHEMY_STATEMENT_TIMEOUT=500,
+        SQLALCHEMY_ENGINE_OPTIONS={
+            'connect_args': {'application_name': 'shop'}})
+    assert options['poolclass'] is InstrumentedQueuePool
+    assert options['pool_size'] == 3
+    assert options['pool_pre_ping']
+    assert options['connect_args'] == {
+        'application_name': 'shop',
+        'options': '-c statement_timeout=500'}
+
+
+def test_external_pooler(app, monkeypatch):
+    """ External pooler mode doesn't keep connections """
+    options = engine_options(
+        app, monkeypatch, 'postgresql://shop@db/shop',
+        SQLALCHEMY_POOL_SIZE=3, SQLALCHEMY_MAX_OVERFLOW=2,
+        SQLALCHEMY_EXTERNAL_POOLER=True)
+    assert options['poolclass'] is NullPool
+    assert 'pool_size' not in options
+    assert 'max_overflow' not in options
+
+
+def test_checkout_wait(tmpdir):
+    """ Checkouts record their wait """
+    engine = create_engine('sqlite:///%s' % tmpdir.join('pool.db'),
+                           poolclass=InstrumentedQueuePool)
+    _, _, before = POOL_CHECKOUT_WAIT.samples()
+    engine.connect().close()
+    engine.connect().close()
+    assert POOL_CHECKOUT_WAIT.samples()[2] == before + 2
+
+
+def test_forked_connections(tmpdir, monkeypatch):
+    """ Connections opened by another process are replaced """
+    engine = create_engine('sqlite:///%s' % tmpdir.join('pool.db'),
+                           poolclass=InstrumentedQueuePool)
+    conn = engine.connect()
+    parent = conn.connection.connection
+    conn.close()
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    conn = engine.connect()
+    assert conn.connection.connection is not parent
+    assert conn.execute('select 1').scalar() == 1
+    conn.close()
+
+
+def test_reset_pools(app, db_session):
+    """ Engines keep working with new pools """
+    pool = db.engine.pool
+    db.reset_pools(app)
+    assert db.engine.pool is not pool
+    assert db.engine.execute('select 1').scalar() == 1
@@ -0,0 +1,169 @@
+import datetime
+
+import pytest
+from flask import json
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db, models
+from app.idempotency import (IdempotencyKey, IdempotencyManager,
+                             request_hash)
+from app.placement import PlacementManager
+
+from .utils import assert_max_queries
+
+
+def post(client, url, data, key):
+    return client.post(url, data=json.dumps(data),
+                       content_type='application/json',
+                       headers={'Idempotency-Key': key})
+
+
+def order_request(customer_factory, product_factory):
+    customer = customer_factory.create()
+    products = product_factory.create_batch(2)
+    return {'customer': customer.id,
+            'detail': [{'product': p.id, 'quantity': 1} for p in products]}
+
+
+def test_retry(client, customer_factory, product_factory):
+    """ Retries return the response of the first request without creating
+        anything """
+    req = order_request(customer_factory, product_factory)
+    rv = post(client, '/api/orders', req, 'order-1')
+    assert rv.status_code == 201
+    assert 'Idempotent-Replayed' not in rv.headers
+    with assert_max_queries(1):
+        retry = post(client, '/api/orders', req, 'order-1')
+    assert retry.status_code == 201
+    assert retry.data == rv.data
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert models.Order.query.count() == 1
+    assert models.OrderDetail.query.count() == 2
+    other = post(client, '/api/orders', req, 'order-2')
+    assert other.status_code == 201
+    assert other.data != rv.data
+
+
+def test_bulk_retry(client, country_factory):
+    """ Bulk creations are idempotent too """
+    country = country_factory.create()
+    items = [{'email': 'c%d@example.com' % i, 'firstname': 'First',
+              'lastname': 'Last', 'country': country.id} for i in range(3)]
+    rv = post(client, '/api/customers/bulk', items, 'customers')
+    retry = post(client, '/api/customers/bulk', items, 'customers')
+    assert retry.status_code == rv.status_code == 201
+    assert retry.data == rv.data
+    assert models.Customer.query.count() == 3
+
+
+def test_key_reuse(client, customer_factory, product_factory):
+    """ Keys can't be reused for another request """
+    req = order_request(customer_factory, product_factory)
+    assert post(client, '/api/orders', req, 'order').status_code == 201
+    req['detail'][0]['quantity'] = 2
+    rv = post(client, '/api/orders', req, 'order')
+    assert rv.status_code == 409
+    assert post(client, '/api/orders', req, '').status_code == 400
+    assert post(client, '/api/orders', req, 'k' * 256).status_code == 400
+    assert models.Order.query.count() == 1
+
+
+def test_in_progress(client, db_session, customer_factory,
+                     product_factory):
+    """ Requests whose key is held by an uncompleted one are conflicts """
+    req = order_request(customer_factory, product_factory)
+    IdempotencyManager.reserve('order', request_hash(
+        'POST', '/api/orders', json.dumps(req).encode()), 60)
+    db_session.commit()
+    rv = post(client, '/api/orders', req, 'order')
+    assert rv.status_code == 409
+    assert 'in progress' in json.loads(rv.data)['message']
+    assert models.Order.query.count() == 0
+
+
+def test_stale_reservation(client, db_session, customer_factory,
+                           product_factory):
+    """ A reservation committed without its response stops blocking the key
+        after IDEMPOTENCY_RESERVATION_TIMEOUT """
+    req = order_request(customer_factory, product_factory)
+    IdempotencyManager.reserve('order', request_hash(
+        'POST', '/api/orders', json.dumps(req).encode()), 60,
+        now=datetime.datetime.now() - datetime.timedelta(seconds=61))
+    db_session.commit()
+    rv = post(client, '/api/orders', req, 'order')
+    assert rv.status_code == 201
+    assert models.Order.query.count() == 1
+
+
+def test_retry_after_failure(isolated_app, monkeypatch):
+    """ The reservation of a request that failed is rolled back with it,
+        the retry creates the records """
+    category = models.Category(name='Category')
+    product = models.Product(name='Product', price=10, category=category,
+                             status=models.ProductStatusEnum.ACTIVE)
+    customer = models.Customer(
+        email='customer@example.com', firstname='First', lastname='Last',
+        country=models.Country(name='Country'))
+    db.session.add_all([product, customer])
+    db.session.commit()
+    req = {'customer': customer.id,
+           'detail': [{'product': product.id, 'quantity': 1}]}
+    client = isolated_app.test_client()
+
+    def place(*args):
+        raise SQLAlchemyError('placement failed')
+    monkeypatch.setattr(PlacementManager, 'place', place)
+    with pytest.raises(SQLAlchemyError):
+        post(client, '/api/orders', req, 'order')
+    assert IdempotencyKey.query.count() == 0
+    monkeypatch.undo()
+    assert post(client, '/api/orders', req, 'order').status_code == 201
+    assert models.Order.query.count() == 1
+
+
+def test_expiry(app, client, customer_factory, product_factory):
+    """ Keys expire after IDEMPOTENCY_KEY_TTL, expired rows are swept """
+    req = order_request(customer_factory, product_factory)
+    assert post(client, '/api/orders', req, 'order').status_code == 201
+    record = IdempotencyKey.query.get('order')
+    ttl = datetime.timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+    assert ttl - datetime.timedelta(seconds=60) < \
+        record.expires_at - datetime.datetime.now() <= ttl
+    later = record.expires_at + datetime.timedelta(seconds=1)
+    assert IdempotencyManager.find('order', later) is None
+    assert IdempotencyManager.sweep(
+        now=record.expires_at - datetime.timedelta(seconds=1)) == 0
+    assert IdempotencyManager.sweep(batch_size=1, now=later) == 1
+    assert IdempotencyKey.query.count() == 0
+    assert post(client, '/api/orders', req, 'order').status_code == 201
+    assert models.Order.query.count() == 2
+
+
+def test_store_failure(isolated_app, monkeypatch):
+    """ The response is stored with the records: when storing it fails
+        nothing is created, and the retry creates them once """
+    category = models.Category(name='Category')
+    product = models.Product(name='Product', price=10, category=category,
+                             status=models.ProductStatusEnum.ACTIVE)
+    customer = models.Customer(
+        email='customer@example.com', firstname='First', lastname='Last',
+        country=models.Country(name='Country'))
+    db.session.add_all([product, customer])
+    db.session.commit()
+    req = {'customer': customer.id,
+           'detail': [{'product': product.id, 'quantity': 1}]}
+    client = isolated_app.test_client()
+
+    def store(*args):
+        raise SQLAlchemyError('store failed')
+    monkeypatch.setattr(IdempotencyManager, 'store', store)
+    assert post(client, '/api/orders', req, 'order').status_code == 400
+    assert models.Order.query.count() == 0
+    assert IdempotencyKey.query.count() == 0
+    monkeypatch.undo()
+    rv = post(client, '/api/orders', req, 'order')
+    assert rv.status_code == 201
+    retry = post(client, '/api/orders', req, 'order')
+    assert retry.status_code == 201
+    assert retry.data == rv.data
+    assert models.Order.query.count() == 1
@@ -0,0 +1,41 @@
+from app import metrics
+from app.metrics import COUNT_BUCKETS, Histogram
+
+
+def test_histogram_buckets():
+    """ Buckets are cumulative and inclusive of their upper bound """
+    histogram = Histogram('h', 'help', buckets=(1, 5))
+    for value in (0.5, 1, 3, 7):
+        histogram.observe(value, endpoint='e')
+    assert histogram.samples(endpoint='e') == ([2, 3, 4], 11.5, 4)
+    assert histogram.samples(endpoint='other') == ([0, 0, 0], 0, 0)
+    assert 'h_bucket{endpoint="e",le="+Inf"} 4' in histogram.expose()
+
+
+def test_endpoint_metrics(client, product_factory, db_session):
+    """ Requests record latency, SQL and serialization per endpoint """
+    product_factory.create_batch(3)
+    db_session.commit()
+    labels = {'endpoint': 'api.products', 'method': 'GET'}
+    _, statements_before, before = metrics.sql_count.samples(**labels)
+    assert client.get('/api/products').status_code == 200
+    _, statements, count = metrics.sql_count.samples(**labels)
+    assert count == before + 1
+    assert statements > statements_before
+    assert metrics.serialization_duration.samples(**labels)[2] == count
+    body = client.get('/metrics').get_data(as_text=True)
+    assert ('http_request_sql_statements_count'
+            '{endpoint="api.products",method="GET"} %d' % count) in body
+    assert 'endpoint="metrics"' not in body
+    assert len(COUNT_BUCKETS) + 1 == body.count(
+        'http_request_sql_statements_bucket{endpoint="api.products"')
+
+
+def test_server_timing(app, client, monkeypatch):
+    """ Server-Timing header is only sent when enabled """
+    assert 'Server-Timing' not in client.get('/api/categories').headers
+    monkeypatch.setitem(app.config, 'METRICS_SERVER_TIMING', True)
+    timing = client.get('/api/categories').headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert 'serialization;dur=' in timing
+    assert 'total;dur=' in timing
@@ -1,9 +1,13 @@
 import random
 
-from app.models import (Customer, CustomersManager, OrdersManager,
-                            OrderStatusEnum, ProductsManager)
+from app import db
+from app.models import (Customer, CustomersManager, NameResolver, Order,
+                        OrdersManager, OrderStatusEnum, ProductsManager, Tag)
+from app.reference import references
 from sqlalchemy.exc import IntegrityError
 
+from .utils import assert_max_queries
+
 
 def test_count_customers_by_country(customer_factory, country_factory):
     """ Test counting customers in all countries """
@@ -47,6 +51,24 @@ def test_customer_email_unique(customer_factory):
     assert False
 
 
+def test_name_resolver(tag_factory, db_session):
+    """ Names are resolved with one select and one insert, ignoring names
+        inserted by others after the select. Known names come from the
+        reference data cache """
+    existing = tag_factory.create(name='existing')
+    db_session.commit()
+    references.warm()
+    resolver = NameResolver(Tag)
+    with assert_max_queries(1):
+        resolver.prefetch(['existing', 'new', 'raced'])
+    db.session.execute(Tag.__table__.insert().values(name='raced'))
+    with assert_max_queries(2):
+        tags = resolver.resolve(['new', 'existing', 'raced', 'new'])
+    assert [t.name for t in tags] == ['new', 'existing', 'raced', 'new']
+    assert tags[1] is existing and tags[0] is tags[3]
+    assert Tag.query.filter(Tag.name.in_(['new', 'raced'])).count() == 2
+
+
 def test_order_total(order_factory, product_factory):
     """ Test order total calculation """
     order = order_factory.create()
@@ -57,6 +79,27 @@ def test_order_total(order_factory, product_factory):
     assert order.total == 2 * 10 + 3 * 15
 
 
+def test_order_stored_totals(order_factory, product_factory, db_session):
+    """ Stored totals follow detail lines changes """
+    order = order_factory.create()
+    product1 = product_factory.create(price=10)
+    product2 = product_factory.create(price=15)
+    order.add_product(product1, 2)
+    order.add_product(product2, 3)
+    assert order.items_count == 5
+    db_session.commit()
+    order.detail[1].quantity = 1
+    order.detail[0].unit_price = 12
+    db_session.commit()
+    db_session.refresh(order)
+    assert (order.total, order.items_count) == (2 * 12 + 15, 3)
+    assert OrdersManager.check_totals() == []
+    db.session.execute(Order.__table__.update().values(total=1))
+    assert [e[0] for e in OrdersManager.check_totals()] == [order.id]
+    OrdersManager.update_totals()
+    assert OrdersManager.check_totals() == []
+
+
 def test_count_orders_by_status(order_factory):
     """ Test orders count by status """
     expected = []
@@ -1,12 +1,15 @@
 import collections
+import csv
 import datetime
+import io
 import random
 
 import dateutil
 from flask import json
-from app import models
+from app import db, models
+from app.summaries import SummariesManager
 
-from .utils import expected_404, model_to_dict
+from .utils import assert_max_queries, expected_404, model_to_dict
 
 
 def order_to_dict(order, fields=None):
@@ -31,6 +34,46 @@ def test_order_get(client, order_factory):
     assert order_to_dict(order2) == data
 
 
+def test_order_get_queries(client, order_factory, db_session):
+    """ Retrieve one order with a single query """
+    order = order_factory.create(details=5)
+    db_session.commit()
+    with assert_max_queries(1):
+        rv = client.get('/api/orders/{:d}'.format(order.id))
+    assert order_to_dict(order) == json.loads(rv.data)
+
+
+def test_order_etag(client, order_factory, db_session):
+    """ Order ETag changes with its detail lines and their products """
+    order = order_factory.create(details=2)
+    db_session.commit()
+    url = '/api/orders/{:d}'.format(order.id)
+    etags = [client.get(url).headers['ETag']]
+    assert client.get(url, headers={'If-None-Match': etags[0]}
+                      ).status_code == 304
+    order.detail[0].product.name = 'Renamed'
+    db_session.commit()
+    etags.append(client.get(url).headers['ETag'])
+    order.detail[1].quantity += 1
+    db_session.commit()
+    etags.append(client.get(url).headers['ETag'])
+    assert len(set(etags)) == 3
+
+
+def test_list_etag(client, order_factory, customer_factory, db_session):
+    """ The ETags computed from the listed rows are the ones conditional
+        requests compute with the versions query """
+    order_factory.create_batch(3, details=2)
+    order_factory.create()
+    customer_factory.create()
+    db_session.commit()
+    for url in ('/api/orders', '/api/orders?after=', '/api/customers',
+                '/api/orders?status=DELIVERED'):
+        etag = client.get(url).headers['ETag']
+        rv = client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304, url
+
+
 def test_get_404(client, order_factory):
     """ Try to retrieve a non existing order """
     order = order_factory.create()
@@ -67,6 +110,82 @@ def test_list_limit_offset(client, order_factory):
 &limit=3'
 
 
+def test_list_after(client, order_factory):
+    """ List orders using keyset pagination """
+    orders = order_factory.create_batch(5, details=2)
+    list_fields = ['id', 'created_at', 'total', 'status',
+                   ('customer', ['id', 'email', 'firstname', 'lastname'])]
+    rv = client.get('/api/orders?after=&limit=2')
+    assert order_to_dict(orders[:2], list_fields) == json.loads(rv.data)
+    rv = client.get(rv.headers['x-next'])
+    assert order_to_dict(orders[2:4], list_fields) == json.loads(rv.data)
+    rv = client.get(rv.headers['x-next'])
+    assert order_to_dict(orders[4:], list_fields) == json.loads(rv.data)
+    assert 'x-next' not in rv.headers
+
+
+def test_list_filters(client, order_factory):
+    """ Filter orders by status and customer, the filters are kept in the
+        next page links """
+    orders = order_factory.create_batch(6)
+    for order in orders[::2]:
+        order.status = models.OrderStatusEnum.PAYED
+    rv = client.get('/api/orders?status=PAYED&limit=2')
+    assert [o['id'] for o in json.loads(rv.data)] == [
+        orders[0].id, orders[2].id]
+    assert rv.headers['x-next'] == 'http://localhost/api/orders?offset=2\
+&limit=2&status=PAYED'
+    rv = client.get(rv.headers['x-next'])
+    assert [o['id'] for o in json.loads(rv.data)] == [orders[4].id]
+    rv = client.get('/api/orders?status__in=PAYED,PENDING&customer={:d}'
+                    .format(orders[1].customer.id))
+    assert [o['id'] for o in json.loads(rv.data)] == [orders[1].id]
+    rv = client.get('/api/orders?status=LOST')
+    assert rv.status_code == 422
+    rv = client.get('/api/orders?created_at=2020-01-01')
+    assert rv.status_code == 422
+
+
+def test_list_sort(client, order_factory, product_factory):
+    """ Sort orders by descending total, paginating with cursors """
+    product = product_factory.create(price=10)
+    orders = order_factory.create_batch(5)
+    for order, quantity in zip(orders, [3, 1, 4, 1, 5]):
+        order.add_product(product, quantity)
+    expected = [orders[4].id, orders[2].id, orders[0].id, orders[3].id,
+                orders[1].id]
+    rv = client.get('/api/orders?sort=-total')
+    assert [o['id'] for o in json.loads(rv.data)] == expected
+    url, ids = '/api/orders?sort=-total&after=&limit=2', []
+    while url is not None:
+        rv = client.get(url)
+        assert rv.status_code == 200
+        ids += [o['id'] for o in json.loads(rv.data)]
+        url = rv.headers.get('x-next')
+    assert ids == expected
+    rv = client.get('/api/orders?sort=created_at')
+    assert rv.status_code == 422
+
+
+def test_export_csv(client, order_factory):
+    """ Export all orders as CSV, nested records use dotted columns """
+    orders = order_factory.create_batch(3, details=2)
+    rv = client.get('/api/orders/export?format=csv')
+    assert rv.mimetype == 'text/csv'
+    lines = rv.get_data(as_text=True)
+    assert lines.splitlines()[0] == (
+        'created_at,customer.email,customer.firstname,customer.id,'
+        'customer.lastname,id,status,total')
+    rows = list(csv.DictReader(io.StringIO(lines)))
+    assert [int(r['id']) for r in rows] == [o.id for o in orders]
+    assert [r['customer.email'] for r in rows] == [
+        o.customer.email for o in orders]
+    assert [r['total'] for r in rows] == [
+        '{:.2f}'.format(o.total) for o in orders]
+    rv = client.get('/api/orders/export?format=xml')
+    assert rv.status_code == 422
+
+
 def test_order_post(client, customer_factory, product_factory):
     """ Create a new order """
     customer = customer_factory.create()
@@ -113,6 +232,125 @@ def test_order_post(client, customer_factory, product_factory):
     assert actual == expect
 
 
+def test_order_post_queries(app, client, customer_factory, product_factory,
+                            monkeypatch):
+    """ Orders are created with the same statements whatever their lines
+        count, and the summaries follow them. The placement stages are
+        timed """
+    monkeypatch.setitem(app.config, 'METRICS_SERVER_TIMING', True)
+    customer = customer_factory.create()
+    products = product_factory.create_batch(20)
+    req = {'customer': customer.id,
+           'detail': [{'product': p.id, 'quantity': 2} for p in products]}
+    client.get('/api/orders')
+    with assert_max_queries(6):
+        rv = client.post('/api/orders', data=json.dumps(req),
+                         content_type='application/json')
+    assert rv.status_code == 201
+    for stage in ('load', 'validate', 'insert', 'aggregates'):
+        assert 'placement_%s;dur=' % stage in rv.headers['Server-Timing']
+    order = models.Order.query.get(int(rv.data))
+    assert order.items_count == 40
+    assert order.total == sum(p.price * 2 for p in products)
+    assert [(d.product, d.quantity) for d in order.detail] == [
+        (p, 2) for p in products]
+    assert SummariesManager.check() == []
+
+
+def test_order_post_unavailable(client, customer_factory, product_factory):
+    """ Orders of unknown customers, unknown or inactive products are
+        rejected """
+    customer = customer_factory.create()
+    product = product_factory.create()
+    inactive = product_factory.create(
+        status=models.ProductStatusEnum.INACTIVE)
+    for req in ({'customer': customer.id + 1,
+                 'detail': [{'product': product.id, 'quantity': 1}]},
+                {'customer': customer.id,
+                 'detail': [{'product': product.id, 'quantity': 1},
+                            {'product': inactive.id, 'quantity': 1}]},
+                {'customer': customer.id,
+                 'detail': [{'product': inactive.id + 1, 'quantity': 1}]}):
+        rv = client.post('/api/orders', data=json.dumps(req),
+                         content_type='application/json')
+        assert rv.status_code == 422
+    assert models.Order.query.count() == 0
+
+
+def test_order_post_empty(client, customer_factory):
+    """ Orders without detail lines are created, with a zero total """
+    customer = customer_factory.create()
+    rv = client.post('/api/orders', data=json.dumps(
+        {'customer': customer.id, 'detail': []}),
+        content_type='application/json')
+    assert rv.status_code == 201
+    order = models.Order.query.get(int(rv.data))
+    assert (order.total, order.items_count, order.detail) == (0, 0, [])
+
+
+def test_order_bulk_post_ndjson(client, customer_factory, product_factory):
+    """ Create many orders sent as NDJSON """
+    customers = customer_factory.create_batch(2)
+    products = product_factory.create_batch(3)
+    items = [{
+        'customer': customers[i % 2].id,
+        'detail': [{'product': p.id, 'quantity': i + 1} for p in products]
+    } for i in range(4)]
+    rv = client.post('/api/orders/bulk',
+                     data='\n'.join(json.dumps(i) for i in items) + '\n',
+                     content_type='application/x-ndjson')
+    assert rv.status_code == 201
+    for id, item in zip(json.loads(rv.data), items):
+        order = models.Order.query.get(id)
+        assert order.customer.id == item['customer']
+        assert [(d.product.id, d.quantity) for d in order.detail] == [
+            (d['product'], d['quantity']) for d in item['detail']]
+    assert SummariesManager.check() == []
+
+
+def test_order_bulk_post_queries(client, customer_factory, product_factory):
+    """ Bulk orders are placed with a fixed number of statements each,
+        whatever their lines count """
+    customer = customer_factory.create()
+    products = product_factory.create_batch(10)
+    items = [{'customer': customer.id,
+              'detail': [{'product': p.id, 'quantity': 1}
+                         for p in products[:n]]} for n in (1, 10)]
+    client.get('/api/orders')
+    with assert_max_queries(12) as statements:
+        rv = client.post('/api/orders/bulk', data=json.dumps(items),
+                         content_type='application/json')
+    assert rv.status_code == 201
+    assert len([s for s in statements
+                if s.startswith('INSERT INTO order_detail')]) == 2
+
+
+def test_order_bulk_post_unavailable(isolated_app):
+    """ Bulk orders with inactive products are rejected, none is created,
+        including the orders placed before the invalid one """
+    category = models.Category(name='Category')
+    products = [models.Product(name=status.name, price=10, category=category,
+                               status=status)
+                for status in (models.ProductStatusEnum.ACTIVE,
+                               models.ProductStatusEnum.INACTIVE)]
+    customer = models.Customer(
+        email='customer@example.com', firstname='First', lastname='Last',
+        country=models.Country(name='Country'))
+    db.session.add_all(products + [customer])
+    db.session.commit()
+    items = [{'customer': customer.id,
+              'detail': [{'product': p.id, 'quantity': 1}]}
+             for p in products]
+    rv = isolated_app.test_client().post(
+        '/api/orders/bulk', data=json.dumps(items),
+        content_type='application/json')
+    assert rv.status_code == 422
+    assert json.loads(rv.data)['errors'] == [
+        {'index': 1, 'errors': {'detail': {'0': {
+            'product': ['Not available.']}}}}]
+    assert models.Order.query.count() == 0
+
+
 def test_order_update(client, order_factory):
     """ Update a order """
     order = order_factory.create()
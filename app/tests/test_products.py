@@ -1,8 +1,14 @@
+import pytest
 from flask import json
 from app import models
+from app.reference import references
+from app.restapi import register_crud_view
+from app.restapi.cruds import ProductsView
+from app.restapi.filtering import Filter, ListSpec
+from app.restapi.schemas import encode_cursor
 
-from .utils import (expected_404, expected_integrity_error, model_to_dict,
-                    product_to_dict)
+from .utils import (assert_max_queries, expected_404,
+                    expected_integrity_error, model_to_dict, product_to_dict)
 
 
 def test_get(client, product_factory):
@@ -23,6 +29,60 @@ def test_get_404(client, product_factory):
     assert expected_404 == data
 
 
+def test_get_etag(client, product_factory, tag_factory, db_session):
+    """ Conditional retrieval of a product """
+    product = product_factory.create()
+    db_session.commit()
+    url = '/api/products/{:d}'.format(product.id)
+    etag = client.get(url).headers['ETag']
+    with assert_max_queries(1):
+        rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 304
+    assert rv.data == b''
+    product.tags.append(tag_factory.create().name)
+    db_session.commit()
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
+def test_list_etag(client, product_factory, db_session):
+    """ Products list ETag changes when a listed product or its category
+        changes """
+    products = product_factory.create_batch(5)
+    db_session.commit()
+    etags = [client.get('/api/products').headers['ETag']]
+    rv = client.get('/api/products', headers={'If-None-Match': etags[0]})
+    assert rv.status_code == 304
+    products[2].category.name = 'Renamed'
+    db_session.commit()
+    etags.append(client.get('/api/products').headers['ETag'])
+    products[3].price += 1
+    db_session.commit()
+    etags.append(client.get('/api/products').headers['ETag'])
+    product_factory.create()
+    etags.append(client.get('/api/products').headers['ETag'])
+    assert len(set(etags)) == 4
+
+
+def test_list_etag_version_order(client, product_factory, db_session):
+    """ Updates getting a version lower than the greatest listed one, from
+        a concurrent transaction or a host with a late clock, change the
+        list ETag """
+    products = product_factory.create_batch(2)
+    db_session.commit()
+    etag = client.get('/api/products').headers['ETag']
+    versions = sorted(p.version for p in products)
+    assert versions[0] + 1 < versions[1]
+    table = models.Product.__table__
+    db_session.execute(table.update().where(
+        table.c.version == versions[0]).values(
+        name='Updated', version=versions[0] + 1))
+    rv = client.get('/api/products', headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert rv.headers['ETag'] != etag
+
+
 def test_list(client, product_factory):
     """ List all products """
     products = product_factory.create_batch(10)
@@ -33,6 +93,17 @@ def test_list(client, product_factory):
         data, key=lambda c: c['id'])
 
 
+def test_list_queries(client, product_factory, db_session):
+    """ Listing products doesn't issue queries per product, categories
+        come from the reference data cache """
+    product_factory.create_batch(20)
+    db_session.commit()
+    references.warm()
+    with assert_max_queries(2):
+        rv = client.get('/api/products')
+    assert len(json.loads(rv.data)) == 20
+
+
 def test_list_limit_offset(client, product_factory):
     """ List a range of products """
     products = product_factory.create_batch(10)
@@ -46,6 +117,91 @@ def test_list_limit_offset(client, product_factory):
 &limit=3'
 
 
+def test_list_after(client, product_factory):
+    """ Walk all products using keyset pagination """
+    products = product_factory.create_batch(7)
+    url = '/api/products?after=&limit=3'
+    data = []
+    while url is not None:
+        rv = client.get(url)
+        assert rv.status_code == 200
+        data += json.loads(rv.data)
+        url = rv.headers.get('x-next')
+    assert product_to_dict(products) == data
+
+
+def test_list_after_invalid(client, product_factory):
+    """ Malformed cursors and mixed pagination modes are rejected """
+    product_factory.create()
+    rv = client.get('/api/products?after=not-a-cursor')
+    assert rv.status_code == 422
+    rv = client.get('/api/products?after=&offset=3')
+    assert rv.status_code == 422
+    for values in ([{}], [None], [[1, 2]], ['abc'], [1, 2], [True]):
+        rv = client.get('/api/products?after=' + encode_cursor(values))
+        assert rv.status_code == 422, values
+    rv = client.get('/api/products?sort=name&after=' + encode_cursor([1]))
+    assert rv.status_code == 422
+
+
+def test_list_filters(client, product_factory, category_factory,
+                      tag_factory):
+    """ Filter products by category, tag and status """
+    category = category_factory.create()
+    tag = tag_factory.create()
+    products = product_factory.create_batch(4)
+    products[0].category = category
+    products[1].rel_tags.append(tag)
+    products[2].rel_tags.append(tag)
+    products[2].status = models.ProductStatusEnum.INACTIVE
+    rv = client.get('/api/products?category={:d}'.format(category.id))
+    assert [p['id'] for p in json.loads(rv.data)] == [products[0].id]
+    rv = client.get('/api/products?tag={:d}&status=ACTIVE'.format(tag.id))
+    assert [p['id'] for p in json.loads(rv.data)] == [products[1].id]
+    rv = client.get('/api/products?tag__in={:d},{:d}&sort=-name'.format(
+        tag.id, tag.id + 1000))
+    assert [p['id'] for p in json.loads(rv.data)] == [
+        p.id for p in sorted(products[1:3], key=lambda p: p.name,
+                             reverse=True)]
+    rv = client.get('/api/products?tag=x')
+    assert rv.status_code == 422
+
+
+def test_unindexed_sort():
+    """ Sorting large collections requires an index """
+    with pytest.raises(ValueError):
+        ListSpec(models.Product, {}, {'price': models.Product.price})
+    assert ListSpec(models.Product, {}, {'price': models.Product.price},
+                    small_collection=True).sort({'sort': '-price'}) == (
+        models.Product.price, True)
+
+    class UnindexedView(ProductsView):
+        class Meta(ProductsView.Meta):
+            sorts = {'price': models.Product.price}
+    with pytest.raises(ValueError):
+        register_crud_view(UnindexedView, 'unindexed')
+
+
+def test_unindexed_filter():
+    """ Filtering large collections requires an index """
+    filters = {'price': Filter(models.Product.price)}
+    with pytest.raises(ValueError):
+        ListSpec(models.Product, filters, {})
+    assert ListSpec(models.Product, filters, {},
+                    small_collection=True).load({'price': '1'})['price'] == 1
+
+
+def test_export(app, client, product_factory, monkeypatch):
+    """ Export all products as NDJSON, in several batches """
+    monkeypatch.setitem(app.config, 'EXPORT_BATCH_SIZE', 3)
+    products = product_factory.create_batch(7)
+    rv = client.get('/api/products/export')
+    assert rv.status_code == 200
+    assert rv.mimetype == 'application/x-ndjson'
+    lines = rv.get_data(as_text=True).splitlines()
+    assert product_to_dict(products) == [json.loads(line) for line in lines]
+
+
 def test_product_post(client, category_factory, product_factory, tag_factory):
     """ Create a new product """
     category = category_factory.create()
@@ -70,6 +226,48 @@ def test_product_post(client, category_factory, product_factory, tag_factory):
     assert product_to_dict(product) == expect
 
 
+def test_product_bulk_post(client, category_factory, tag_factory):
+    """ Create many products at once, sharing new and existing tags """
+    categories = category_factory.create_batch(2)
+    tag_factory.create(name='tag0')
+    req = [{
+        'name': 'product %d' % i,
+        'price': '1.50',
+        'status': 'ACTIVE',
+        'category': categories[i % 2].id,
+        'tags': ['tag0', 'tag1']
+    } for i in range(5)]
+    rv = client.post('/api/products/bulk', data=json.dumps(req),
+                     content_type='application/json')
+    assert rv.status_code == 201
+    ids = json.loads(rv.data)
+    assert len(ids) == 5
+    for id, item in zip(ids, req):
+        product = models.Product.query.get(id)
+        assert product.name == item['name']
+        assert product.category.id == item['category']
+        assert sorted(product.tags) == ['tag0', 'tag1']
+    assert models.Tag.query.filter_by(name='tag1').count() == 1
+
+
+def test_product_bulk_post_invalid(client, category_factory):
+    """ No product is created when any item is invalid """
+    category = category_factory.create()
+    req = [
+        {'name': 'ok', 'status': 'ACTIVE', 'category': category.id,
+         'tags': []},
+        {'name': 'bad', 'status': 'ACTIVE', 'category': category.id + 1,
+         'tags': []},
+    ]
+    rv = client.post('/api/products/bulk', data=json.dumps(req),
+                     content_type='application/json')
+    assert rv.status_code == 422
+    errors = json.loads(rv.data)['errors']
+    assert [e['index'] for e in errors] == [1]
+    assert 'category' in errors[0]['errors']
+    assert models.Product.query.filter_by(name='ok').count() == 0
+
+
 def test_product_post_unique(client, product_factory):
     """ Try to create an already existing product """
     product = product_factory.create()
@@ -0,0 +1,117 @@
+from flask import json
+from app import models, reference
+from app.reference import ReferenceCache, ReferenceVersion, references
+
+from .utils import FakeClock, assert_max_queries
+
+
+def test_rows_from_cache(customer_factory, db_session):
+    """ Once loaded, known rows are read without queries """
+    customer = customer_factory.create()
+    references.warm()
+    with assert_max_queries(0):
+        row = references.row(models.Country, customer.country.id)
+        found = references.find(models.Country, [customer.country.name])
+    assert row.name == customer.country.name
+    assert found == {customer.country.name: customer.country}
+
+
+def test_rename(country_factory, db_session):
+    """ Renames are seen at once by the process that made them, by others
+        after their check interval """
+    country = country_factory.create(name='Old')
+    other = ReferenceCache(check_interval=10, clock=FakeClock())
+    references.warm()
+    other.warm()
+    assert db_session.query(ReferenceVersion).get('country') is None
+    country.name = 'New'
+    db_session.commit()
+    assert db_session.query(ReferenceVersion).get('country') is not None
+    assert references.row(models.Country, country.id).name == 'New'
+    assert other.row(models.Country, country.id).name == 'Old'
+    other.clock.now = 10
+    assert other.row(models.Country, country.id).name == 'New'
+
+
+def test_bump_versions(db_session, monkeypatch):
+    """ Bumping inserts the missing versions rows and updates the others """
+    versions = iter(range(1, 4))
+    monkeypatch.setattr(reference, 'next_version', lambda: next(versions))
+    reference.bump_versions(db_session.connection(), {models.Country})
+    reference.bump_versions(db_session.connection(),
+                            {models.Country, models.Tag})
+    assert dict(db_session.query(ReferenceVersion.name,
+                                 ReferenceVersion.version)) == {
+        'country': 2, 'tag': 3}
+
+
+def test_new_rows(country_factory, db_session):
+    """ Rows created after the cache was loaded are looked up """
+    references.warm()
+    country = country_factory.create()
+    assert references.row(models.Country, country.id).name == country.name
+    assert references.find(models.Country, [country.name]) == {
+        country.name: country}
+    with assert_max_queries(0):
+        references.row(models.Country, country.id)
+    assert references.row(models.Country, country.id + 1) is None
+
+
+def test_pending_rows(db_session):
+    """ Sessions with pending changes to a model don't use its cache """
+    references.warm()
+    country = models.Country(name='Pending')
+    db_session.add(country)
+    db_session.flush()
+    assert references.table(models.Country, db_session) is None
+    assert references.get(models.Country, country.id) is country
+    assert references.table(models.Category, db_session) is not None
+
+
+def test_unknown_reference(client, country_factory):
+    """ Unknown ids and values which aren't ids are validation errors """
+    country = country_factory.create()
+    for value in (1000000, country.id + 0.5, True, 'x', '-1', None):
+        rv = client.post('/api/customers', data=json.dumps({
+            'email': 'unknown@example.com', 'firstname': 'First',
+            'lastname': 'Last', 'country': value}),
+            content_type='application/json')
+        assert rv.status_code == 422, value
+        assert 'country' in json.loads(rv.data)['message']
+    assert models.Customer.query.count() == 0
+
+
+def test_reference_string_id(client, country_factory):
+    """ Ids sent as strings are accepted """
+    country = country_factory.create()
+    rv = client.post('/api/customers', data=json.dumps({
+        'email': 'string@example.com', 'firstname': 'First',
+        'lastname': 'Last', 'country': str(country.id)}),
+        content_type='application/json')
+    assert rv.status_code == 201
+    assert models.Customer.query.get(int(rv.data)).country is country
+
+
+def test_stale_etag(client, customer_factory, db_session):
+    """ Records dumped with stale cached names get the ETag of the cached
+        versions, not a fresher one """
+    customer = customer_factory.create()
+    db_session.commit()
+    url = '/api/customers/{:d}'.format(customer.id)
+    references.warm()
+    etag = client.get(url).headers['ETag']
+    # Renamed by another process, this one didn't reload its copy yet
+    table = models.Country.__table__
+    db_session.execute(table.update().where(
+        table.c.id == customer.country_id).values(
+        name='Renamed', version=models.next_version()))
+    for headers in ({}, {'If-None-Match': etag}):
+        rv = client.get(url, headers=headers)
+        assert rv.status_code == 200
+        assert json.loads(rv.data)['country']['name'] != 'Renamed'
+        assert rv.headers['ETag'] == etag
+    references.clear()
+    rv = client.get(url, headers={'If-None-Match': etag})
+    assert rv.status_code == 200
+    assert json.loads(rv.data)['country']['name'] == 'Renamed'
+    assert rv.headers['ETag'] != etag
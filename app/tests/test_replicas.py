@@ -0,0 +1,89 @@
+import pytest
+
+from app import create_app, db
+from app.models import Country
+from app.replicas import ReplicaRouter
+
+from .utils import FakeClock
+
+
+@pytest.fixture
+def replicated(tmpdir):
+    """ App with a primary and a replica database, plus a replica that
+        can't be opened """
+    uri = 'sqlite:///%s' % tmpdir.join('primary.db')
+    replica_uri = 'sqlite:///%s' % tmpdir.join('replica.db')
+    broken_uri = 'sqlite:///%s' % tmpdir.join('missing', 'replica.db')
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': uri,
+                      'SQLALCHEMY_REPLICA_URIS': [broken_uri, replica_uri]})
+    db.session.remove()
+    with app.app_context():
+        db.create_all()
+        replica = app.extensions['replicas'].engines[1]
+        db.Model.metadata.create_all(replica)
+        replica.execute(Country.__table__.insert().values(
+            name='Replica', version=1))
+        yield app
+        db.session.remove()
+
+
+def country_names(client):
+    return [c['name'] for c in client.get('/api/countries').get_json()]
+
+
+def test_router_round_robin():
+    """ Replicas are used in turn, failed ones skipped until retry """
+    clock = FakeClock()
+    router = ReplicaRouter(['a', 'b', 'c'], retry_after=10, clock=clock)
+    assert router.candidates() == ['a', 'b', 'c']
+    assert router.candidates() == ['b', 'c', 'a']
+    router.mark_failed('c')
+    assert router.candidates() == ['a', 'b']
+    clock.now = 10
+    assert router.candidates() == ['a', 'b', 'c']
+
+
+def test_reads_from_replica(replicated):
+    """ Reads go to a healthy replica, failing ones are marked """
+    client = replicated.test_client()
+    assert country_names(client) == ['Replica']
+    assert country_names(client) == ['Replica']
+    router = replicated.extensions['replicas']
+    assert [router.is_healthy(e) for e in router.engines] == [False, True]
+
+
+def test_read_your_writes(replicated):
+    """ After a write the client reads from the primary """
+    client = replicated.test_client()
+    response = client.post('/api/countries', json={'name': 'Primary'})
+    assert response.status_code == 201
+    assert country_names(client) == ['Primary']
+    assert country_names(replicated.test_client()) == ['Replica']
+
+
+def test_no_healthy_replica(replicated):
+    """ Reads fall back to the primary """
+    router = replicated.extensions['replicas']
+    for engine in router.engines:
+        router.mark_failed(engine)
+    db.session.add(Country(name='Primary'))
+    db.session.commit()
+    assert country_names(replicated.test_client()) == ['Primary']
+
+
+def test_routing_disabled(app):
+    """ Without replicas every query uses the primary """
+    assert app.extensions['replicas'].engines == []
+    assert db.session().get_bind() is db.engine
+
+
+def test_routing_ends_with_transaction(replicated):
+    """ The replica is used until the transaction ends, sessions outliving
+        the request then read from the primary """
+    assert country_names(replicated.test_client()) == ['Replica']
+    assert db.session().replica is None
+    assert Country.query.count() == 0
+    db.session().use_replica(replicated.extensions['replicas'])
+    assert Country.query.count() == 1
+    db.session.commit()
+    assert Country.query.count() == 0
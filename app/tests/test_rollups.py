@@ -0,0 +1,149 @@
+import datetime
+import random
+
+from flask import json
+from app import db
+from app.models import (Category, Country, Customer, Order,
+                        OrderStatusEnum, Product, ProductStatusEnum)
+from app.rollups import (ROLLUPS, DailyProductSales, RollupsManager,
+                         period_start)
+
+from .test_summaries import create_orders
+from .utils import assert_max_queries
+
+
+def test_rollups_follow_order_writes(client, order_factory, product_factory,
+                                     customer_factory, country_factory,
+                                     db_session):
+    """ Rollups are kept up to date when orders change status, their lines
+        change and their customer moves """
+    customers = customer_factory.create_batch(3)
+    products = product_factory.create_batch(4)
+    orders = create_orders(order_factory, customers, products, 12)
+    db_session.commit()
+    assert RollupsManager.check() == []
+    for order in random.sample(orders, 6):
+        rv = client.put('/api/orders/{:d}'.format(order.id),
+                        data=json.dumps({'status': 'PAYED'}),
+                        content_type='application/json')
+        assert rv.status_code == 204
+    assert RollupsManager.check() == []
+    for order in orders:
+        order.status = OrderStatusEnum.SHIPPING
+    db_session.commit()
+    orders[0].detail[0].quantity += 5
+    orders[1].detail[0].product = products[0]
+    orders[2].add_product(products[3], 2)
+    customers[0].country = country_factory.create()
+    db_session.commit()
+    assert RollupsManager.check() == []
+    orders[3].status = OrderStatusEnum.CANCELED
+    db_session.commit()
+    assert RollupsManager.check() == []
+
+
+def test_rollups_follow_deletions(isolated_app):
+    """ Rollups follow lines moving to another order or deleted, orders
+        deleted and orders created at another time, with one upsert per
+        rollup """
+    category = Category(name='Category')
+    products = [Product(name='Product %d' % i, price=10 + i,
+                        category=category, status=ProductStatusEnum.ACTIVE)
+                for i in range(3)]
+    customers = [Customer(email='c%d@example.com' % i, firstname='First',
+                          lastname='Last', country=Country(name=str(i)))
+                 for i in range(2)]
+    orders = []
+    for i in range(4):
+        order = Order(customer=customers[i % 2])
+        for product in products[i % 2:]:
+            order.add_product(product, i + 1)
+        order.status = OrderStatusEnum.PAYED
+        orders.append(order)
+    db.session.add_all(orders)
+    db.session.commit()
+    assert RollupsManager.check() == []
+    orders[0].detail[0].order = orders[1]
+    orders[2].created_at -= datetime.timedelta(days=1, hours=2)
+    with assert_max_queries(12) as statements:
+        db.session.flush()
+    assert len([s for s in statements if 'rollup_' in s]) == len(ROLLUPS)
+    assert RollupsManager.check() == []
+    for obj in orders[3].detail + [orders[3], orders[1].detail[0]]:
+        db.session.delete(obj)
+    db.session.commit()
+    assert RollupsManager.check() == []
+
+
+def test_rebuild_rollups(order_factory, product_factory, customer_factory,
+                         db_session):
+    """ Rebuild fixes rollups out of sync """
+    products = product_factory.create_batch(3)
+    for order in create_orders(order_factory, customer_factory.create_batch(3),
+                               products, 5):
+        order.status = OrderStatusEnum.DELIVERED
+    db_session.commit()
+    db_session.query(DailyProductSales).update({DailyProductSales.units: 0})
+    assert len(RollupsManager.check()) > 0
+    RollupsManager.rebuild()
+    assert RollupsManager.check() == []
+
+
+def test_period_start():
+    monday = datetime.datetime(2026, 10, 12)
+    assert period_start(datetime.datetime(2026, 10, 18), 'week') == monday
+    assert period_start(monday, 'month') == datetime.datetime(2026, 10, 1)
+
+
+def test_sales_endpoint(client, order_factory, product_factory,
+                        customer_factory, db_session):
+    """ Sales by product and country, in hour, day and month buckets """
+    product, other = product_factory.create_batch(2, price=10)
+    customer = customer_factory.create()
+    moments = [datetime.datetime(2026, 9, 30, 10, 15),
+               datetime.datetime(2026, 9, 30, 11, 45),
+               datetime.datetime(2026, 10, 1, 9, 0),
+               datetime.datetime(2026, 10, 2, 9, 0)]
+    for moment in moments:
+        order = order_factory.create(customer=customer)
+        order.created_at = moment
+        order.add_product(product, 2)
+        order.add_product(other, 1)
+        order.status = OrderStatusEnum.PAYED
+    order_factory.create(customer=customer).add_product(product, 5)
+    db_session.commit()
+
+    def sales(**args):
+        rv = client.get('/api/statistics/sales', query_string=args)
+        assert rv.status_code == 200
+        return json.loads(rv.data)
+
+    daily = sales(**{'from': '2026-09-30', 'to': '2026-10-02'})
+    assert [(r['bucket'][:10], r['product']['id'], r['units'], r['revenue'],
+             r['orders']) for r in daily] == [
+        ('2026-09-30', product.id, 4, '40.00', 2),
+        ('2026-09-30', other.id, 2, '20.00', 2),
+        ('2026-10-01', product.id, 2, '20.00', 1),
+        ('2026-10-01', other.id, 1, '10.00', 1),
+    ]
+    hourly = sales(**{'from': '2026-09-30T11:00:00', 'to': '2026-10-01',
+                      'bucket': 'hour', 'by': 'country'})
+    assert [(r['bucket'][:16], r['country']['id'], r['units'], r['orders'])
+            for r in hourly] == [
+        ('2026-09-30T11:00', customer.country.id, 3, 1)]
+    monthly = sales(**{'from': '2026-09-01', 'to': '2026-11-01',
+                       'bucket': 'month', 'by': 'country'})
+    assert [(r['bucket'][:10], r['units'], r['revenue'], r['orders'])
+            for r in monthly] == [('2026-09-01', 6, '60.00', 2),
+                                  ('2026-10-01', 6, '60.00', 2)]
+
+
+def test_sales_arguments(client):
+    """ A valid range is required """
+    rv = client.get('/api/statistics/sales?from=2026-10-02&to=2026-10-01')
+    assert rv.status_code == 422
+    rv = client.get('/api/statistics/sales?from=2026-10-01&to=x')
+    assert rv.status_code == 422
+    rv = client.get('/api/statistics/sales?from=2026-10-01&to=2026-10-02'
+                    '&bucket=year')
+    assert rv.status_code == 422
@@ -0,0 +1,107 @@
+from flask import json
+from app.search import IndexCache, SearchManager
+
+
+def search(client, query):
+    rv = client.get('/api/products/search?' + query)
+    assert rv.status_code == 200
+    return json.loads(rv.data), rv.headers
+
+
+def test_search_ranking(client, product_factory, tag_factory):
+    """ Products matching all the words, name matches first """
+    red = tag_factory.create(name='red')
+    first = product_factory.create(name='Red', description='A red lamp',
+                                   tags=[])
+    by_name = product_factory.create(name='Red chair', tags=[])
+    by_tag = product_factory.create(name='Table', tags=[red.name])
+    by_description = product_factory.create(
+        name='Lamp', description='A red lamp', tags=[])
+    data, _ = search(client, 'q=red')
+    assert data['total'] == 4
+    assert [p['id'] for p in data['results']] == [
+        first.id, by_name.id, by_tag.id, by_description.id]
+    data, _ = search(client, 'q=RED+Lamp')
+    assert [p['id'] for p in data['results']] == [first.id, by_description.id]
+    assert data['results'][0]['tags'] == []
+    data, _ = search(client, 'q=missing')
+    assert data == {'total': 0, 'results': [],
+                    'facets': {'categories': [], 'tags': []}}
+
+
+def test_search_facets(client, product_factory, category_factory,
+                       tag_factory):
+    """ Facets count the matching products of each category and tag, they
+        can be used to narrow the results """
+    chairs = category_factory.create(name='Chairs')
+    tags = tag_factory.create_batch(2)
+    products = product_factory.create_batch(
+        3, description='Wooden', category=chairs, tags=[tags[0].name])
+    products[0].tags.append(tags[1].name)
+    other = product_factory.create(description='Wooden', tags=[])
+    data, _ = search(client, 'q=wooden')
+    assert data['facets'] == {
+        'categories': [{'id': chairs.id, 'name': 'Chairs', 'count': 3},
+                       {'id': other.category.id, 'name': other.category.name,
+                        'count': 1}],
+        'tags': [{'id': tags[0].id, 'name': tags[0].name, 'count': 3},
+                 {'id': tags[1].id, 'name': tags[1].name, 'count': 1}],
+    }
+    data, _ = search(client, 'q=wooden&tag={:d}'.format(tags[1].id))
+    assert [p['id'] for p in data['results']] == [products[0].id]
+    data, _ = search(client, 'q=wooden+chairs&category={:d}'.format(
+        chairs.id))
+    assert data['total'] == 3
+
+
+def test_search_pagination(client, product_factory):
+    """ Results are paginated, x-next links the next page """
+    products = product_factory.create_batch(5, description='Stool', tags=[])
+    data, headers = search(client, 'q=stool&limit=2')
+    ids = [p['id'] for p in data['results']]
+    while 'x-next' in headers:
+        data, headers = search(client, headers['x-next'].split('?', 1)[1])
+        ids += [p['id'] for p in data['results']]
+    assert ids == [p.id for p in products]
+
+
+def test_search_follows_changes(client, product_factory, tag_factory,
+                                db_session):
+    """ Products are searchable by their current name, tags and category """
+    tag = tag_factory.create(name='blue')
+    product = product_factory.create(name='Sofa', tags=[tag.name])
+    assert SearchManager.search('blue').total == 1
+    tag.name = 'green'
+    product.category.name = 'Living room'
+    db_session.commit()
+    assert SearchManager.search('blue').total == 0
+    assert SearchManager.search('green living').total == 1
+    product.name = 'Couch'
+    db_session.commit()
+    assert SearchManager.search('sofa').total == 0
+    assert SearchManager.search('couch').hits[0].product_id == product.id
+    db_session.delete(product)
+    db_session.commit()
+    assert SearchManager.search('couch').total == 0
+
+
+def test_search_arguments(client):
+    rv = client.get('/api/products/search')
+    assert rv.status_code == 422
+    rv = client.get('/api/products/search?q=x&limit=0')
+    assert rv.status_code == 422
+
+
+def test_index_rebuild(product_factory, db_session):
+    """ Rebuilds replace the fallback index, searches running on the
+        previous one are unaffected """
+    cache = IndexCache()
+    product = product_factory.create(name='Lamp', tags=[])
+    db_session.commit()
+    index = cache.refresh(db_session)
+    assert cache.refresh(db_session) is index
+    product.name = 'Chair'
+    db_session.commit()
+    assert cache.refresh(db_session) is not index
+    assert index.search('lamp').total == 1
+    assert cache.refresh(db_session).search('lamp').total == 0
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+from flask import json
+from app.models import OrderStatusEnum
+from app.summaries import (OrderStatusSummary, ProductSellsSummary,
+                           SummariesManager, SummaryDelta)
+
+from .utils import assert_max_queries
+
+
+def create_orders(order_factory, customers, products, n):
+    orders = []
+    for _ in range(n):
+        order = order_factory.create(
+            customer=random.choice(customers),
+            status=random.choice(list(OrderStatusEnum)))
+        for product in random.sample(products, random.randint(1, 3)):
+            order.add_product(product, random.randint(1, 10))
+        orders.append(order)
+    return orders
+
+
+def test_summaries_follow_order_writes(client, order_factory, product_factory,
+                                       customer_factory, db_session):
+    """ Summaries are kept up to date when orders are created and their
+        status changes """
+    customers = customer_factory.create_batch(5)
+    products = product_factory.create_batch(5)
+    orders = create_orders(order_factory, customers, products, 20)
+    db_session.commit()
+    assert SummariesManager.check() == []
+    for order in random.sample(orders, 10):
+        rv = client.put('/api/orders/{:d}'.format(order.id),
+                        data=json.dumps({'status': 'DELIVERED'}),
+                        content_type='application/json')
+        assert rv.status_code == 204
+    assert SummariesManager.check() == []
+    for order in random.sample(orders, 10):
+        rv = client.put('/api/orders/{:d}'.format(order.id),
+                        data=json.dumps({'status': 'CANCELED'}),
+                        content_type='application/json')
+        assert rv.status_code == 204
+    assert SummariesManager.check() == []
+
+
+@pytest.mark.parametrize('dialect', [None, 'other'])
+def test_summary_delta_upsert(product_factory, db_session, monkeypatch,
+                              dialect):
+    """ Increments are added to the rows existing when they are applied,
+        even those inserted since the delta was computed, with one
+        statement per table where the database supports upserts """
+    products = product_factory.create_batch(3)
+    connection = db_session.connection()
+    if dialect:
+        monkeypatch.setattr(connection.dialect, 'name', dialect)
+    delta = SummaryDelta()
+    for product in products:
+        delta.add(ProductSellsSummary, product.id, 2)
+    delta.add(OrderStatusSummary, OrderStatusEnum.PENDING, 1)
+    # Inserted by a concurrent transaction
+    db_session.add(ProductSellsSummary(product_id=products[0].id, sells=5))
+    db_session.add(OrderStatusSummary(status=OrderStatusEnum.PENDING,
+                                      count=1))
+    db_session.flush()
+    with assert_max_queries(2 if dialect is None else 6):
+        delta.apply(connection)
+    assert {row.product_id: row.sells
+            for row in ProductSellsSummary.query} == {
+        products[0].id: 7, products[1].id: 2, products[2].id: 2}
+    assert OrderStatusSummary.query.get(OrderStatusEnum.PENDING).count == 2
+
+
+def test_summaries_follow_detail_changes(order_factory, product_factory,
+                                         customer_factory, country_factory,
+                                         db_session):
+    """ Summaries are kept up to date when detail lines change and when a
+        customer moves to another country """
+    customers = customer_factory.create_batch(3)
+    products = product_factory.create_batch(3)
+    orders = create_orders(order_factory, customers, products, 10)
+    for order in orders:
+        order.status = OrderStatusEnum.DELIVERED
+    db_session.commit()
+    orders[0].detail[0].quantity += 5
+    orders[1].detail[0].product = products[0]
+    customers[0].country = country_factory.create()
+    db_session.commit()
+    assert SummariesManager.check() == []
+
+
+def test_rebuild_summaries(order_factory, product_factory, customer_factory,
+                           db_session):
+    """ Rebuild fixes summary tables out of sync """
+    products = product_factory.create_batch(3)
+    create_orders(order_factory, customer_factory.create_batch(3), products, 5)
+    db_session.commit()
+    db_session.query(ProductSellsSummary).update(
+        {ProductSellsSummary.sells: 0})
+    assert len(SummariesManager.check()) > 0
+    SummariesManager.rebuild()
+    assert SummariesManager.check() == []
@@ -1,8 +1,13 @@
 import collections
+import contextlib
 import decimal
 import enum
 import datetime
 
+from sqlalchemy import event
+
+from app import db
+
 
 def model_to_dict(model, fields):
     """ build dict from model object, only include fields listed in `fields`
@@ -66,6 +71,35 @@ def product_to_dict(product):
     return d
 
 
+class FakeClock:
+    """ Clock for the components taking one, its time is set by the tests """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@contextlib.contextmanager
+def assert_max_queries(n):
+    """ Fails if the code run inside the context executes more than `n` SQL
+        statements. Savepoints issued by the test transactions are not
+        counted """
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith(('SAVEPOINT', 'RELEASE', 'ROLLBACK')):
+            statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert len(statements) <= n, '{:d} queries executed:\n{:s}'.format(
+        len(statements), '\n'.join(statements))
+
+
 expected_404 = {
     'status': 404,
     'message': 'Not found'
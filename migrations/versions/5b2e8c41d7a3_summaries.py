@@ -0,0 +1,61 @@
+"""statistics summary tables
+
+Revision ID: 5b2e8c41d7a3
+Revises: 07451d1ea1fc
+Create Date: 2026-10-18 10:12:31.204711
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8c41d7a3'
+down_revision = '07451d1ea1fc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('summary_product_sells',
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('sells', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['product_id'], ['product.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('product_id')
+    )
+    op.create_table('summary_delivered_units',
+    sa.Column('product_id', sa.Integer(), nullable=False),
+    sa.Column('country_id', sa.Integer(), nullable=False),
+    sa.Column('units', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['country_id'], ['country.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['product_id'], ['product.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('product_id', 'country_id')
+    )
+    op.create_table('summary_order_status',
+    sa.Column('status', postgresql.ENUM('PENDING', 'PAYED', 'SHIPPING', 'DELIVERED', 'CANCELED', name='orderstatusenum', create_type=False), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('status')
+    )
+    # Backfill from the existing orders
+    op.execute(
+        'INSERT INTO summary_product_sells (product_id, sells) '
+        'SELECT product_id, SUM(quantity) FROM order_detail '
+        'GROUP BY product_id')
+    op.execute(
+        'INSERT INTO summary_delivered_units (product_id, country_id, units) '
+        'SELECT order_detail.product_id, customer.country_id, '
+        'SUM(order_detail.quantity) FROM order_detail '
+        'JOIN "order" ON "order".id = order_detail.order_id '
+        'JOIN customer ON customer.id = "order".customer_id '
+        "WHERE \"order\".status = 'DELIVERED' "
+        'GROUP BY order_detail.product_id, customer.country_id')
+    op.execute(
+        'INSERT INTO summary_order_status (status, count) '
+        'SELECT status, COUNT(id) FROM "order" GROUP BY status')
+
+
+def downgrade():
+    op.drop_table('summary_order_status')
+    op.drop_table('summary_delivered_units')
+    op.drop_table('summary_product_sells')
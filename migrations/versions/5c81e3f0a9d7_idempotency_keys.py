@@ -0,0 +1,36 @@
+"""idempotency keys
+
+Revision ID: 5c81e3f0a9d7
+Revises: d29f4a7e61b8
+Create Date: 2026-10-18 21:14:37.902215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c81e3f0a9d7'
+down_revision = 'd29f4a7e61b8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'idempotency_key',
+        sa.Column('key', sa.String(length=255), nullable=False),
+        sa.Column('request_hash', sa.String(length=64), nullable=False),
+        sa.Column('status', sa.SmallInteger(), nullable=True),
+        sa.Column('response', sa.Text(), nullable=True),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('key')
+    )
+    op.create_index(op.f('ix_idempotency_key_expires_at'), 'idempotency_key',
+                    ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_key_expires_at'),
+                  table_name='idempotency_key')
+    op.drop_table('idempotency_key')
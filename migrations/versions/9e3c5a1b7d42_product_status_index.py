@@ -0,0 +1,24 @@
+"""product status index
+
+Revision ID: 9e3c5a1b7d42
+Revises: 5c81e3f0a9d7
+Create Date: 2026-10-18 23:02:17.518230
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9e3c5a1b7d42'
+down_revision = '5c81e3f0a9d7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_product_status_id', 'product', ['status', 'id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_product_status_id', table_name='product')
@@ -0,0 +1,29 @@
+"""row versions
+
+Revision ID: a3d6f0c2b915
+Revises: 5b2e8c41d7a3
+Create Date: 2026-10-18 11:02:47.531094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3d6f0c2b915'
+down_revision = '5b2e8c41d7a3'
+branch_labels = None
+depends_on = None
+
+TABLES = ('category', 'country', 'customer', 'product', 'order')
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, sa.Column('version', sa.BigInteger(),
+                                       server_default='1', nullable=False))
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        op.drop_column(table, 'version')
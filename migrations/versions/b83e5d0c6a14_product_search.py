@@ -0,0 +1,56 @@
+"""product search
+
+Revision ID: b83e5d0c6a14
+Revises: f1a2c9d84e37
+Create Date: 2026-10-18 18:21:09.304117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'b83e5d0c6a14'
+down_revision = 'f1a2c9d84e37'
+branch_labels = None
+depends_on = None
+
+# Same text search configuration and weights as app/search.py
+DOCUMENT = (
+    "setweight(to_tsvector('english', coalesce(product.name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(("
+    "SELECT string_agg(tag.name, ' ') FROM product_tag "
+    "JOIN tag ON tag.id = product_tag.tag_id "
+    "WHERE product_tag.product_id = product.id), '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(category.name, '')), 'C') || "
+    "setweight(to_tsvector('english', coalesce(product.description, '')), "
+    "'D')"
+)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    op.create_table(
+        'product_search',
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.Column('document', sa.Text().with_variant(
+            postgresql.TSVECTOR(), 'postgresql'), nullable=True),
+        sa.ForeignKeyConstraint(['product_id'], ['product.id'],
+                                ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('product_id')
+    )
+    # Backfill from the existing products
+    op.execute(
+        'INSERT INTO product_search (product_id, version, document) '
+        'SELECT product.id, 1, {document} FROM product '
+        'JOIN category ON category.id = product.category_id'.format(
+            document=DOCUMENT if dialect == 'postgresql' else 'NULL'))
+    if dialect == 'postgresql':
+        op.execute('CREATE INDEX ix_product_search_document ON '
+                   'product_search USING gin (document)')
+
+
+def downgrade():
+    op.drop_table('product_search')
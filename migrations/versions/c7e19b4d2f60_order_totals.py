@@ -0,0 +1,42 @@
+"""stored order totals
+
+Revision ID: c7e19b4d2f60
+Revises: a3d6f0c2b915
+Create Date: 2026-10-18 13:40:12.318230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e19b4d2f60'
+down_revision = 'a3d6f0c2b915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('order', sa.Column('total', sa.Numeric(12, 5),
+                                     server_default='0', nullable=False))
+    op.add_column('order', sa.Column('items_count', sa.Integer(),
+                                     server_default='0', nullable=False))
+    order = sa.table('order', sa.column('id'), sa.column('total'),
+                     sa.column('items_count'))
+    detail = sa.table('order_detail', sa.column('order_id'),
+                      sa.column('unit_price'), sa.column('quantity'))
+
+    def detail_sum(expression):
+        return sa.func.coalesce(
+            sa.select([sa.func.sum(expression)])
+            .where(detail.c.order_id == order.c.id).as_scalar(), 0)
+    op.execute(order.update().values(
+        total=detail_sum(detail.c.unit_price * detail.c.quantity),
+        items_count=detail_sum(detail.c.quantity)))
+    op.create_index(op.f('ix_order_total'), 'order', ['total'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_order_total'), table_name='order')
+    op.drop_column('order', 'items_count')
+    op.drop_column('order', 'total')
@@ -0,0 +1,31 @@
+"""reference versions
+
+Revision ID: d29f4a7e61b8
+Revises: b83e5d0c6a14
+Create Date: 2026-10-18 20:02:44.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd29f4a7e61b8'
+down_revision = 'b83e5d0c6a14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table = op.create_table(
+        'reference_version',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table, [{'name': name, 'version': 1}
+                           for name in ('country', 'category', 'tag')])
+
+
+def downgrade():
+    op.drop_table('reference_version')
@@ -0,0 +1,39 @@
+"""foreign keys and filters indexes
+
+Revision ID: e4b8a17c3d52
+Revises: c7e19b4d2f60
+Create Date: 2026-10-18 14:25:51.904417
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8a17c3d52'
+down_revision = 'c7e19b4d2f60'
+branch_labels = None
+depends_on = None
+
+# (index name, table, columns)
+INDEXES = (
+    ('ix_customer_country_id', 'customer', ['country_id']),
+    ('ix_product_category_id', 'product', ['category_id']),
+    ('ix_product_tag_tag_id', 'product_tag', ['tag_id']),
+    ('ix_order_customer_id', 'order', ['customer_id']),
+    ('ix_order_status_id', 'order', ['status', 'id']),
+    ('ix_order_detail_order_id', 'order_detail', ['order_id']),
+    ('ix_order_detail_product_id_quantity', 'order_detail',
+     ['product_id', 'quantity']),
+    ('ix_summary_delivered_units_country_id', 'summary_delivered_units',
+     ['country_id']),
+)
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,81 @@
+"""sales rollups
+
+Revision ID: f1a2c9d84e37
+Revises: e4b8a17c3d52
+Create Date: 2026-10-18 16:05:42.518037
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a2c9d84e37'
+down_revision = 'e4b8a17c3d52'
+branch_labels = None
+depends_on = None
+
+# (table, granularity, key columns besides the bucket)
+ROLLUPS = (
+    ('rollup_product_sales_hourly', 'hour', ('product_id', 'country_id')),
+    ('rollup_product_sales_daily', 'day', ('product_id', 'country_id')),
+    ('rollup_country_sales_hourly', 'hour', ('country_id',)),
+    ('rollup_country_sales_daily', 'day', ('country_id',)),
+)
+
+SOURCE_COLUMNS = {
+    'product_id': 'order_detail.product_id',
+    'country_id': 'customer.country_id',
+}
+
+
+def bucket(dialect, granularity):
+    if dialect == 'postgresql':
+        return "date_trunc('%s', \"order\".created_at)" % granularity
+    return "strftime('%s', \"order\".created_at)" % (
+        '%Y-%m-%d %H:00:00.000000' if granularity == 'hour'
+        else '%Y-%m-%d 00:00:00.000000')
+
+
+def upgrade():
+    for table, _, keys in ROLLUPS:
+        columns = [sa.Column('bucket', sa.DateTime(), nullable=False)]
+        constraints = []
+        if 'product_id' in keys:
+            columns.append(sa.Column('product_id', sa.Integer(),
+                                     nullable=False))
+            constraints.append(sa.ForeignKeyConstraint(
+                ['product_id'], ['product.id'], ondelete='CASCADE'))
+        columns += [
+            sa.Column('country_id', sa.Integer(), nullable=False),
+            sa.Column('units', sa.Integer(), nullable=False),
+            sa.Column('revenue', sa.Numeric(14, 5), nullable=False),
+            sa.Column('orders', sa.Integer(), nullable=False),
+        ]
+        constraints += [
+            sa.ForeignKeyConstraint(['country_id'], ['country.id'],
+                                    ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('bucket', *keys),
+        ]
+        op.create_table(table, *(columns + constraints))
+    # Backfill from the existing orders
+    dialect = op.get_bind().dialect.name
+    for table, granularity, keys in ROLLUPS:
+        expression = bucket(dialect, granularity)
+        sources = ', '.join(SOURCE_COLUMNS[key] for key in keys)
+        op.execute(
+            'INSERT INTO {table} (bucket, {keys}, units, revenue, orders) '
+            'SELECT {bucket}, {sources}, SUM(order_detail.quantity), '
+            'SUM(order_detail.unit_price * order_detail.quantity), '
+            'COUNT(DISTINCT "order".id) FROM order_detail '
+            'JOIN "order" ON "order".id = order_detail.order_id '
+            'JOIN customer ON customer.id = "order".customer_id '
+            "WHERE \"order\".status IN ('PAYED', 'SHIPPING', 'DELIVERED') "
+            'GROUP BY {bucket}, {sources}'.format(
+                table=table, keys=', '.join(keys), bucket=expression,
+                sources=sources))
+
+
+def downgrade():
+    for table, _, _ in reversed(ROLLUPS):
+        op.drop_table(table)